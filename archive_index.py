@@ -0,0 +1,669 @@
+import argparse
+import bisect
+import ctypes
+import ctypes.util
+import logging
+import mmap
+import os
+import sqlite3
+import sys
+import time
+import traceback
+import zipfile
+import zlib
+import xml.parsers.expat
+import dedup_store
+import s3_operations
+
+# Index of an export zip for restoring single items without unpacking the whole export.
+#
+# The index is built in one pass over the saved zip. It records where the data of every member starts, so an
+# attachment can be read with one range request, and the byte ranges of the issues, pages, attachments and
+# the entities that belong to them (comments, body contents, change groups...) within the uncompressed
+# entities.xml. entities.xml is one deflate stream, so the pass also saves checkpoints at deflate block
+# boundaries about every CHECKPOINT_SPACING bytes of XML, with the last 32 KB of XML before each of them, the
+# way zran.c of zlib does it. Decompression can restart at a checkpoint, so restoring an item only reads the
+# compressed bytes from the checkpoint before it to its end, from the local file through mmap or from S3
+# with ranged GETs.
+#
+# Restarting in the middle of a byte needs inflatePrime of the zlib C library, which the zlib module does not
+# offer; it is called through ctypes. Where the library cannot be loaded, e.g. on Windows, the index has no
+# checkpoints and a restore inflates entities.xml from its start up to the end of the item.
+
+INDEX_SUFFIX = '.index.sqlite'
+ENTITIES_MEMBER = 'entities.xml'
+CHECKPOINT_SPACING = 4 * 1024 * 1024
+WINDOW_SIZE = 32 * 1024
+OUTPUT_SIZE = 256 * 1024
+# Bytes of the previous piece of XML kept to look at a tag that started in it
+TAG_TAIL = 64
+# Jira entities that belong to an issue have an issue attribute
+JIRA_ROOT = 'entity-engine-xml'
+# Confluence objects that are restored on their own, and the properties that point to the content an object
+# belongs to
+CONFLUENCE_ROOT = 'hibernate-generic'
+CONFLUENCE_KINDS = {'Page', 'BlogPost', 'Attachment', 'Comment'}
+CONFLUENCE_OWNERS = {'content', 'containerContent'}
+# Kinds that can be restored, in the order tried for an id that several kinds have
+RESTORE_KINDS = ['Issue', 'Page', 'BlogPost', 'Comment', 'Attachment', 'FileAttachment']
+ATTACHMENT_KINDS = {'Attachment', 'FileAttachment'}
+
+_Z_OK = 0
+_Z_STREAM_END = 1
+_Z_BUF_ERROR = -5
+_Z_NO_FLUSH = 0
+_Z_BLOCK = 5
+
+
+class ArchiveIndexError(Exception):
+    pass
+
+
+class _ZStream(ctypes.Structure):
+    _fields_ = [('next_in', ctypes.c_void_p), ('avail_in', ctypes.c_uint), ('total_in', ctypes.c_ulong),
+                ('next_out', ctypes.c_void_p), ('avail_out', ctypes.c_uint), ('total_out', ctypes.c_ulong),
+                ('msg', ctypes.c_char_p), ('state', ctypes.c_void_p), ('zalloc', ctypes.c_void_p),
+                ('zfree', ctypes.c_void_p), ('opaque', ctypes.c_void_p), ('data_type', ctypes.c_int),
+                ('adler', ctypes.c_ulong), ('reserved', ctypes.c_ulong)]
+
+
+def _load_zlib():
+    name = ctypes.util.find_library('z')
+    if name is None:
+        return None
+    try:
+        library = ctypes.CDLL(name)
+    except OSError:
+        return None
+    stream = ctypes.POINTER(_ZStream)
+    library.zlibVersion.restype = ctypes.c_char_p
+    library.inflateInit2_.argtypes = [stream, ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+    library.inflate.argtypes = [stream, ctypes.c_int]
+    library.inflateEnd.argtypes = [stream]
+    library.inflatePrime.argtypes = [stream, ctypes.c_int, ctypes.c_int]
+    library.inflateSetDictionary.argtypes = [stream, ctypes.c_char_p, ctypes.c_uint]
+    return library
+
+
+libz = _load_zlib()
+
+
+def checkpoints_available():
+    return libz is not None
+
+
+class _Inflater(object):
+    """Raw inflate through the zlib C library, which can stop at deflate block boundaries and restart in the
+    middle of a byte"""
+
+    def __init__(self):
+        self._stream = _ZStream()
+        if libz.inflateInit2_(ctypes.byref(self._stream), -zlib.MAX_WBITS, libz.zlibVersion(),
+                              ctypes.sizeof(_ZStream)) != _Z_OK:
+            raise zlib.error('Cannot initialize zlib')
+        self._output = ctypes.create_string_buffer(OUTPUT_SIZE)
+        self.finished = False
+
+    def prime(self, bits, value):
+        libz.inflatePrime(ctypes.byref(self._stream), bits, value)
+
+    def set_window(self, window):
+        if window and libz.inflateSetDictionary(ctypes.byref(self._stream), window, len(window)) != _Z_OK:
+            raise zlib.error('Cannot set the window of a checkpoint')
+
+    def inflate(self, data, flush=_Z_NO_FLUSH):
+        """Yield (output, input bytes left) until data is used up or the stream ends. With Z_BLOCK it also
+        yields at every block boundary, possibly with empty output"""
+        source = ctypes.create_string_buffer(bytes(data), len(data))
+        stream = self._stream
+        stream.next_in = ctypes.addressof(source)
+        stream.avail_in = len(data)
+        while not self.finished:
+            stream.next_out = ctypes.addressof(self._output)
+            stream.avail_out = OUTPUT_SIZE
+            result = libz.inflate(ctypes.byref(stream), flush)
+            if result == _Z_BUF_ERROR:
+                # No progress possible without more input
+                return
+            if result == _Z_STREAM_END:
+                self.finished = True
+            elif result != _Z_OK:
+                raise zlib.error(f'Error {result} while inflating')
+            yield ctypes.string_at(self._output, OUTPUT_SIZE - stream.avail_out), stream.avail_in
+            if not stream.avail_in and stream.avail_out:
+                return
+
+    @property
+    def at_block_boundary(self):
+        # zlib sets 128 after an end of block code and 64 while in the last block
+        return bool(self._stream.data_type & 128) and not self._stream.data_type & 64
+
+    @property
+    def unused_bits(self):
+        return self._stream.data_type & 7
+
+    def close(self):
+        libz.inflateEnd(ctypes.byref(self._stream))
+
+
+class EntityScanner(object):
+    """Find the byte ranges of the items in entities.xml, fed in pieces in file order"""
+
+    def __init__(self):
+        self._parser = xml.parsers.expat.ParserCreate()
+        self._parser.buffer_text = True
+        self._parser.StartElementHandler = self._start
+        self._parser.EndElementHandler = self._end
+        self._parser.CharacterDataHandler = self._text
+        self.root = None
+        self.size = 0
+        # (kind, id, owner, start, end, input end)
+        self.entities = []
+        # Issue id to key, or to the project id and number when the export has no keys
+        self.issue_keys = {}
+        self.projects = {}
+        self._depth = 0
+        self._entity = None
+        self._owner_property = False
+        self._capture = None
+        self._capture_field = None
+        self._input_end = 0
+        self._data = b''
+        self._previous = b''
+
+    def feed(self, data, input_end):
+        """Parse the next piece of XML
+
+        :param input_end: Compressed bytes of the member that were read to produce data
+        """
+        self._input_end = input_end
+        self._previous = (self._previous + self._data)[-TAG_TAIL:]
+        self._data = data
+        self.size += len(data)
+        self._parser.Parse(data, False)
+
+    def close(self):
+        self._parser.Parse(b'', True)
+
+    def _close_entity(self, end):
+        kind, entity_id, owner, start = self._entity
+        if entity_id is not None or owner is not None:
+            self.entities.append((kind, entity_id, owner, start, end, self._input_end))
+        self._entity = None
+
+    def _closes_with_tag(self, position):
+        # An end event is at the start of an end tag, or right after the /> of an empty element
+        offset = position - (self.size - len(self._data))
+        if offset >= 0:
+            return self._data[offset:offset + 2] == b'</'
+        return (self._previous + self._data[:2])[len(self._previous) + offset:][:2] == b'</'
+
+    def _start(self, name, attributes):
+        position = self._parser.CurrentByteIndex
+        self._depth += 1
+        if self._depth == 1:
+            self.root = name
+        elif self._depth == 2:
+            if self.root == JIRA_ROOT:
+                if name == 'Project':
+                    self.projects[attributes.get('id')] = attributes.get('key')
+                elif name == 'Issue':
+                    self._entity = [name, attributes.get('id'), None, position]
+                    self.issue_keys[attributes.get('id')] = (attributes.get('key')
+                                                             or (attributes.get('project'), attributes.get('number')))
+                elif 'issue' in attributes:
+                    self._entity = [name, attributes.get('id'), attributes.get('issue'), position]
+            elif name == 'object':
+                self._entity = [attributes.get('class'), None, None, position]
+        elif self._entity is not None and self.root == CONFLUENCE_ROOT:
+            # <object class="Page"><id name="id">1</id><property name="content" class="Page"><id name="id">2</id>
+            if self._depth == 3:
+                self._owner_property = name == 'property' and attributes.get('name') in CONFLUENCE_OWNERS
+                if name == 'id':
+                    self._capture, self._capture_field = [], 1
+            elif self._depth == 4 and name == 'id' and self._owner_property and self._entity[2] is None:
+                self._capture, self._capture_field = [], 2
+
+    def _text(self, data):
+        if self._capture is not None:
+            self._capture.append(data)
+
+    def _end(self, name):
+        position = self._parser.CurrentByteIndex
+        if self._capture is not None:
+            self._entity[self._capture_field] = ''.join(self._capture).strip()
+            self._capture = None
+        self._depth -= 1
+        if self._depth == 1 and self._entity is not None:
+            if self.root == CONFLUENCE_ROOT and self._entity[0] not in CONFLUENCE_KINDS and self._entity[2] is None:
+                self._entity = None
+            else:
+                self._close_entity(position + len(name) + 3 if self._closes_with_tag(position) else position)
+
+
+def _create_tables(connection):
+    connection.executescript('''
+        CREATE TABLE members (
+            name TEXT PRIMARY KEY, data_offset INTEGER NOT NULL, compress_type INTEGER NOT NULL,
+            compress_size INTEGER NOT NULL, file_size INTEGER NOT NULL, attachment_id TEXT);
+        CREATE INDEX members_by_attachment ON members (attachment_id);
+        CREATE TABLE entities (
+            kind TEXT NOT NULL, id TEXT, owner TEXT, start INTEGER NOT NULL, end INTEGER NOT NULL,
+            input_end INTEGER NOT NULL);
+        CREATE INDEX entities_by_id ON entities (id);
+        CREATE INDEX entities_by_owner ON entities (owner);
+        CREATE TABLE aliases (alias TEXT PRIMARY KEY, id TEXT NOT NULL);
+        CREATE TABLE checkpoints (
+            output INTEGER PRIMARY KEY, input INTEGER NOT NULL, bits INTEGER NOT NULL, window BLOB NOT NULL);
+        CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT);
+    ''')
+
+
+def attachment_id(name):
+    """Id of the attachment stored in a member, from the layout of the Jira and Confluence exports"""
+    parts = name.split('/')
+    if name.startswith('data/attachments/') and len(parts) > 3:
+        # data/attachments/<project>/<bucket>/<issue>/<attachment id>
+        return parts[-1]
+    if name.startswith('attachments/') and len(parts) >= 4:
+        # attachments/<content id>/<attachment id>/<version>
+        return parts[2]
+    return None
+
+
+class Build(object):
+    """Statistics of an index build"""
+
+    def __init__(self):
+        self.members = 0
+        self.entities = 0
+        self.checkpoints = 0
+        self.xml_size = 0
+
+
+def build(path, index_path=None, spacing=CHECKPOINT_SPACING):
+    """Index the export zip path into index_path, by default next to it
+
+    :param spacing: Bytes of XML between checkpoints. Smaller is faster to restore from but a larger index
+    :return: Build with the numbers of indexed members, entities and checkpoints
+    """
+    index_path = index_path or path + INDEX_SUFFIX
+    temp_path = index_path + '.tmp'
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    stats = Build()
+    connection = sqlite3.connect(temp_path)
+    try:
+        with connection:
+            _create_tables(connection)
+            entities_region = None
+            for kind, offset, length, info in dedup_store.zip_regions(path):
+                if kind != 'member':
+                    continue
+                connection.execute('INSERT INTO members VALUES (?, ?, ?, ?, ?, ?)',
+                                   (info.filename, offset, info.compress_type, info.compress_size, info.file_size,
+                                    attachment_id(info.filename)))
+                stats.members += 1
+                if info.filename == ENTITIES_MEMBER:
+                    entities_region = (offset, length, info.compress_type)
+            if entities_region is None:
+                raise ArchiveIndexError(f'{path} has no {ENTITIES_MEMBER}')
+
+            scanner = EntityScanner()
+            with open(path, 'rb') as f:
+                f.seek(entities_region[0])
+                checkpoints = _scan(f, entities_region[1], entities_region[2], scanner, spacing)
+            scanner.close()
+            stats.xml_size = scanner.size
+
+            connection.executemany('INSERT INTO entities VALUES (?, ?, ?, ?, ?, ?)', scanner.entities)
+            aliases = []
+            for issue_id, key in scanner.issue_keys.items():
+                if isinstance(key, tuple):
+                    project, number = key
+                    key = f'{scanner.projects[project]}-{number}' if scanner.projects.get(project) else None
+                if key:
+                    aliases.append((key, issue_id))
+            connection.executemany('INSERT OR REPLACE INTO aliases VALUES (?, ?)', aliases)
+            connection.executemany('INSERT INTO checkpoints VALUES (?, ?, ?, ?)',
+                                   [(output, source, bits, zlib.compress(window))
+                                    for output, source, bits, window in checkpoints])
+            connection.executemany('INSERT INTO meta VALUES (?, ?)',
+                                   [('root', scanner.root), ('archive', os.path.basename(path)),
+                                    ('archive_size', str(os.path.getsize(path))),
+                                    ('xml_size', str(stats.xml_size))])
+            stats.entities = len(scanner.entities)
+            stats.checkpoints = len(checkpoints)
+    finally:
+        connection.close()
+    os.replace(temp_path, index_path)
+    return stats
+
+
+def _scan(f, length, compress_type, scanner, spacing):
+    """Feed the XML of the member at the position of f to scanner and return the checkpoints"""
+    if compress_type == zipfile.ZIP_STORED:
+        done = 0
+        while done < length:
+            block = f.read(min(dedup_store.READ_SIZE, length - done))
+            done += len(block)
+            scanner.feed(block, done)
+        return []
+    if compress_type != zipfile.ZIP_DEFLATED:
+        raise ArchiveIndexError(f'{ENTITIES_MEMBER} uses an unsupported compression method')
+
+    checkpoints = []
+    if libz is None:
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        done = 0
+        while done < length:
+            block = f.read(min(dedup_store.READ_SIZE, length - done))
+            done += len(block)
+            scanner.feed(decompressor.decompress(block), done)
+        scanner.feed(decompressor.flush(), done)
+        return checkpoints
+
+    inflater = _Inflater()
+    window = bytearray()
+    output = 0
+    last = -spacing
+    done = 0
+    try:
+        while done < length and not inflater.finished:
+            block = f.read(min(dedup_store.READ_SIZE, length - done))
+            if not block:
+                raise IOError('Unexpected end of file')
+            for data, left in inflater.inflate(block, _Z_BLOCK):
+                used = done + len(block) - left
+                if data:
+                    scanner.feed(data, used)
+                    output += len(data)
+                    window += data
+                    if len(window) > 2 * WINDOW_SIZE:
+                        del window[:-WINDOW_SIZE]
+                if inflater.at_block_boundary and output - last >= spacing:
+                    checkpoints.append((output, used, inflater.unused_bits, bytes(window[-WINDOW_SIZE:])))
+                    last = output
+            done += len(block)
+    finally:
+        inflater.close()
+    return checkpoints
+
+
+class LocalArchive(object):
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.requests = 0
+        self.bytes_read = 0
+
+    def read(self, offset, length):
+        self.requests += 1
+        self.bytes_read += length
+        return self._map[offset:offset + length]
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+class S3Archive(object):
+
+    def __init__(self, bucket, key):
+        self._bucket = bucket
+        self._key = key
+        self._client = s3_operations.get_client()
+        self.requests = 0
+        self.bytes_read = 0
+
+    def read(self, offset, length):
+        if length <= 0:
+            return b''
+        self.requests += 1
+        self.bytes_read += length
+        response = self._client.get_object(Bucket=self._bucket, Key=self._key,
+                                           Range=f'bytes={offset}-{offset + length - 1}')
+        return response['Body'].read()
+
+    def download_index(self, target):
+        self._client.download_file(self._bucket, self._key + INDEX_SUFFIX, target)
+
+    def close(self):
+        pass
+
+
+def open_archive(location):
+    """Open a local export zip or one in S3 given as s3://bucket/key"""
+    if location.startswith('s3://'):
+        bucket, _, key = location[len('s3://'):].partition('/')
+        return S3Archive(bucket, key)
+    return LocalArchive(location)
+
+
+class Index(object):
+    """Read side of an index built by build"""
+
+    def __init__(self, index_path):
+        self._connection = sqlite3.connect(f'file:{index_path}?mode=ro', uri=True)
+        self.root = self._meta('root')
+        self._checkpoints = self._connection.execute(
+            'SELECT output, input, bits FROM checkpoints ORDER BY output').fetchall()
+        self._outputs = [checkpoint[0] for checkpoint in self._checkpoints]
+
+    def _meta(self, name):
+        row = self._connection.execute('SELECT value FROM meta WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def resolve(self, item, kind=None):
+        """Return (kind, id) of an item given by id or issue key, None if it is not in the index
+
+        :param kind: Kind of the item, e.g. FileAttachment, when entities of several kinds have its id
+        """
+        if kind is None:
+            row = self._connection.execute('SELECT id FROM aliases WHERE alias = ?', (item,)).fetchone()
+            if row is not None:
+                return 'Issue', row[0]
+        kinds = [kind] if kind else RESTORE_KINDS
+        found = {row[0] for row in self._connection.execute(
+            f'SELECT DISTINCT kind FROM entities WHERE id = ? AND kind IN ({",".join("?" * len(kinds))})',
+            [item] + kinds)}
+        for candidate in kinds:
+            if candidate in found:
+                return candidate, item
+        return None
+
+    def issue_keys(self):
+        return [row[0] for row in self._connection.execute('SELECT alias FROM aliases ORDER BY alias')]
+
+    def ranges(self, kind, item_id):
+        """Return the (kind, id, start, end, input_end) of an item and of everything that belongs to it"""
+        if kind == 'Issue' or self.root == CONFLUENCE_ROOT:
+            # Jira entities belong to issues only, Confluence content ids are unique across kinds
+            return self._connection.execute(
+                'SELECT kind, id, start, end, input_end FROM entities WHERE kind = ? AND id = ? OR owner = ? '
+                'ORDER BY start', (kind, item_id, item_id)).fetchall()
+        return self._connection.execute('SELECT kind, id, start, end, input_end FROM entities WHERE kind = ? AND '
+                                        'id = ? ORDER BY start', (kind, item_id)).fetchall()
+
+    def member(self, name):
+        row = self._connection.execute('SELECT name, data_offset, compress_type, compress_size, file_size '
+                                       'FROM members WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            raise ArchiveIndexError(f'{name} is not in the archive')
+        return row
+
+    def attachment_members(self, attachment_ids):
+        ids = list(attachment_ids)
+        if not ids:
+            return []
+        return self._connection.execute(
+            'SELECT name, data_offset, compress_type, compress_size, file_size FROM members '
+            f'WHERE attachment_id IN ({",".join("?" * len(ids))}) ORDER BY name', ids).fetchall()
+
+    def checkpoint_before(self, output):
+        """Return (output, input, bits, window) of the last checkpoint at or before output, None if none"""
+        position = bisect.bisect_right(self._outputs, output) - 1
+        if position < 0:
+            return None
+        checkpoint_output, checkpoint_input, bits = self._checkpoints[position]
+        window = self._connection.execute('SELECT window FROM checkpoints WHERE output = ?',
+                                          (checkpoint_output,)).fetchone()[0]
+        return checkpoint_output, checkpoint_input, bits, zlib.decompress(window)
+
+    def close(self):
+        self._connection.close()
+
+
+def _read_member(archive, member):
+    name, data_offset, compress_type, compress_size, file_size = member
+    data = archive.read(data_offset, compress_size)
+    if compress_type == zipfile.ZIP_STORED:
+        return data
+    if compress_type == zipfile.ZIP_DEFLATED:
+        return zlib.decompress(data, -zlib.MAX_WBITS)
+    raise ArchiveIndexError(f'{name} uses an unsupported compression method')
+
+
+def _read_xml(archive, index, entities_member, start, end, input_end):
+    """Return the bytes start-end of entities.xml, inflating from the nearest checkpoint"""
+    _, data_offset, compress_type, _, _ = entities_member
+    if compress_type == zipfile.ZIP_STORED:
+        return archive.read(data_offset + start, end - start)
+
+    checkpoint = index.checkpoint_before(start)
+    if checkpoint is None or libz is None:
+        # Without a checkpoint the stream has to be inflated from its start
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return decompressor.decompress(archive.read(data_offset, input_end))[start:end]
+
+    output, source, bits, window = checkpoint
+    first = source - (1 if bits else 0)
+    data = archive.read(data_offset + first, input_end - first)
+    inflater = _Inflater()
+    try:
+        if bits:
+            inflater.prime(bits, data[0] >> (8 - bits))
+            data = data[1:]
+        inflater.set_window(window)
+        pieces = []
+        for piece, _ in inflater.inflate(data):
+            pieces.append(piece)
+            output += len(piece)
+            if output >= end:
+                break
+    finally:
+        inflater.close()
+    skip = start - checkpoint[0]
+    return b''.join(pieces)[skip:skip + end - start]
+
+
+class Restore(object):
+    """Result of a restore"""
+
+    def __init__(self):
+        self.entities = 0
+        self.attachments = []
+        self.xml_path = None
+
+
+def restore(index, archive, item, folder, kind=None):
+    """Write the XML of an item and of everything that belongs to it to folder, with its attachments
+
+    :param index: Index of the archive
+    :param archive: LocalArchive or S3Archive, see open_archive
+    :param item: Issue key, or id of an issue, page, blog post, comment or attachment
+    :param kind: Kind of the item when several kinds have its id, see Index.resolve
+    :return: Restore with the written files
+    """
+    resolved = index.resolve(item, kind)
+    if resolved is None:
+        raise ArchiveIndexError(f'{item} is not in the index')
+    ranges = index.ranges(*resolved)
+    entities_member = index.member(ENTITIES_MEMBER)
+
+    # Items that are close together are inflated in one go
+    groups = []
+    for _, _, start, end, input_end in ranges:
+        if groups and start - groups[-1][1] < CHECKPOINT_SPACING:
+            groups[-1][1] = max(groups[-1][1], end)
+            groups[-1][2] = max(groups[-1][2], input_end)
+            groups[-1][3].append((start, end))
+        else:
+            groups.append([start, end, input_end, [(start, end)]])
+
+    fragments = []
+    for group_start, group_end, input_end, members in groups:
+        xml_data = _read_xml(archive, index, entities_member, group_start, group_end, input_end)
+        fragments += [xml_data[start - group_start:end - group_start].strip() for start, end in members]
+
+    result = Restore()
+    result.entities = len(fragments)
+    os.makedirs(folder, exist_ok=True)
+    result.xml_path = os.path.join(folder, f'{item}.xml')
+    with open(result.xml_path, 'wb') as f:
+        f.write(f'<?xml version="1.0" encoding="UTF-8"?>\n<{index.root}>\n'.encode('UTF-8'))
+        for fragment in fragments:
+            f.write(b'    ' + fragment + b'\n')
+        f.write(f'</{index.root}>\n'.encode('UTF-8'))
+
+    attachment_ids = {entity_id for entity_kind, entity_id, _, _, _ in ranges if entity_kind in ATTACHMENT_KINDS}
+    for member in index.attachment_members(attachment_ids):
+        parts = member[0].split('/')
+        if '..' in parts:
+            raise ArchiveIndexError(f'{member[0]} is outside of the export')
+        target = os.path.join(folder, *parts)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as f:
+            f.write(_read_member(archive, member))
+        result.attachments.append(target)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser('archive_index')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='Index an export zip, the index is saved next to it')
+    build_parser.add_argument('file')
+    restore_parser = subparsers.add_parser('restore', help='Restore one issue, page or attachment')
+    restore_parser.add_argument('archive', help='Export zip, local or s3://bucket/key')
+    restore_parser.add_argument('item', help='Issue key, or id of an issue, page, blog post, comment or attachment')
+    restore_parser.add_argument('--kind', help='Kind of the item when several kinds have its id', choices=RESTORE_KINDS)
+    restore_parser.add_argument('-o', '--output', help='Folder to write the item to', default='.')
+    restore_parser.add_argument('--index', help='Index file, by default the one next to the archive')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s', level=logging.INFO)
+    try:
+        if args.command == 'build':
+            start = time.perf_counter()
+            stats = build(args.file)
+            logging.info(f'{stats.entities} entities of {stats.xml_size // 1000000} MB of XML and {stats.members} '
+                         f'members indexed with {stats.checkpoints} checkpoints in '
+                         f'{time.perf_counter() - start:.1f} seconds')
+            return
+
+        start = time.perf_counter()
+        archive = open_archive(args.archive)
+        index_path = args.index or args.archive + INDEX_SUFFIX
+        if args.index is None and isinstance(archive, S3Archive):
+            index_path = os.path.join(args.output, os.path.basename(args.archive) + INDEX_SUFFIX)
+            os.makedirs(args.output, exist_ok=True)
+            archive.download_index(index_path)
+        index = Index(index_path)
+        try:
+            result = restore(index, archive, args.item, args.output, args.kind)
+        finally:
+            index.close()
+            archive.close()
+        logging.info(f'{result.entities} entities written to {result.xml_path} and {len(result.attachments)} '
+                     f'attachments restored in {time.perf_counter() - start:.2f} seconds with {archive.requests} '
+                     f'reads of {archive.bytes_read // 1000} KB')
+    except Exception:
+        logging.error(f'{args.command} failed')
+        logging.error(traceback.format_exc())
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
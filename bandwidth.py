@@ -0,0 +1,381 @@
+import ctypes
+import logging
+import os
+import platform
+import re
+import threading
+import time
+import weakref
+from collections import deque
+
+# Bandwidth shaping of downloads and uploads.
+#
+# A TokenBucket is shared by every worker that should stay under one limit. Workers take tokens from it in
+# leases of LEASE_SECONDS worth of the rate and spend them on their own, so the shared lock is only taken
+# about once per lease and not for every chunk. The limit can follow a Schedule of the time of day and be
+# lowered further by an AdaptiveThrottle when the latency of the requests rises, i.e. when the link is
+# congested. Every bucket counts the bytes that passed through it to report the achieved rate.
+
+# Tokens a worker takes from the shared bucket at once, in seconds of the rate
+LEASE_SECONDS = 0.05
+# How often the limit is recomputed from the schedule and the throttle
+REFRESH_INTERVAL = 1.0
+# The throttle backs off when the latency is this much above the lowest latency seen recently...
+LATENCY_TOLERANCE = 1.0
+# ...and at least this many seconds above it
+MIN_LATENCY_INCREASE = 0.1
+LATENCY_HISTORY_SECONDS = 600
+BACKOFF_FACTOR = 0.7
+RECOVERY_STEP = 0.05
+MIN_FACTOR = 0.1
+# Burst of an adaptive bucket in seconds of the rate. A long burst fills the queue the throttle tries to keep short
+ADAPTIVE_BURST_SECONDS = 0.1
+# Niceness added by lower_priority
+NICE_INCREMENT = 10
+
+DAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+_WINDOW = re.compile(r'^(?:(?P<days>[a-z]{3}(?:-[a-z]{3})?)\s+)?(?P<start>\d{1,2}:\d{2})-(?P<end>\d{1,2}:\d{2})'
+                     r'\s*=\s*(?P<rate>\d+(?:\.\d+)?)$')
+# ioprio_set is not wrapped by Python
+_IOPRIO_SET = {'x86_64': 251, 'aarch64': 30}
+_IOPRIO_WHO_PROCESS = 1
+_IOPRIO_CLASS_BE = 2
+_IOPRIO_CLASS_SHIFT = 13
+_IOPRIO_LOWEST_LEVEL = 7
+# Linux keeps the priorities per thread, lower_priority sets the flag of every thread it has lowered
+_lowered = threading.local()
+
+
+def _minutes(text):
+    hours, minutes = (int(part) for part in text.split(':'))
+    if hours > 24 or minutes > 59:
+        raise ValueError(f'Invalid time {text}')
+    return hours * 60 + minutes
+
+
+class Schedule(object):
+    """Bandwidth limits by day of the week and time of day
+
+    A schedule is a comma separated list of windows like "08:00-18:00=50" or "mon-fri 08:00-18:00=50", with
+    the limit in MB/s. Windows may cross midnight. The first matching window applies; outside of all windows
+    the default rate applies, None for no limit.
+    """
+
+    def __init__(self, windows, default_rate=None):
+        """
+        :param windows: List of (set of weekdays 0-6, start minute, end minute, rate in bytes per second)
+        :param default_rate: Rate in bytes per second outside of the windows, None for no limit
+        """
+        self.windows = windows
+        self.default_rate = default_rate
+
+    @classmethod
+    def parse(cls, text, default_rate=None):
+        windows = []
+        for part in text.lower().split(','):
+            match = _WINDOW.match(part.strip())
+            if match is None:
+                raise ValueError(f'Invalid bandwidth schedule window "{part.strip()}", expected e.g. '
+                                 f'"mon-fri 08:00-18:00=50"')
+            days = set(range(7))
+            if match.group('days'):
+                first, _, last = match.group('days').partition('-')
+                last = last or first
+                if first not in DAYS or last not in DAYS:
+                    raise ValueError(f'Invalid days {match.group("days")}, expected e.g. mon-fri')
+                first, last = DAYS.index(first), DAYS.index(last)
+                days = {day % 7 for day in range(first, last + 1 if last >= first else last + 8)}
+            windows.append((days, _minutes(match.group('start')), _minutes(match.group('end')),
+                            float(match.group('rate')) * 1000000))
+        return cls(windows, default_rate)
+
+    def rate_at(self, local_time):
+        """Rate in bytes per second at local_time, a time.struct_time"""
+        minute = local_time.tm_hour * 60 + local_time.tm_min
+        day = local_time.tm_wday
+        for days, start, end, rate in self.windows:
+            if start <= end:
+                if day in days and start <= minute < end:
+                    return rate
+            # A window across midnight belongs to the day it starts on
+            elif (day in days and minute >= start) or ((day - 1) % 7 in days and minute < end):
+                return rate
+        return self.default_rate
+
+
+class AdaptiveThrottle(object):
+    """Lower the rate while request latencies are above the lowest recent latency
+
+    The lowest latency of the last LATENCY_HISTORY_SECONDS is taken as the latency of an idle link. While the
+    smoothed latency is well above it, the rate is cut by BACKOFF_FACTOR, otherwise it recovers by RECOVERY_STEP
+    of the full rate, both at most once per REFRESH_INTERVAL.
+    """
+
+    def __init__(self, tolerance=LATENCY_TOLERANCE, min_increase=MIN_LATENCY_INCREASE):
+        self._tolerance = tolerance
+        self._min_increase = min_increase
+        self._samples = deque()
+        self._smoothed = None
+        self._next_change = 0.0
+        self._reference = None
+        self.factor = 1.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        """Add the latency of a request"""
+        now = time.monotonic()
+        with self._lock:
+            # Keep the samples that can still be the minimum
+            while self._samples and (self._samples[-1][1] >= seconds or
+                                     self._samples[0][0] < now - LATENCY_HISTORY_SECONDS):
+                if self._samples[-1][1] >= seconds:
+                    self._samples.pop()
+                else:
+                    self._samples.popleft()
+            self._samples.append((now, seconds))
+            base = self._samples[0][1]
+            self._smoothed = seconds if self._smoothed is None else 0.7 * self._smoothed + 0.3 * seconds
+
+            if now < self._next_change:
+                return
+            self._next_change = now + REFRESH_INTERVAL
+            if self._smoothed > base * (1 + self._tolerance) and self._smoothed - base > self._min_increase:
+                self.factor = max(MIN_FACTOR, self.factor * BACKOFF_FACTOR)
+            else:
+                self.factor = min(1.0, self.factor + RECOVERY_STEP)
+
+    def limit(self, ceiling, achieved):
+        """Return the rate to use given the configured ceiling, None for no limit, and the achieved rate"""
+        with self._lock:
+            if self.factor >= 1.0:
+                self._reference = None
+                return ceiling
+            if not self._reference:
+                # Without a configured limit, back off from the rate at which the congestion started
+                self._reference = ceiling or achieved
+            return self._reference * self.factor if self._reference else ceiling
+
+
+class _WorkerState(object):
+
+    def __init__(self):
+        self.bytes = 0
+        self.credit = 0.0
+        self.waited = 0.0
+
+
+class _ThreadAlive(object):
+    """Kept in the thread-local storage only, so it is freed when the thread ends"""
+
+
+class TokenBucket(object):
+    """Limit the average transfer rate of everybody sharing this object to rate bytes per second"""
+
+    def __init__(self, rate, burst=None, schedule=None, throttle=None):
+        """
+        :param rate: Bytes per second, None for no limit. Only used if there is no schedule
+        :param burst: Bytes that may be sent at once after an idle time, one second of the rate by default and
+                      ADAPTIVE_BURST_SECONDS with a throttle
+        :param schedule: Optional Schedule that sets the rate by the time of day
+        :param throttle: Optional AdaptiveThrottle that lowers the rate on rising latency, see watch
+        """
+        self._base_rate = float(rate) if rate else None
+        self._burst = burst
+        self._burst_seconds = ADAPTIVE_BURST_SECONDS if throttle is not None else 1.0
+        self._schedule = schedule
+        self._throttle = throttle
+        self._rate = None
+        self._capacity = 0.0
+        self._tokens = 0.0
+        self._local = threading.local()
+        self._workers = set()
+        # Workers whose thread has ended, their totals are moved to the counters below with the lock held
+        self._ended = deque()
+        self._ended_bytes = 0
+        self._ended_waited = 0.0
+        self._lock = threading.Lock()
+
+        now = time.monotonic()
+        self._started = None
+        self._last = now
+        self._window_start = now
+        self._window_bytes = 0
+        self.achieved_rate = 0.0
+        self._next_refresh = 0.0
+        with self._lock:
+            self._refresh(now)
+        self._tokens = self._capacity
+
+    def __call__(self, bytes_amount):
+        # S3 progress callbacks report negative amounts when a part is retried
+        if bytes_amount <= 0:
+            return
+        worker = getattr(self._local, 'worker', None)
+        if worker is None:
+            worker = self._register()
+        worker.bytes += bytes_amount
+        now = time.monotonic()
+        if now >= self._next_refresh:
+            with self._lock:
+                self._refresh(now)
+        if self._rate is None:
+            return
+
+        worker.credit -= bytes_amount
+        if worker.credit >= 0:
+            return
+        wait = self._lease(worker, now)
+        if wait > 0:
+            worker.waited += wait
+            time.sleep(wait)
+
+    def _register(self):
+        worker = _WorkerState()
+        self._local.worker = worker
+        self._local.alive = _ThreadAlive()
+        # Transfer threads come and go, so a worker is dropped when its thread ends. The finalizer can run in the
+        # middle of any code of the ending thread, so it only queues the worker and does not take the lock
+        weakref.finalize(self._local.alive, self._ended.append, worker)
+        with self._lock:
+            self._workers.add(worker)
+            if self._started is None:
+                self._started = time.monotonic()
+        return worker
+
+    def _lease(self, worker, now):
+        with self._lock:
+            rate = self._rate
+            if rate is None:
+                worker.credit = 0.0
+                return 0
+            self._tokens = min(self._capacity, self._tokens + (now - self._last) * rate)
+            self._last = now
+            # Take the tokens right away and let the caller sleep off the debt, so that the lock is not
+            # held while waiting
+            take = max(-worker.credit, rate * LEASE_SECONDS)
+            self._tokens -= take
+            worker.credit += take
+            return -self._tokens / rate if self._tokens < 0 else 0
+
+    def _refresh(self, now):
+        # Called with the lock held
+        if now < self._next_refresh:
+            return
+        self._next_refresh = now + REFRESH_INTERVAL
+        total = self._total_bytes()
+        if now > self._window_start:
+            self.achieved_rate = (total - self._window_bytes) / (now - self._window_start)
+        self._window_start = now
+        self._window_bytes = total
+
+        rate = self._schedule.rate_at(time.localtime()) if self._schedule is not None else self._base_rate
+        if self._throttle is not None:
+            rate = self._throttle.limit(rate, self.achieved_rate)
+        if rate != self._rate:
+            if rate is not None:
+                logging.debug(f'Bandwidth limit is now {rate / 1000000:.1f} MB/s')
+            self._rate = rate
+            self._capacity = float(self._burst or (rate or 0) * self._burst_seconds)
+            self._tokens = min(self._tokens, self._capacity)
+            self._last = now
+
+    def _total_bytes(self):
+        # Called with the lock held
+        while self._ended:
+            worker = self._ended.popleft()
+            self._workers.discard(worker)
+            self._ended_bytes += worker.bytes
+            self._ended_waited += worker.waited
+        return self._ended_bytes + sum(worker.bytes for worker in self._workers)
+
+    @property
+    def rate(self):
+        """Current limit in bytes per second, None for no limit"""
+        return self._rate
+
+    def watch(self, session):
+        """Feed the request latencies of a transport.create_session session to the adaptive throttle"""
+        if self._throttle is not None:
+            session.transport_stats.add_listener(self._observe)
+
+    def _observe(self, method, url, seconds, failed):
+        if not failed:
+            self._throttle.observe(seconds)
+
+    def report(self):
+        with self._lock:
+            total = self._total_bytes()
+            waited = self._ended_waited + sum(worker.waited for worker in self._workers)
+            elapsed = time.monotonic() - self._started if self._started is not None else 0
+            return {
+                'bytes': total,
+                'seconds': elapsed,
+                'achieved_bytes_per_second': total / elapsed if elapsed else 0,
+                'limit_bytes_per_second': self._rate,
+                'throttled_seconds': waited,
+            }
+
+    def log(self, name='Transfer'):
+        report = self.report()
+        limit = report['limit_bytes_per_second']
+        logging.info(f'{name} ran at {report["achieved_bytes_per_second"] / 1000000:.1f} MB/s on average, limit '
+                     f'{f"{limit / 1000000:.1f} MB/s" if limit else "none"} at the end, workers waited '
+                     f'{report["throttled_seconds"]:.1f} seconds for the limit')
+
+
+class CombinedLimiter(object):
+    """Apply several limits at once, e.g. a per-site limit and a global one"""
+
+    def __init__(self, *limiters):
+        self._limiters = [limiter for limiter in limiters if limiter is not None]
+
+    def __call__(self, bytes_amount):
+        for limiter in self._limiters:
+            limiter(bytes_amount)
+
+    def watch(self, session):
+        for limiter in self._limiters:
+            limiter.watch(session)
+
+
+def from_mb(rate_mb, schedule=None, adaptive=False):
+    """Create a TokenBucket from a rate in MB/s, None if neither a rate, a schedule nor adaptive is set
+
+    :param schedule: Schedule text, see Schedule, with rate_mb as the rate outside of its windows
+    :param adaptive: Lower the rate on rising latency
+    """
+    if not (rate_mb or schedule or adaptive):
+        return None
+    rate = rate_mb * 1000000 if rate_mb else None
+    return TokenBucket(rate, schedule=Schedule.parse(schedule, rate) if schedule else None,
+                       throttle=AdaptiveThrottle() if adaptive else None)
+
+
+def from_options(options):
+    """Create the TokenBucket of the bandwidth_mb, bandwidth_schedule and adaptive_bandwidth options"""
+    return from_mb(options.get('bandwidth_mb'), options.get('bandwidth_schedule'),
+                   options.get('adaptive_bandwidth', False))
+
+
+def lower_priority():
+    """Lower the CPU and disk I/O priority of the calling thread and of the threads it starts afterwards
+
+    The disk priority is the lowest best-effort level, which only the BFQ and CFQ Linux I/O schedulers take
+    into account. Later calls from the same thread do nothing, so the niceness is only added once.
+    """
+    if getattr(_lowered, 'done', False):
+        return
+    _lowered.done = True
+    try:
+        os.nice(NICE_INCREMENT)
+    except (AttributeError, OSError):
+        logging.warning('Cannot lower the CPU priority')
+
+    syscall = _IOPRIO_SET.get(platform.machine())
+    if syscall is None or platform.system() != 'Linux':
+        logging.warning('Cannot lower the disk I/O priority on this platform')
+        return
+    libc = ctypes.CDLL(None, use_errno=True)
+    priority = (_IOPRIO_CLASS_BE << _IOPRIO_CLASS_SHIFT) | _IOPRIO_LOWEST_LEVEL
+    if libc.syscall(syscall, _IOPRIO_WHO_PROCESS, 0, priority) != 0:
+        logging.warning(f'Cannot lower the disk I/O priority: {os.strerror(ctypes.get_errno())}')
@@ -0,0 +1,122 @@
+import argparse
+import contextlib
+import logging
+import os
+import random
+import tempfile
+import time
+import zipfile
+import archive_index
+import s3_operations
+from benchmark_repack import synthetic_entities
+from benchmark_s3_upload import moto_server
+
+# Indexes a synthetic Jira export and restores random issues from it, through mmap of the local zip and with
+# ranged GETs from a local moto S3 server, against the way a single issue was restored before: reading the whole
+# entities.xml out of the zip, or downloading the whole zip first. Without --zip the export has --issues issues
+# with comments, and an attachment for every 100th issue.
+
+BUCKET = 'benchmark-archive-index'
+ATTACHMENT_SIZE = 200 * 1024
+
+
+def write_export(path, issues):
+    rng = random.Random(1)
+    text = synthetic_entities(rng, issues)
+    attachments = range(0, issues, 100)
+    rows = ''.join(f'    <FileAttachment id="{30000 + i}" issue="{10000 + i}" filename="file{i}.bin" '
+                   f'mimetype="application/octet-stream" filesize="{ATTACHMENT_SIZE}"/>\n' for i in attachments)
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('entities.xml', text.replace('</entity-engine-xml>', rows + '</entity-engine-xml>'))
+        for i in attachments:
+            zf.writestr(f'data/attachments/OPS/10000/OPS-{i + 1}/{30000 + i}', os.urandom(ATTACHMENT_SIZE))
+
+
+def full_read(path, item):
+    """Restore the way it was done without an index: inflate entities.xml until the issue is found"""
+    with zipfile.ZipFile(path) as zf, zf.open('entities.xml') as f:
+        tail = b''
+        needle = f'key="{item}"'.encode()
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            if needle in tail + block:
+                return True
+            tail = block[-len(needle):]
+    return False
+
+
+def restore_many(index, archive, items, folder):
+    start = time.perf_counter()
+    for item in items:
+        archive_index.restore(index, archive, item, folder)
+    return (time.perf_counter() - start) / len(items)
+
+
+def main():
+    parser = argparse.ArgumentParser('benchmark_archive_index')
+    parser.add_argument('--zip', help='Export zip to use instead of a synthetic one')
+    parser.add_argument('--issues', help='Issues of the synthetic export', type=int, default=200000)
+    parser.add_argument('--restores', help='Random issues to restore', type=int, default=20)
+    parser.add_argument('--spacing', help='Checkpoint spacing in MB of XML, comma separated', default='1,4,16')
+    parser.add_argument('--s3', help='Also restore from a local moto S3 server', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s', level=logging.WARNING)
+    with tempfile.TemporaryDirectory() as folder:
+        path = args.zip
+        if path is None:
+            path = os.path.join(folder, 'export.zip')
+            write_export(path, args.issues)
+        print(f'{os.path.getsize(path) // 1000000} MB zip, checkpoints '
+              f'{"through the zlib C library" if archive_index.checkpoints_available() else "not available"}')
+
+        index_path = os.path.join(folder, 'export' + archive_index.INDEX_SUFFIX)
+        print(f'{"spacing":>8} {"build s":>8} {"XML MB/s":>9} {"index MB":>9} {"restore ms":>11} {"read KB":>8}')
+        for spacing in [float(spacing) for spacing in args.spacing.split(',')]:
+            start = time.perf_counter()
+            stats = archive_index.build(path, index_path, int(spacing * 1024 * 1024))
+            seconds = time.perf_counter() - start
+            index = archive_index.Index(index_path)
+            keys = index.issue_keys()
+            items = random.Random(2).sample(keys, min(args.restores, len(keys)))
+            archive = archive_index.LocalArchive(path)
+            restore_seconds = restore_many(index, archive, items, os.path.join(folder, 'restored'))
+            print(f'{spacing:>8g} {seconds:>8.1f} {stats.xml_size / seconds / 1000000:>9.1f} '
+                  f'{os.path.getsize(index_path) / 1000000:>9.1f} {restore_seconds * 1000:>11.1f} '
+                  f'{archive.bytes_read / len(items) / 1000:>8.0f}')
+            archive.close()
+            index.close()
+
+        start = time.perf_counter()
+        for item in items[:3]:
+            full_read(path, item)
+        print(f'Without the index one issue takes {(time.perf_counter() - start) / 3 * 1000:.0f} ms to find in '
+              f'the local zip')
+
+        if args.s3:
+            for name in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY']:
+                os.environ.setdefault(name, 'benchmark')
+            os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+            with contextlib.ExitStack() as stack:
+                os.environ['AWS_ENDPOINT_URL'] = stack.enter_context(moto_server())
+                client = s3_operations.get_client()
+                client.create_bucket(Bucket=BUCKET)
+                client.upload_file(path, BUCKET, 'export.zip')
+                client.upload_file(index_path, BUCKET, 'export.zip' + archive_index.INDEX_SUFFIX)
+
+                start = time.perf_counter()
+                archive = archive_index.open_archive(f's3://{BUCKET}/export.zip')
+                archive.download_index(os.path.join(folder, 'downloaded' + archive_index.INDEX_SUFFIX))
+                index = archive_index.Index(os.path.join(folder, 'downloaded' + archive_index.INDEX_SUFFIX))
+                index_seconds = time.perf_counter() - start
+                restore_seconds = restore_many(index, archive, items, os.path.join(folder, 'restored'))
+                index.close()
+                start = time.perf_counter()
+                client.download_file(BUCKET, 'export.zip', os.path.join(folder, 'downloaded.zip'))
+                download_seconds = time.perf_counter() - start
+                print(f'From S3: index downloaded in {index_seconds * 1000:.0f} ms, then {restore_seconds * 1000:.1f} '
+                      f'ms and {archive.requests / len(items):.1f} ranged GETs per issue; downloading the whole zip '
+                      f'takes {download_seconds * 1000:.0f} ms')
+
+
+if __name__ == '__main__':
+    main()
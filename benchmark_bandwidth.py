@@ -0,0 +1,145 @@
+import argparse
+import threading
+import time
+import bandwidth
+
+# Runs worker threads that push chunks through a shared bandwidth.TokenBucket and reports the achieved rate
+# against the limit, next to a bucket that takes its lock for every chunk like the one the scripts used before.
+# The adaptive part sends through a simulated link with a queue: the latency grows with the queued bytes, and
+# the throttle has to find a rate that keeps the queue short.
+
+CHUNK_SIZE = 256 * 1024
+
+
+class LockedBucket(object):
+    """The previous TokenBucket, with the shared lock taken on every call"""
+
+    def __init__(self, rate, burst):
+        self._rate = float(rate)
+        self._capacity = float(burst)
+        self._tokens = self._capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __call__(self, bytes_amount):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._capacity, self._tokens + (now - self._last) * self._rate)
+            self._last = now
+            self._tokens -= bytes_amount
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+def run_workers(limiter, workers, seconds, chunk_size=CHUNK_SIZE, link=None):
+    """Call limiter with chunk_size from every worker for seconds and return the bytes and calls made"""
+    stop = time.monotonic() + seconds
+    counts = [[0, 0] for _ in range(workers)]
+
+    def work(count):
+        while time.monotonic() < stop:
+            limiter(chunk_size)
+            if link is not None:
+                link.send(chunk_size)
+            count[0] += chunk_size
+            count[1] += 1
+
+    threads = [threading.Thread(target=work, args=(count,)) for count in counts]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(count[0] for count in counts), sum(count[1] for count in counts)
+
+
+class SimulatedLink(object):
+    """A link of capacity bytes per second behind a queue. Sending blocks while the queue is full"""
+
+    def __init__(self, capacity, base_latency, queue_bytes):
+        self._capacity = capacity
+        self._base_latency = base_latency
+        self._queue_bytes = queue_bytes
+        self._queued = 0.0
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _drain(self):
+        now = time.monotonic()
+        self._queued = max(0.0, self._queued - (now - self._last) * self._capacity)
+        self._last = now
+
+    def send(self, amount):
+        while True:
+            with self._lock:
+                self._drain()
+                if self._queued + amount <= self._queue_bytes:
+                    self._queued += amount
+                    return
+                wait = (self._queued + amount - self._queue_bytes) / self._capacity
+            time.sleep(wait)
+
+    def latency(self):
+        with self._lock:
+            self._drain()
+            return self._base_latency + self._queued / self._capacity
+
+
+def main():
+    parser = argparse.ArgumentParser('benchmark_bandwidth')
+    parser.add_argument('--rate', help='Limit in MB/s', type=float, default=200)
+    parser.add_argument('--workers', help='Comma separated worker counts', default='1,4,16')
+    parser.add_argument('--seconds', help='Duration of each run', type=float, default=3)
+    parser.add_argument('--link', help='Capacity of the simulated link in MB/s', type=float, default=100)
+    args = parser.parse_args()
+    rate = args.rate * 1000000
+    # A small burst, so that the achieved rate of a short run is not dominated by it
+    burst = rate / 10
+
+    print(f'Limit {args.rate:.0f} MB/s, {CHUNK_SIZE // 1024} KB chunks')
+    print(f'{"bucket":>8} {"workers":>8} {"MB/s":>8} {"of limit":>9} {"calls/s":>10}')
+    for workers in [int(workers) for workers in args.workers.split(',')]:
+        for name, limiter in [('locked', LockedBucket(rate, burst)),
+                              ('leased', bandwidth.TokenBucket(rate, burst))]:
+            total, calls = run_workers(limiter, workers, args.seconds)
+            print(f'{name:>8} {workers:>8} {total / args.seconds / 1000000:>8.1f} '
+                  f'{total / args.seconds / rate:>9.1%} {calls / args.seconds:>10.0f}')
+
+    print('\nUnlimited bucket, calls per second of the hot path')
+    for workers in [int(workers) for workers in args.workers.split(',')]:
+        total, calls = run_workers(bandwidth.TokenBucket(None), workers, args.seconds / 3)
+        print(f'{workers:>8} workers {calls / (args.seconds / 3):>12.0f}')
+
+    print(f'\nAdaptive throttle over a simulated {args.link:.0f} MB/s link with 20 ms latency and a 64 MB queue')
+    link = SimulatedLink(args.link * 1000000, 0.02, 64 * 1000000)
+    throttle = bandwidth.AdaptiveThrottle()
+    limiter = bandwidth.TokenBucket(None, throttle=throttle)
+    stop = threading.Event()
+    # The trigger and progress requests see the idle link before the download starts
+    throttle.observe(link.latency())
+
+    def probe():
+        # Stands in for the latency of the requests that transport.TransportStats passes on
+        while not stop.wait(0.05):
+            throttle.observe(link.latency())
+
+    def show():
+        while not stop.wait(1):
+            limit = f'{limiter.rate / 1000000:.1f} MB/s' if limiter.rate else 'none'
+            print(f'  achieved {limiter.achieved_rate / 1000000:>7.1f} MB/s, '
+                  f'latency {link.latency() * 1000:>6.0f} ms, limit {limit}')
+
+    watchers = [threading.Thread(target=probe), threading.Thread(target=show)]
+    for watcher in watchers:
+        watcher.start()
+    run_workers(limiter, 4, args.seconds * 8, link=link)
+    stop.set()
+    for watcher in watchers:
+        watcher.join()
+    report = limiter.report()
+    print(f'  {report["achieved_bytes_per_second"] / 1000000:.1f} MB/s on average, '
+          f'workers waited {report["throttled_seconds"]:.1f} seconds for the limit')
+
+
+if __name__ == '__main__':
+    main()
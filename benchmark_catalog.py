@@ -0,0 +1,116 @@
+import argparse
+import contextlib
+import logging
+import os
+import random
+import tempfile
+import time
+import catalog
+import s3_operations
+from benchmark_s3_upload import moto_server
+
+# Fills a catalog with daily backups of many sites and times the queries the backup tools make: listing all
+# backups, the backups of one site in a period, the newest backup and planning a retention policy. With
+# --s3-objects the same number of objects is put into a local moto S3 server to compare the catalog with
+# listing the bucket, to time sync, and to compare batched deletes with one request per object.
+
+BUCKET = 'benchmark-catalog'
+DAY = 24 * 3600
+POLICY = {'daily': 7, 'weekly': 4, 'monthly': 12}
+
+
+def timed(function, repeat=1):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function()
+    return result, (time.perf_counter() - start) / repeat
+
+
+def fill(backups, sites, days, start):
+    rng = random.Random(1)
+    for site in range(sites):
+        for product in ['jira', 'confluence']:
+            for day in range(days):
+                created = start + day * DAY + rng.randint(0, 3600)
+                name = f'site{site}-{product}-export-{time.strftime("%Y%m%d_%H%M%S", time.localtime(created))}.zip'
+                backups.record(f'site{site}', product, created, name, rng.randint(10 ** 8, 10 ** 10),
+                               f'{rng.getrandbits(256):064x}', None, BUCKET, name)
+
+
+def compare_s3(count):
+    client = s3_operations.get_client()
+    client.create_bucket(Bucket=BUCKET)
+    start = time.time() - count * DAY
+    keys = []
+    for number in range(count):
+        created = start + number * DAY
+        key = f'site{number % 10}-jira-export-{time.strftime("%Y%m%d_%H%M%S", time.localtime(created))}.zip'
+        client.put_object(Bucket=BUCKET, Key=key, Body=b'',
+                          Metadata=catalog.object_metadata(f'site{number % 10}', 'jira', created))
+        keys.append(key)
+
+    def crawl():
+        return sum(len(page.get('Contents', []))
+                   for page in client.get_paginator('list_objects_v2').paginate(Bucket=BUCKET))
+
+    listed, crawl_seconds = timed(crawl)
+    with tempfile.TemporaryDirectory() as folder:
+        backups = catalog.Catalog(os.path.join(folder, catalog.CATALOG_FILE))
+        (added, _), sync_seconds = timed(lambda: catalog.sync(backups, BUCKET))
+        found, find_seconds = timed(lambda: backups.find(), 10)
+        backups.close()
+    print(f'{listed} objects listed from S3 in {crawl_seconds * 1000:.0f} ms, '
+          f'the catalog lists {len(found)} in {find_seconds * 1000:.1f} ms')
+    print(f'sync added {added} backups in {sync_seconds:.1f} s, once, reading the metadata of every new object')
+
+    half = len(keys) // 2
+    _, batched_seconds = timed(lambda: s3_operations.delete_objects(BUCKET, keys[:half]))
+    _, single_seconds = timed(lambda: [client.delete_object(Bucket=BUCKET, Key=key) for key in keys[half:]])
+    print(f'Deleting {half} objects: {batched_seconds * 1000:.0f} ms in batches, '
+          f'{single_seconds * 1000:.0f} ms one by one')
+
+
+def main():
+    parser = argparse.ArgumentParser('benchmark_catalog')
+    parser.add_argument('--sites', type=int, default=50)
+    parser.add_argument('--days', help='Daily backups per site and product', type=int, default=100)
+    parser.add_argument('--s3-objects', help='Objects to put into a local moto S3 server, 0 to skip', type=int,
+                        default=2000)
+    parser.add_argument('--endpoint-url', help='S3 compatible server to use instead of a local moto server')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s', level=logging.WARNING)
+    with tempfile.TemporaryDirectory() as folder:
+        backups = catalog.Catalog(os.path.join(folder, catalog.CATALOG_FILE))
+        start = time.time() - args.days * DAY
+        _, fill_seconds = timed(lambda: fill(backups, args.sites, args.days, start))
+        total = args.sites * 2 * args.days
+        print(f'{total} backups recorded in {fill_seconds:.1f} s')
+
+        found, seconds = timed(lambda: backups.find(), 10)
+        print(f'{"all backups":>36} {len(found):>6} rows {seconds * 1000:>9.2f} ms')
+        rng = random.Random(2)
+
+        def one_week():
+            day = start + rng.randint(0, args.days - 7) * DAY
+            return backups.find(f'site{rng.randrange(args.sites)}', 'jira', day, day + 7 * DAY)
+
+        found, seconds = timed(one_week, 1000)
+        print(f'{"one site, product and week":>36} {len(found):>6} rows {seconds * 1000:>9.3f} ms')
+        found, seconds = timed(lambda: backups.latest(f'site{rng.randrange(args.sites)}', 'confluence'), 1000)
+        print(f'{"newest backup of a site":>36} {1:>6} rows {seconds * 1000:>9.3f} ms')
+        pruned, seconds = timed(lambda: catalog.prune(backups, POLICY, dry_run=True))
+        print(f'{"retention plan of all sites":>36} {len(pruned):>6} rows {seconds * 1000:>9.2f} ms to prune')
+        backups.close()
+
+    if args.s3_objects:
+        for name in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY']:
+            os.environ.setdefault(name, 'benchmark')
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        with contextlib.ExitStack() as stack:
+            os.environ['AWS_ENDPOINT_URL'] = args.endpoint_url or stack.enter_context(moto_server())
+            compare_s3(args.s3_objects)
+
+
+if __name__ == '__main__':
+    main()
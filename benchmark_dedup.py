@@ -0,0 +1,85 @@
+import argparse
+import logging
+import os
+import random
+import tempfile
+import time
+import zipfile
+import dedup_store
+
+# Ingests a series of synthetic exports into a local chunk store. Every day a small share of the entities
+# changes, a few entities and attachments are added, and everything else stays the same, like in a real
+# Jira or Confluence site.
+
+WORDS = ['issue', 'page', 'comment', 'sprint', 'status', 'done', 'review', 'release', 'backlog', 'epic',
+         'customer', 'priority', 'assignee', 'reporter', 'label', 'version', 'component', 'summary']
+
+
+def entity(rng, entity_id, revision):
+    text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(20, 80)))
+    return f'<Issue id="{entity_id}" revision="{revision}" summary="{text}"/>\n'
+
+
+class SyntheticSite(object):
+
+    def __init__(self, entities, attachments, attachment_size, seed=1):
+        self._rng = random.Random(seed)
+        self._entities = [entity(self._rng, i, 0) for i in range(entities)]
+        self._attachments = [os.urandom(attachment_size) for _ in range(attachments)]
+        self._attachment_size = attachment_size
+
+    def next_day(self, change_ratio):
+        for _ in range(int(len(self._entities) * change_ratio)):
+            i = self._rng.randrange(len(self._entities))
+            self._entities[i] = entity(self._rng, i, self._rng.randint(1, 1000))
+        for _ in range(int(len(self._entities) * change_ratio / 2)):
+            self._entities.append(entity(self._rng, len(self._entities), 0))
+        self._attachments.append(os.urandom(self._attachment_size))
+
+    def write_export(self, path):
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr('entities.xml', '<entity-engine-xml>\n' + ''.join(self._entities) + '</entity-engine-xml>\n')
+            for i, data in enumerate(self._attachments):
+                zf.writestr(f'data/attachments/{i}', data)
+
+
+def main():
+    parser = argparse.ArgumentParser('benchmark_dedup')
+    parser.add_argument('--days', type=int, default=5)
+    parser.add_argument('--entities', type=int, default=50000)
+    parser.add_argument('--attachments', type=int, default=20)
+    parser.add_argument('--attachment-size', help='Size of each attachment in MB', type=int, default=2)
+    parser.add_argument('--change-ratio', help='Share of entities changed per day', type=float, default=0.01)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s', level=logging.WARNING)
+    site = SyntheticSite(args.entities, args.attachments, args.attachment_size * 1000000)
+
+    with tempfile.TemporaryDirectory() as folder:
+        store = dedup_store.open_store(os.path.join(folder, 'store'))
+        ingested = 0
+        stored = 0
+        print(f'{"day":>4} {"zip MB":>8} {"new MB":>8} {"MB/s":>8} {"dedup ratio":>12} identical')
+        for day in range(args.days):
+            if day:
+                site.next_day(args.change_ratio)
+            path = os.path.join(folder, f'export-{day}.zip')
+            site.write_export(path)
+            size = os.path.getsize(path)
+
+            start = time.perf_counter()
+            stats = dedup_store.ingest(path, store)
+            elapsed = time.perf_counter() - start
+            ingested += size
+            stored += stats.stored_bytes
+
+            restored = os.path.join(folder, 'restored.zip')
+            identical = dedup_store.restore(store, os.path.basename(path), restored)
+            print(f'{day:>4} {size / 1000000:>8.1f} {stats.stored_bytes / 1000000:>8.2f} '
+                  f'{size / 1000000 / elapsed:>8.1f} {ingested / stored:>12.2f} {identical}')
+            os.remove(restored)
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import argparse
+import hashlib
+import logging
+import os
+import tempfile
+import time
+import downloader
+import local_server
+import transport
+
+# Downloads a generated file from the local stand-in server with different worker counts and checks
+# that every result is byte-identical to the source file
+
+
+def sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def create_file(path, size):
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            block = os.urandom(min(remaining, 1024 * 1024))
+            f.write(block)
+            remaining -= len(block)
+
+
+def run(url, target, workers, segment_size):
+    session = transport.create_session(max(workers, 1))
+    start = time.perf_counter()
+    downloader.download(session, url, target, workers, segment_size)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser('benchmark_download')
+    parser.add_argument('--size', help='Size of the generated file in MB', type=int, default=256)
+    parser.add_argument('--workers', help='Comma separated worker counts to compare', default='1,2,4,8')
+    parser.add_argument('--segment-size', help='Segment size in MB', type=int, default=16)
+    parser.add_argument('--stream-rate', help='Per-connection limit of the server in MB/s', type=float, default=50)
+    parser.add_argument('--no-ranges', help='Let the server ignore Range requests', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s', level=logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as folder:
+        source = os.path.join(folder, 'source.zip')
+        create_file(source, args.size * 1000000)
+        expected = sha256(source)
+
+        stream_rate = args.stream_rate * 1000000 if args.stream_rate else None
+        server, url = local_server.serve(source, accept_ranges=not args.no_ranges, stream_rate=stream_rate)
+        try:
+            print(f'{"workers":>8} {"seconds":>9} {"MB/s":>9}  identical')
+            for workers in [int(w) for w in args.workers.split(',')]:
+                target = os.path.join(folder, f'target-{workers}.zip')
+                elapsed = run(url, target, workers, args.segment_size * 1024 * 1024)
+                identical = sha256(target) == expected
+                print(f'\r{workers:>8} {elapsed:>9.2f} {args.size / elapsed:>9.1f}  {identical}')
+                os.remove(target)
+        finally:
+            server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+import local_server
+
+# Runs whole backups of many simulated sites at once: jira_backup.py and confluence_backup.py are started as
+# separate processes for every site, each against its own site of a local_server.serve_atlassian server, from the
+# trigger through the progress checks to the verified download. The server can answer with errors and throttling
+# and cut off downloads, so the retries and the resumed downloads are part of the measurement. With more than one
+# round all sites are backed up again, as a soak test. Every round starts from empty folders unless --reuse-state
+# keeps them, then the later rounds find the export state of the first one and skip the export and the download.
+#
+# Reported per round: the wall time of the round and the end-to-end time of each backup, the download throughput
+# of all backups together, the peak memory and the CPU time of the backup processes (from os.wait4, so Linux and
+# macOS only) and the responses of the server.
+
+SCRIPTS = {'jira': 'jira_backup.py', 'confluence': 'confluence_backup.py'}
+REPO = os.path.dirname(os.path.abspath(__file__))
+
+
+def create_export(path, size):
+    """A valid export zip of about size bytes, incompressible so the download moves the whole size"""
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as zf:
+        zf.writestr('entities.xml', '<?xml version="1.0" encoding="UTF-8"?>\n<entity-engine-xml>\n'
+                                    '</entity-engine-xml>\n')
+        with zf.open('data/attachments/BENCH/10000/BENCH-1/10000', 'w') as f:
+            remaining = size
+            while remaining > 0:
+                block = os.urandom(min(remaining, 1024 * 1024))
+                f.write(block)
+                remaining -= len(block)
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))] if values else 0
+
+
+def max_rss_bytes(ru_maxrss):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return ru_maxrss if sys.platform == 'darwin' else ru_maxrss * 1024
+
+
+def start_backup(url, site, product, folder, metrics_dir, args):
+    """Start one backup process in its own folder, which also holds its log, URL file and export state"""
+    os.makedirs(folder, exist_ok=True)
+    base_url = f'{url}/{site}' + ('/wiki' if product == 'confluence' else '')
+    command = [sys.executable, os.path.join(REPO, SCRIPTS[product]), '-s', site, '-u', 'bench@example.com',
+               '-t', 'token', '-f', folder, '--base-url', base_url, '--metrics-dir', metrics_dir,
+               '-w', str(args.workers)]
+    return subprocess.Popen(command, cwd=folder, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def run_round(url, round_folder, sites_folder, args):
+    metrics_dir = os.path.join(round_folder, 'metrics')
+    started = {}
+    round_start = time.perf_counter()
+    for i in range(args.sites):
+        for product in args.products.split(','):
+            site = f'site{i}'
+            process = start_backup(url, site, product, os.path.join(sites_folder, site, product), metrics_dir, args)
+            started[process.pid] = (site, product, time.perf_counter())
+
+    runs = []
+    while started:
+        pid, status, usage = os.wait4(-1, 0)
+        if pid not in started:
+            continue
+        site, product, start = started.pop(pid)
+        runs.append({'site': site, 'product': product, 'seconds': time.perf_counter() - start,
+                     'exit_code': os.waitstatus_to_exitcode(status), 'max_rss': max_rss_bytes(usage.ru_maxrss),
+                     'cpu_seconds': usage.ru_utime + usage.ru_stime})
+    round_seconds = time.perf_counter() - round_start
+
+    reports = []
+    for path in glob.glob(os.path.join(metrics_dir, '*.json')):
+        with open(path, 'r', encoding='UTF-8') as f:
+            reports.append(json.load(f))
+    return round_seconds, runs, reports
+
+
+def print_round(number, round_seconds, runs, reports, server_counts):
+    seconds = [run['seconds'] for run in runs]
+    downloaded = sum(report['counters'].get('download_bytes', 0) for report in reports)
+    successful = sum(1 for report in reports if report['values'].get('success'))
+    failed = sum(1 for run in runs if run['exit_code'] != 0)
+    download_rates = [report['bytes_per_second']['download'] for report in reports
+                      if 'download' in report['bytes_per_second']]
+    export_wait = [report['phase_seconds'].get('export_wait', 0) for report in reports]
+    print(f'{number:>5} {len(runs):>5} {successful:>7} {failed:>6} {round_seconds:>8.1f} '
+          f'{percentile(seconds, 0.5):>7.1f} {percentile(seconds, 0.95):>7.1f} '
+          f'{percentile(export_wait, 0.5):>7.1f} {downloaded / round_seconds / 1000000:>9.1f} '
+          f'{percentile(download_rates, 0.5) / 1000000:>9.1f} {max(run["max_rss"] for run in runs) / 1000000:>7.0f} '
+          f'{sum(run["cpu_seconds"] for run in runs):>7.1f}')
+    if server_counts:
+        print('      server: ' + ', '.join(f'{endpoint} {status}: {count}'
+                                           for (endpoint, status), count in sorted(server_counts.items(),
+                                                                                   key=lambda item: str(item[0]))))
+
+
+def main():
+    parser = argparse.ArgumentParser('benchmark_end_to_end')
+    parser.add_argument('--sites', help='Simulated sites backed up at the same time', type=int, default=8)
+    parser.add_argument('--products', help='Comma separated products backed up for every site',
+                        default='jira,confluence')
+    parser.add_argument('--rounds', help='Back up all sites this many times, for a soak test', type=int, default=1)
+    parser.add_argument('--file-size', help='Size of the backup file in MB', type=int, default=64)
+    parser.add_argument('--export-seconds', help='Duration of an export', type=float, default=10)
+    parser.add_argument('--workers', help='Download connections of every backup', type=int, default=4)
+    parser.add_argument('--stream-rate', help='Per-connection limit of the server in MB/s', type=float)
+    parser.add_argument('--no-ranges', help='Let the server ignore Range requests', action='store_true')
+    parser.add_argument('--error-rate', help='Share of the GET requests answered with 503', type=float, default=0)
+    parser.add_argument('--throttle-rate', help='Share of the progress checks answered with 429', type=float,
+                        default=0)
+    parser.add_argument('--drop-rate', help='Share of the downloads cut off part way', type=float, default=0)
+    parser.add_argument('--reuse-state', help='Keep the site folders with their export state across the rounds',
+                        action='store_true')
+    parser.add_argument('--keep', help='Keep the downloaded files, logs and reports of the rounds in this folder')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s', level=logging.WARNING)
+    with tempfile.TemporaryDirectory() as folder:
+        source = os.path.join(folder, 'export.zip')
+        create_export(source, args.file_size * 1000000)
+        work = args.keep or os.path.join(folder, 'rounds')
+
+        stream_rate = args.stream_rate * 1000000 if args.stream_rate else None
+        server, url = local_server.serve_atlassian(source, export_seconds=args.export_seconds,
+                                                   accept_ranges=not args.no_ranges, stream_rate=stream_rate,
+                                                   error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+                                                   drop_rate=args.drop_rate, seed=1)
+        print(f'{args.sites} sites x {args.products}, {args.file_size} MB backup files, exports take '
+              f'{args.export_seconds:g} s')
+        print(f'{"round":>5} {"runs":>5} {"success":>7} {"failed":>6} {"wall s":>8} {"p50 s":>7} {"p95 s":>7} '
+              f'{"wait s":>7} {"all MB/s":>9} {"run MB/s":>9} {"RSS MB":>7} {"CPU s":>7}')
+        try:
+            for number in range(1, args.rounds + 1):
+                round_folder = os.path.join(work, f'round{number}')
+                sites_folder = os.path.join(work, 'sites') if args.reuse_state else round_folder
+                with server.lock:
+                    server.counts = {}
+                round_seconds, runs, reports = run_round(url, round_folder, sites_folder, args)
+                print_round(number, round_seconds, runs, reports, dict(server.counts))
+                if not args.keep:
+                    # Many rounds of many sites would fill the disk otherwise
+                    shutil.rmtree(round_folder, ignore_errors=True)
+        finally:
+            server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import tempfile
+import export_state
+import jira_backup
+import polling
+from benchmark_polling import VirtualClock
+
+# Runs jira_backup against a simulated Atlassian site on a virtual clock, once with and once without the
+# export state, and counts the requests, refused exports and downloads of a run schedule. Runs crash while they
+# wait for the export with the given probability. The site allows one export every 24 hours and an export
+# takes --export-hours. Runs start every --interval hours plus up to --jitter minutes, like cron jobs on a busy
+# host; the last variant starts the runs with the export state at the time export_state.py --next prints.
+
+HOUR = 3600
+
+
+class Crash(Exception):
+    pass
+
+
+class Response(object):
+
+    def __init__(self, status_code, text=''):
+        self.status_code = status_code
+        self.text = text
+        self.headers = {}
+
+    def __str__(self):
+        return f'<Response [{self.status_code}]>'
+
+
+class SimulatedSite(object):
+
+    def __init__(self, clock, export_seconds):
+        self._clock = clock
+        self._export_seconds = export_seconds
+        self.exports = []
+        self.requests = 0
+        self.refused = 0
+
+    def post(self, url, data=None):
+        self.requests += 1
+        if self.exports and self._clock() - self.exports[-1] < export_state.COOLDOWN:
+            self.refused += 1
+            return Response(406, 'Backup frequency is limited')
+        self.exports.append(self._clock())
+        return Response(200)
+
+    def get(self, url, **kwargs):
+        self.requests += 1
+        if url.endswith('lastTaskId'):
+            return Response(200, str(len(self.exports)))
+        task = int(url.rsplit('=', 1)[1])
+        elapsed = self._clock() - self.exports[task - 1]
+        progress = min(100, int(elapsed * 100 / self._export_seconds))
+        return Response(200, json.dumps({'progress': progress, 'message': 'Exporting', 'status': 'InProgress',
+                                         'result': f'export/download/?fileId={task}' if progress == 100 else None}))
+
+
+def simulate(with_state, args, timer=False):
+    clock = VirtualClock()
+    rng = random.Random(1)
+    site = SimulatedSite(clock, args.export_hours * HOUR)
+    downloads = []
+    delays = []
+    folder = tempfile.mkdtemp()
+    url_file = os.path.join(folder, 'url.txt')
+    state_path = os.path.join(folder, export_state.state_file('site', 'jira'))
+    end = args.days * 24 * HOUR
+    while clock.now < end:
+        crash_at = clock.now + rng.uniform(0, args.export_hours * HOUR) if rng.random() < args.crashes else None
+
+        def sleep(seconds):
+            clock.sleep(seconds)
+            if crash_at is not None and clock.now >= crash_at:
+                raise Crash()
+
+        poller = polling.Poller(clock=clock, sleep=sleep)
+        state = export_state.ExportState.load(state_path, clock) if with_state else None
+        if state is not None:
+            state.acquire()
+        exports = len(site.exports)
+        try:
+            file_url = jira_backup.jira_backup('site', False, site, url_file, poller, state=state)
+        except Crash:
+            file_url = None
+        if len(site.exports) > exports and exports:
+            # How long after the end of the cooldown the export was triggered
+            delays.append(site.exports[-1] - site.exports[-2] - export_state.COOLDOWN)
+        if file_url is not None and (state is None or not state.is_downloaded(file_url)):
+            downloads.append(file_url)
+            if state is not None:
+                state.downloaded(file_url)
+        if state is not None:
+            state.release()
+
+        # The next start of the schedule after the end of this run
+        next_run = (math.floor(clock.now / (args.interval * HOUR)) + 1) * args.interval * HOUR
+        next_run += rng.uniform(0, args.jitter * 60)
+        if timer:
+            next_run = state.next_run_at()
+        clock.now = max(next_run, clock.now + 60)
+    return site, downloads, delays
+
+
+def main():
+    parser = argparse.ArgumentParser('benchmark_export_state')
+    parser.add_argument('--days', type=int, default=14)
+    parser.add_argument('--interval', help='Hours between two runs', type=float, default=1)
+    parser.add_argument('--export-hours', help='Duration of an export', type=float, default=2)
+    parser.add_argument('--jitter', help='Minutes a run may start late', type=float, default=5)
+    parser.add_argument('--crashes', help='Probability that a run crashes', type=float, default=0.1)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+    print(f'{args.days} days, a run every {args.interval:g} hours, {args.crashes:.0%} of the runs crash')
+    print(f'{"":>22} {"requests":>9} {"refused":>8} {"exports":>8} {"downloads":>10} {"unique":>7} '
+          f'{"delay h":>8}')
+    for name, with_state, timer in [('without state', False, False), ('with state', True, False),
+                                    ('with state and timer', True, True)]:
+        site, downloads, delays = simulate(with_state, args, timer)
+        delay = sum(delays) / len(delays) / HOUR if delays else 0
+        print(f'{name:>22} {site.requests:>9} {site.refused:>8} {len(site.exports):>8} {len(downloads):>10} '
+              f'{len(set(downloads)):>7} {delay:>8.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+import argparse
+import logging
+import os
+import tempfile
+import time
+import confluence_incremental
+import dedup_store
+import incremental
+import jira_incremental
+import local_server
+import operations
+
+# Replays recorded REST responses of consecutive runs from fixtures/ through the local stand-in server and
+# runs the incremental backups against them. For every run it prints how many items were fetched and how many
+# bytes were transferred and stored, and checks that the index of the last run can be read back in full.
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+# The Jira runs were recorded an hour apart starting at this time. The search window is relative to the
+# current time, so the replay has to use the same clock to send the recorded queries
+JIRA_RECORDED_AT = 1792234800.0
+JIRA_RECORDING_INTERVAL = 3600
+
+
+def print_header():
+    print(f'{"run":>20} {"seconds":>8} {"requests":>8} {"fetched":>8} {"KB in":>8} {"KB stored":>9}')
+
+
+def print_run(recording, elapsed, session, backup, successful):
+    requests = session.transport_stats.totals()['requests']
+    print(f'{os.path.basename(recording):>20} {elapsed:>8.2f} {requests:>8} {backup.totals.items:>8} '
+          f'{backup.totals.total_bytes / 1000:>8.1f} {backup.totals.stored_bytes / 1000:>9.1f}'
+          f'{"" if successful else "  FAILED"}')
+
+
+def replay_confluence(days, workers, parallel_pages):
+    server, url = local_server.serve_recorded(days[0])
+    with tempfile.TemporaryDirectory() as folder:
+        store = dedup_store.open_store(os.path.join(folder, 'store'))
+        index = incremental.Index.load(confluence_incremental.index_file(folder, 'acme'))
+        try:
+            print_header()
+            for day in days:
+                server.responses = local_server.load_recording(day)
+                session = operations.get_session('user', 'token', workers + parallel_pages)
+                backup = confluence_incremental.ConfluenceIncremental(url + '/wiki', session, store, index, workers,
+                                                                      parallel_pages)
+                start = time.perf_counter()
+                successful = backup.run()
+                elapsed = time.perf_counter() - start
+                index.save()
+                print_run(day, elapsed, session, backup, successful)
+
+            # Every item of the index must be complete in the store
+            items = 0
+            for section in ['content', 'attachments']:
+                for entry in index.entries(section).values():
+                    incremental.read_item(store, entry['chunks'])
+                    items += 1
+            print(f'{items} items of the last day read back from the store')
+        finally:
+            server.shutdown()
+
+
+def replay_jira(runs, workers):
+    server, url = local_server.serve_recorded(runs[0])
+    with tempfile.TemporaryDirectory() as folder:
+        store = dedup_store.open_store(os.path.join(folder, 'store'))
+        index = jira_incremental.JiraIndex(jira_incremental.index_file(folder, 'acme'))
+        try:
+            print_header()
+            for number, run in enumerate(runs):
+                server.responses = local_server.load_recording(run)
+                session = operations.get_session('user', 'token', 2 * workers)
+                now = JIRA_RECORDED_AT + number * JIRA_RECORDING_INTERVAL
+                backup = jira_incremental.JiraIncremental(url, session, store, index, workers,
+                                                          clock=lambda now=now: now)
+                start = time.perf_counter()
+                successful = backup.run()
+                print_run(run, time.perf_counter() - start, session, backup, successful)
+
+            items = 0
+            for kind, item_id, chunks in index.items():
+                incremental.read_item(store, chunks)
+                items += 1
+            print(f'{items} items of the last run read back from the store')
+        finally:
+            index.close()
+            server.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser('benchmark_incremental')
+    parser.add_argument('--workers', help='Items fetched in parallel', type=int,
+                        default=incremental.DEFAULT_WORKERS)
+    parser.add_argument('--parallel-pages', help='Listing pages fetched in parallel', type=int,
+                        default=incremental.DEFAULT_PARALLEL_PAGES)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s', level=logging.WARNING)
+    folder = os.path.join(FIXTURES, 'confluence_rest')
+    print('Confluence')
+    replay_confluence([os.path.join(folder, name) for name in sorted(os.listdir(folder))], args.workers,
+                      args.parallel_pages)
+    folder = os.path.join(FIXTURES, 'jira_rest')
+    print('Jira')
+    replay_jira([os.path.join(folder, name) for name in sorted(os.listdir(folder))], args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+import argparse
+import random
+import polling
+
+# Compares progress check policies against a simulated export on a virtual clock: the number of progress
+# requests and how long after the end of the export it is noticed
+
+
+class VirtualClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class SimulatedExport(object):
+    """Progress that moves at an uneven speed and reaches 100% after duration seconds"""
+
+    def __init__(self, duration, step, seed):
+        rng = random.Random(seed)
+        weights = [rng.uniform(0.3, 1.7) for _ in range(100)]
+        total = sum(weights)
+        # Time at which each percent is reached
+        self._milestones = []
+        elapsed = 0
+        for weight in weights:
+            elapsed += duration * weight / total
+            self._milestones.append(elapsed)
+        self._step = step
+        self.duration = duration
+
+    def progress(self, now):
+        done = sum(1 for milestone in self._milestones if milestone <= now)
+        # The server reports progress in coarse steps, except for the final 100%
+        return done if done == 100 else done - done % self._step
+
+
+def ladder_policy(export, clock):
+    """The former Jira loop: 10 seconds, slowing to 20, 30 and 60 seconds while the progress stands still"""
+    requests = 0
+    last_progress = -1
+    counter = 0
+    sleep_timer = 10
+    while True:
+        requests += 1
+        progress = export.progress(clock())
+        if progress >= 100:
+            return requests
+        if progress != last_progress:
+            last_progress = progress
+            counter = 0
+            sleep_timer = 10
+        counter += 1
+        if counter == 3:
+            sleep_timer = 20
+        elif counter == 4:
+            sleep_timer = 30
+        elif counter == 6:
+            sleep_timer = 60
+        clock.sleep(sleep_timer)
+
+
+def fixed_policy(export, clock):
+    """The former Confluence loop: every 10 seconds"""
+    requests = 0
+    while True:
+        requests += 1
+        if export.progress(clock()) >= 100:
+            return requests
+        clock.sleep(10)
+
+
+def adaptive_policy(export, clock):
+    poller = polling.Poller(clock=clock, sleep=clock.sleep, max_wait=None)
+    while True:
+        progress = export.progress(clock())
+        poller.observe(progress)
+        if progress >= 100:
+            return poller.polls
+        poller.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser('benchmark_polling')
+    parser.add_argument('--durations', help='Comma separated export durations in minutes', default='1,10,60,240')
+    parser.add_argument('--step', help='Granularity of the reported progress in percent', type=int, default=5)
+    parser.add_argument('--runs', help='Simulated exports per duration', type=int, default=20)
+    args = parser.parse_args()
+
+    policies = [('ladder', ladder_policy), ('fixed 10s', fixed_policy), ('adaptive', adaptive_policy)]
+    print(f'{"minutes":>8} {"policy":>10} {"requests":>9} {"latency s":>10}')
+    for minutes in [float(m) for m in args.durations.split(',')]:
+        for name, policy in policies:
+            requests = 0
+            latency = 0
+            for seed in range(args.runs):
+                export = SimulatedExport(minutes * 60, args.step, seed)
+                clock = VirtualClock()
+                requests += policy(export, clock)
+                latency += clock() - export.duration
+            print(f'{minutes:>8g} {name:>10} {requests / args.runs:>9.1f} {latency / args.runs:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+import argparse
+import glob
+import os
+import re
+import timeit
+import progress_models
+
+# Compares decoding the recorded progress responses in fixtures/ with the models against the regular
+# expressions the scripts used before, and prints what the models made of every response
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def jira_regex(text):
+    progress = re.search('(?<=progress":)(.*?)(?=,)', text)
+    message = re.search('(?<=message":)(.*?)(?=,)', text)
+    result = re.search('(?<=result":")(.*?)(?=",)', text)
+    return progress, message, result, 'error' in text
+
+
+def confluence_regex(text):
+    file_name = re.search('(?<=fileName":")(.*?)(?=")', text)
+    estimated = re.search('(?<=Estimated progress: )(.*?)(?=")', text)
+    status = re.search('(?<=currentStatus":")(.*?)(?=")', text)
+    if estimated is not None:
+        estimated = re.search('(?<=Estimated progress: )(.*?)(?=")', text)
+    else:
+        estimated = re.search('(?<=alternativePercentage":")(.*?)(?=")', text)
+    return file_name, status, estimated, 'error' in text
+
+
+def load(product):
+    fixtures = {}
+    for path in sorted(glob.glob(os.path.join(FIXTURES, product, '*'))):
+        with open(path, 'r', encoding='UTF-8') as f:
+            fixtures[os.path.basename(path)] = f.read()
+    return fixtures
+
+
+def main():
+    parser = argparse.ArgumentParser('benchmark_progress')
+    parser.add_argument('-n', '--number', help='Decodes per fixture', type=int, default=20000)
+    args = parser.parse_args()
+
+    products = [('jira', jira_regex, progress_models.JiraProgress.parse,
+                 lambda p: f'progress={p.progress} result={p.result} error={p.has_error}'),
+                ('confluence', confluence_regex, progress_models.ConfluenceProgress.parse,
+                 lambda p: f'percentage={p.percentage} file={p.file_name} error={p.has_error}')]
+
+    print(f'{"fixture":>32} {"regex us":>9} {"model us":>9}  decoded')
+    for product, regex, parse, describe in products:
+        for name, text in load(product).items():
+            regex_time = timeit.timeit(lambda: regex(text), number=args.number) / args.number * 1e6
+            model_time = timeit.timeit(lambda: parse(text), number=args.number) / args.number * 1e6
+            print(f'{product + "/" + name:>32} {regex_time:>9.2f} {model_time:>9.2f}  {describe(parse(text))}')
+
+
+if __name__ == '__main__':
+    main()
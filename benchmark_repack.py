@@ -0,0 +1,92 @@
+import argparse
+import logging
+import os
+import random
+import tempfile
+import time
+import zipfile
+import repack
+from benchmark_dedup import WORDS
+
+# Packs an export zip with zstd at different levels and thread counts and reports the size against the
+# original zip and the throughput, then checks that unpacking gives back the identical zip. Without --zip a
+# synthetic export is generated; its entities.xml mimics the repetitive attribute structure of a real one.
+# zstd only uses more than one thread for inputs of a few MB per thread, so use a large export to see it scale.
+
+STATUSES = ['10000', '10001', '10002', '3', '6']
+USERS = [f'5b10ac8d82e05b22cc7d{n:04x}' for n in range(40)]
+
+
+def synthetic_entities(rng, count):
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>\n<entity-engine-xml>\n']
+    for i in range(count):
+        created = f'2026-{rng.randint(1, 9):02d}-{rng.randint(1, 28):02d} {rng.randint(0, 23):02d}:' \
+                  f'{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d}.0'
+        lines.append(f'    <Issue id="{10000 + i}" key="OPS-{i + 1}" project="10000" number="{i + 1}" '
+                     f'reporter="{rng.choice(USERS)}" assignee="{rng.choice(USERS)}" creator="{rng.choice(USERS)}" '
+                     f'type="{rng.choice(STATUSES)}" priority="{rng.randint(1, 5)}" status="{rng.choice(STATUSES)}" '
+                     f'created="{created}" updated="{created}" votes="0" watches="{rng.randint(0, 9)}" '
+                     f'workflowId="{20000 + i}">\n'
+                     f'        <summary><![CDATA[{" ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 12)))}]]>'
+                     f'</summary>\n    </Issue>\n')
+        for c in range(rng.randint(0, 3)):
+            lines.append(f'    <Action id="{(10000 + i) * 10 + c}" issue="{10000 + i}" author="{rng.choice(USERS)}" '
+                         f'type="comment" created="{created}" updated="{created}">\n'
+                         f'        <body><![CDATA[{" ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 40)))}'
+                         f']]></body>\n    </Action>\n')
+    lines.append('</entity-engine-xml>\n')
+    return ''.join(lines)
+
+
+def write_export(path, entities, attachments, attachment_size):
+    rng = random.Random(1)
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('entities.xml', synthetic_entities(rng, entities))
+        zf.writestr('activeobjects.xml', synthetic_entities(rng, entities // 10))
+        for i in range(attachments):
+            zf.writestr(f'data/attachments/OPS/10000/{i}', os.urandom(attachment_size))
+
+
+def main():
+    parser = argparse.ArgumentParser('benchmark_repack')
+    parser.add_argument('--zip', help='Export zip to pack instead of a synthetic one')
+    parser.add_argument('--entities', help='Issues in the synthetic export', type=int, default=200000)
+    parser.add_argument('--attachments', type=int, default=10)
+    parser.add_argument('--attachment-size', help='Size of each attachment in MB', type=int, default=2)
+    parser.add_argument('--levels', help='Comma separated zstd levels', default=f'3,{repack.DEFAULT_LEVEL},19')
+    parser.add_argument('--threads', help='Comma separated zstd thread counts, 0 compresses in the calling thread',
+                        default=','.join(str(n) for n in sorted({0, 2, 4, os.cpu_count() or 1})))
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s', level=logging.WARNING)
+    if not repack.available():
+        parser.error('The benchmark needs the zstandard package, pip install zstandard')
+
+    with tempfile.TemporaryDirectory() as folder:
+        source = args.zip
+        if source is None:
+            source = os.path.join(folder, 'export.zip')
+            write_export(source, args.entities, args.attachments, args.attachment_size * 1000000)
+        size = os.path.getsize(source)
+        text_size = sum(info.file_size for info in zipfile.ZipFile(source).infolist() if info.filename.endswith('.xml'))
+        print(f'{os.path.basename(source)}: {size / 1000000:.1f} MB zip, {text_size / 1000000:.1f} MB of XML, '
+              f'{os.cpu_count()} cores')
+
+        print(f'{"level":>6} {"threads":>8} {"pack MB":>8} {"ratio":>6} {"MB/s":>8} {"unpack MB/s":>12} identical')
+        target = os.path.join(folder, 'export.zpk')
+        restored = os.path.join(folder, 'restored.zip')
+        for level in [int(level) for level in args.levels.split(',')]:
+            for threads in [int(threads) for threads in args.threads.split(',')]:
+                start = time.perf_counter()
+                stats = repack.pack(source, target, level, threads)
+                pack_seconds = time.perf_counter() - start
+                start = time.perf_counter()
+                identical = repack.unpack(target, restored)
+                unpack_seconds = time.perf_counter() - start
+                print(f'{level:>6} {threads:>8} {stats.packed_size / 1000000:>8.1f} {stats.ratio:>6.2f} '
+                      f'{size / 1000000 / pack_seconds:>8.1f} {size / 1000000 / unpack_seconds:>12.1f} {identical}')
+                os.remove(restored)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+import argparse
+import contextlib
+import logging
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import s3_operations
+from benchmark_download import create_file
+from benchmark_write_path import free_port
+
+# Uploads a generated file to a local S3 stand-in with different part concurrencies and part sizes and
+# reports the upload rate. Without --endpoint-url the moto server (pip install moto[server]) is started in
+# its own process. moto keeps the objects in memory; for files of many GB use a MinIO server instead, e.g.
+#
+#   python benchmark_s3_upload.py --endpoint-url http://127.0.0.1:9000 --sizes 1000,10000,50000
+
+BUCKET = 'benchmark-bucket'
+
+
+@contextlib.contextmanager
+def moto_server():
+    port = free_port()
+    server = subprocess.Popen([sys.executable, '-m', 'moto.server', '-p', str(port)],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        # Wait for the server to accept connections
+        for _ in range(100):
+            with contextlib.suppress(OSError), socket.create_connection(('127.0.0.1', port)):
+                break
+            time.sleep(0.1)
+        yield f'http://127.0.0.1:{port}'
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser('benchmark_s3_upload')
+    parser.add_argument('--sizes', help='Comma separated sizes of the generated files in MB', default='1000')
+    parser.add_argument('--concurrency', help='Comma separated part concurrencies to compare', default='1,2,4,8,16')
+    parser.add_argument('--part-sizes', help='Comma separated part sizes in MB to compare', default='16,64')
+    parser.add_argument('--endpoint-url', help='S3 compatible server to use instead of a local moto server')
+    parser.add_argument('--crt', help='Use the AWS Common Runtime transfer client', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s', level=logging.WARNING)
+    # Local stand-ins accept any credentials
+    for name in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY']:
+        os.environ.setdefault(name, 'benchmark')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+    with contextlib.ExitStack() as stack:
+        os.environ['AWS_ENDPOINT_URL'] = args.endpoint_url or stack.enter_context(moto_server())
+        folder = stack.enter_context(tempfile.TemporaryDirectory())
+        client = s3_operations.get_client()
+        with contextlib.suppress(client.exceptions.BucketAlreadyOwnedByYou):
+            client.create_bucket(Bucket=BUCKET)
+
+        print(f'{"size MB":>8} {"part MB":>8} {"parallel":>8} {"seconds":>9} {"MB/s":>9}')
+        for size in [int(s) for s in args.sizes.split(',')]:
+            source = os.path.join(folder, 'source.zip')
+            create_file(source, size * 1000000)
+            for part_size in [int(p) for p in args.part_sizes.split(',')]:
+                for concurrency in [int(c) for c in args.concurrency.split(',')]:
+                    settings = s3_operations.TransferSettings(part_size=part_size * 1024 * 1024,
+                                                              max_concurrency=concurrency, use_crt=args.crt)
+                    start = time.perf_counter()
+                    # The progress output is not what is measured, keep it off the terminal
+                    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                        uploaded = s3_operations.upload(source, BUCKET, 'benchmark.zip', settings=settings)
+                    elapsed = time.perf_counter() - start
+                    if not uploaded:
+                        print(f'{size:>8} {part_size:>8} {concurrency:>8}  upload failed')
+                        continue
+                    print(f'{size:>8} {part_size:>8} {concurrency:>8} {elapsed:>9.2f} {size / elapsed:>9.1f}')
+                    client.delete_object(Bucket=BUCKET, Key='benchmark.zip')
+            os.remove(source)
+
+
+if __name__ == '__main__':
+    main()
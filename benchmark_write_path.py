@@ -0,0 +1,91 @@
+import argparse
+import contextlib
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import downloader
+import transport
+from benchmark_download import create_file, sha256
+
+# Measures the download write path against the local stand-in server, which runs in its own process so that
+# the CPU time below is the client's alone. The legacy loop is the one the scripts used before: 1 KB chunks
+# with a progress bar string written for every chunk.
+
+
+def legacy_download(session, url, full_path):
+    file = session.get(url, stream=True)
+    total_size = file.headers.get('content-length')
+    with open(full_path, 'wb') as f:
+        dl = 0
+        for chunk in file.iter_content(1024):
+            f.write(chunk)
+            if total_size is not None:
+                dl += len(chunk)
+                done = int(100 * dl / int(total_size))
+                sys.stdout.write("\r[%s%s] %s percent" % ('=' * done, ' ' * (100 - done), str(done)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def measure(function):
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    # The progress output is not what is measured, keep it off the terminal
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        function()
+    return time.perf_counter() - wall, time.process_time() - cpu
+
+
+def main():
+    parser = argparse.ArgumentParser('benchmark_write_path')
+    parser.add_argument('--size', help='Size of the generated file in MB', type=int, default=512)
+    parser.add_argument('--buffer-sizes', help='Comma separated read buffer sizes in MB', default='1,4,16')
+    parser.add_argument('--workers', help='Parallel connections for the new write path', type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        source = os.path.join(folder, 'source.zip')
+        create_file(source, args.size * 1000000)
+        expected = sha256(source)
+
+        port = free_port()
+        server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                'local_server.py'), source, '-p', str(port)],
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        url = f'http://127.0.0.1:{port}/download/backup.zip'
+        try:
+            # Wait for the server to accept connections
+            for _ in range(50):
+                with contextlib.suppress(OSError), socket.create_connection(('127.0.0.1', port)):
+                    break
+                time.sleep(0.1)
+
+            runs = [('legacy 1 KB', lambda target: legacy_download(transport.create_session(), url, target))]
+            for buffer_mb in [int(b) for b in args.buffer_sizes.split(',')]:
+                runs.append((f'readinto {buffer_mb} MB',
+                             lambda target, b=buffer_mb: downloader.download(
+                                 transport.create_session(args.workers + 1), url, target, args.workers,
+                                 buffer_size=b * 1024 * 1024)))
+
+            gigabytes = args.size / 1000
+            print(f'{"write path":>18} {"MB/s":>9} {"CPU s/GB":>9}  identical')
+            for name, run in runs:
+                target = os.path.join(folder, 'target.zip')
+                wall, cpu = measure(lambda: run(target))
+                identical = sha256(target) == expected
+                print(f'{name:>18} {args.size / wall:>9.1f} {cpu / gigabytes:>9.2f}  {identical}')
+                os.remove(target)
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    main()
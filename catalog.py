@@ -0,0 +1,357 @@
+import argparse
+import datetime
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+import archive_index
+import integrity
+import repack
+import s3_operations
+
+# Catalog of the backups made by operations.download_backup_and_upload_to_s3.
+#
+# Every finished backup is recorded in a local SQLite database with its site, product, time, size, hashes,
+# local files and S3 object. The rows are indexed by site, product and time, so finding the backups of a site
+# or a period takes an index lookup instead of listing S3 prefixes and folders. The same fields are stored
+# as metadata of the S3 object, from which sync rebuilds the catalog of a bucket.
+#
+# prune applies a grandfather-father-son retention policy per site and product: the newest backup of each of
+# the last N days, weeks, months and years is kept, everything else is deleted from S3 in batches of up to
+# 1000 keys and from the local folders. Deleted backups stay in the catalog with the time of deletion.
+
+CATALOG_FILE = 'backup_catalog.sqlite'
+# Retention periods and the key that is the same for all backups of one period
+PERIODS = {
+    'daily': lambda day: day.date(),
+    'weekly': lambda day: day.isocalendar()[:2],
+    'monthly': lambda day: (day.year, day.month),
+    'yearly': lambda day: day.year,
+}
+METADATA_PREFIX = 'backup-'
+# Backup file names of the scripts and of the scheduler, e.g. acme-jira-export-20260101_020000.zip
+_FILE_NAME = re.compile(r'^(?:(?P<site>.+)-)?(?P<product>jira|confluence)-export-(?P<stamp>\d{8}_\d{6})\.zip')
+
+
+def default_path(folder):
+    return os.path.join(folder, CATALOG_FILE)
+
+
+def object_metadata(site, product, created, sha256=None):
+    """S3 user metadata of a backup object, read back by sync"""
+    metadata = {METADATA_PREFIX + 'site': site or '', METADATA_PREFIX + 'product': product,
+                METADATA_PREFIX + 'created': f'{created:.3f}'}
+    if sha256:
+        metadata[METADATA_PREFIX + 'sha256'] = sha256
+    return metadata
+
+
+class Catalog(object):
+    """Backups of all sites and products in an SQLite database"""
+
+    def __init__(self, path):
+        self.path = path
+        # The scheduler records backups from several threads, the lock serializes the use of the connection.
+        # Other processes wait for the database lock for up to 30 seconds
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.executescript('''
+                CREATE TABLE IF NOT EXISTS backups (
+                    id INTEGER PRIMARY KEY, site TEXT NOT NULL, product TEXT NOT NULL, created REAL NOT NULL,
+                    file_name TEXT NOT NULL, size INTEGER, sha256 TEXT, s3_checksum TEXT, s3_bucket TEXT,
+                    s3_key TEXT, local_files TEXT NOT NULL DEFAULT '[]', deleted REAL,
+                    UNIQUE (site, product, file_name));
+                CREATE INDEX IF NOT EXISTS backups_by_time ON backups (site, product, created);
+                CREATE INDEX IF NOT EXISTS backups_by_created ON backups (created);
+                CREATE INDEX IF NOT EXISTS backups_by_object ON backups (s3_bucket, s3_key);
+            ''')
+
+    def record(self, site, product, created, file_name, size=None, sha256=None, s3_checksum=None,
+               s3_bucket=None, s3_key=None, local_files=None):
+        """Add a backup, or update it if the same file of the site and product is already in the catalog
+
+        :param created: Unix time of the backup
+        :param local_files: Full paths of the files of the backup on disk, deleted with the backup
+        :return: id of the backup
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT INTO backups (site, product, created, file_name, size, sha256, s3_checksum, s3_bucket, '
+                's3_key, local_files) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (site, product, file_name) DO UPDATE SET created = excluded.created, '
+                'size = excluded.size, sha256 = excluded.sha256, s3_checksum = excluded.s3_checksum, '
+                's3_bucket = excluded.s3_bucket, s3_key = excluded.s3_key, local_files = excluded.local_files, '
+                'deleted = NULL',
+                (site or '', product, created, file_name, size, sha256, s3_checksum, s3_bucket, s3_key,
+                 json.dumps(local_files or [])))
+            return self._connection.execute('SELECT id FROM backups WHERE site = ? AND product = ? AND '
+                                            'file_name = ?', (site or '', product, file_name)).fetchone()[0]
+
+    def _select(self, query, parameters=()):
+        # Called with the lock held. Plain tuples turned into dicts here are much faster than sqlite3.Row
+        cursor = self._connection.execute(query, parameters)
+        names = [column[0] for column in cursor.description]
+        backups = [dict(zip(names, row)) for row in cursor.fetchall()]
+        for backup in backups:
+            backup['local_files'] = json.loads(backup['local_files']) if backup['local_files'] != '[]' else []
+        return backups
+
+    def find(self, site=None, product=None, since=None, until=None, include_deleted=False):
+        """Return the backups matching all given criteria, newest first
+
+        :param since: Unix time of the oldest backup to return
+        :param until: Unix time before which the backups have to be made
+        """
+        conditions, parameters = [], []
+        for column, value in [('site', site), ('product', product)]:
+            if value is not None:
+                conditions.append(f'{column} = ?')
+                parameters.append(value)
+        if since is not None:
+            conditions.append('created >= ?')
+            parameters.append(since)
+        if until is not None:
+            conditions.append('created < ?')
+            parameters.append(until)
+        if not include_deleted:
+            conditions.append('deleted IS NULL')
+        where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+        with self._lock:
+            return self._select(f'SELECT * FROM backups {where} ORDER BY created DESC', parameters)
+
+    def latest(self, site, product):
+        """Return the newest backup of a site and product, None if there is none"""
+        with self._lock:
+            backups = self._select('SELECT * FROM backups WHERE site = ? AND product = ? AND deleted IS NULL '
+                                   'ORDER BY created DESC LIMIT 1', (site, product))
+        return backups[0] if backups else None
+
+    def series(self):
+        """Return the (site, product) pairs that have backups"""
+        with self._lock:
+            return [tuple(row) for row in
+                    self._connection.execute('SELECT DISTINCT site, product FROM backups WHERE deleted IS NULL '
+                                             'ORDER BY site, product')]
+
+    def by_object(self, s3_bucket, s3_key):
+        with self._lock:
+            backups = self._select('SELECT * FROM backups WHERE s3_bucket = ? AND s3_key = ?', (s3_bucket, s3_key))
+        return backups[0] if backups else None
+
+    def objects(self, s3_bucket, prefix=''):
+        """Return the S3 keys of the backups in a bucket that are not deleted"""
+        with self._lock:
+            rows = self._connection.execute('SELECT s3_key FROM backups WHERE s3_bucket = ? AND deleted IS NULL '
+                                            'AND substr(s3_key, 1, ?) = ?', (s3_bucket, len(prefix), prefix))
+            return {row[0] for row in rows}
+
+    def mark_deleted(self, backup_ids, when=None):
+        when = when or time.time()
+        with self._lock, self._connection:
+            self._connection.executemany('UPDATE backups SET deleted = ? WHERE id = ?',
+                                         [(when, backup_id) for backup_id in backup_ids])
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def plan_retention(backups, policy):
+    """Split backups of one site and product into the ones a retention policy keeps and the ones it prunes
+
+    :param backups: Backups newest first, see Catalog.find
+    :param policy: Dict of period name in PERIODS to the number of periods to keep a backup of
+    :return: Tuple of (backups to keep, backups to prune)
+    """
+    kept = set()
+    seen = {period: set() for period in policy}
+    for backup in backups:
+        day = datetime.datetime.fromtimestamp(backup['created'])
+        for period, count in policy.items():
+            key = PERIODS[period](day)
+            if key not in seen[period] and len(seen[period]) < count:
+                seen[period].add(key)
+                kept.add(backup['id'])
+    # Never prune the newest backup, whatever the policy is
+    if backups:
+        kept.add(backups[0]['id'])
+    return [b for b in backups if b['id'] in kept], [b for b in backups if b['id'] not in kept]
+
+
+def delete_backups(backups):
+    """Delete the S3 objects, with their manifests, archive indexes and packs, and the local files of backups
+
+    :return: ids of the backups of which everything could be deleted
+    """
+    keys = {}
+    for backup in backups:
+        if backup['s3_bucket'] and backup['s3_key']:
+            keys.setdefault(backup['s3_bucket'], []).extend(
+                [backup['s3_key'], backup['s3_key'] + integrity.MANIFEST_SUFFIX,
+                 backup['s3_key'] + archive_index.INDEX_SUFFIX, backup['s3_key'] + repack.PACK_SUFFIX,
+                 backup['s3_key'] + repack.PACK_SUFFIX + integrity.MANIFEST_SUFFIX])
+    failed = set()
+    for bucket, bucket_keys in keys.items():
+        failed.update((bucket, key) for key in s3_operations.delete_objects(bucket, bucket_keys))
+
+    deleted = []
+    for backup in backups:
+        if (backup['s3_bucket'], backup['s3_key']) in failed:
+            continue
+        try:
+            for path in backup['local_files']:
+                for file_path in [path, path + integrity.MANIFEST_SUFFIX]:
+                    if os.path.isfile(file_path):
+                        os.remove(file_path)
+        except OSError:
+            logging.error(f'Cannot delete the local files of {backup["file_name"]}')
+            logging.error(traceback.format_exc())
+            continue
+        deleted.append(backup['id'])
+    return deleted
+
+
+def prune(catalog, policy, site=None, product=None, dry_run=False):
+    """Delete the backups a retention policy does not keep and return them
+
+    :param policy: Dict of period name in PERIODS to the number of periods to keep a backup of
+    :param dry_run: Only return the backups that would be deleted
+    """
+    pruned = []
+    for series_site, series_product in catalog.series():
+        if site is not None and series_site != site or product is not None and series_product != product:
+            continue
+        kept, to_prune = plan_retention(catalog.find(series_site, series_product), policy)
+        logging.info(f'{series_site} {series_product}: keeping {len(kept)} backups, pruning {len(to_prune)}')
+        pruned += to_prune
+
+    if dry_run or not pruned:
+        return pruned
+    deleted = set(delete_backups(pruned))
+    catalog.mark_deleted(deleted)
+    if len(deleted) < len(pruned):
+        logging.error(f'{len(pruned) - len(deleted)} backups could not be deleted, they stay in the catalog')
+    return [backup for backup in pruned if backup['id'] in deleted]
+
+
+def parse_file_name(name):
+    """Return (site, product, unix time) from a backup file name, None if it is not one"""
+    match = _FILE_NAME.match(name)
+    if match is None:
+        return None
+    created = time.mktime(time.strptime(match.group('stamp'), '%Y%m%d_%H%M%S'))
+    return match.group('site'), match.group('product'), created
+
+
+def sync(catalog, bucket, prefix=''):
+    """Add the backups of a bucket that are missing in the catalog and mark the ones gone from S3 as deleted
+
+    This is the only operation that lists the bucket. The metadata of the objects is read for the backups
+    that are not in the catalog yet; older objects without metadata are recognized by their name.
+
+    :return: Tuple of (number of backups added, number marked as deleted)
+    """
+    client = s3_operations.get_client()
+    known = catalog.objects(bucket, prefix)
+    listed = set()
+    added = 0
+    items = [item for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix)
+             for item in page.get('Contents', [])]
+    keys = {item['Key'] for item in items}
+    for item in items:
+        key = item['Key']
+        if key.endswith(integrity.MANIFEST_SUFFIX) or key.endswith(archive_index.INDEX_SUFFIX):
+            continue
+        # A pack uploaded next to its zip belongs to the backup of the zip
+        if key.endswith(repack.PACK_SUFFIX) and key[:-len(repack.PACK_SUFFIX)] in keys:
+            continue
+        listed.add(key)
+        if key in known:
+            continue
+        head = client.head_object(Bucket=bucket, Key=key, ChecksumMode='ENABLED')
+        metadata = head.get('Metadata', {})
+        if METADATA_PREFIX + 'product' in metadata:
+            site = metadata.get(METADATA_PREFIX + 'site')
+            product = metadata[METADATA_PREFIX + 'product']
+            created = float(metadata[METADATA_PREFIX + 'created'])
+        else:
+            parsed = parse_file_name(os.path.basename(key))
+            if parsed is None:
+                continue
+            site, product, created = parsed
+        catalog.record(site, product, created, os.path.basename(key), item['Size'],
+                       metadata.get(METADATA_PREFIX + 'sha256'), head.get('ChecksumSHA256'), bucket, key)
+        added += 1
+
+    gone = [catalog.by_object(bucket, key)['id'] for key in known - listed]
+    catalog.mark_deleted(gone)
+    return added, len(gone)
+
+
+def parse_day(text):
+    return time.mktime(time.strptime(text, '%Y-%m-%d'))
+
+
+def main():
+    parser = argparse.ArgumentParser('catalog')
+    parser.add_argument('-c', '--catalog', help='SQLite catalog file', default=CATALOG_FILE)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    list_parser = subparsers.add_parser('list', help='List the backups')
+    prune_parser = subparsers.add_parser('prune', help='Delete the backups a retention policy does not keep')
+    for sub_parser in [list_parser, prune_parser]:
+        sub_parser.add_argument('-s', '--site')
+        sub_parser.add_argument('-p', '--product', choices=['jira', 'confluence'])
+    list_parser.add_argument('--since', help='First day, YYYY-MM-DD')
+    list_parser.add_argument('--until', help='Day after the last day, YYYY-MM-DD')
+    list_parser.add_argument('--deleted', help='Include deleted backups', action='store_true')
+    for period in PERIODS:
+        prune_parser.add_argument(f'--{period}', help=f'Number of {period} backups to keep', type=int, default=0)
+    prune_parser.add_argument('--dry-run', help='Only show what would be deleted', action='store_true')
+    sync_parser = subparsers.add_parser('sync', help='Add the backups of an S3 bucket to the catalog')
+    sync_parser.add_argument('bucket')
+    sync_parser.add_argument('--prefix', default='')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s', level=logging.INFO)
+    catalog = Catalog(args.catalog)
+    try:
+        if args.command == 'list':
+            start = time.perf_counter()
+            backups = catalog.find(args.site, args.product, parse_day(args.since) if args.since else None,
+                                   parse_day(args.until) if args.until else None, args.deleted)
+            elapsed = time.perf_counter() - start
+            for backup in backups:
+                created = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(backup['created']))
+                location = f's3://{backup["s3_bucket"]}/{backup["s3_key"]}' if backup['s3_key'] else \
+                    ', '.join(backup['local_files'])
+                size = (backup['size'] or 0) // 1000000
+                print(f'{backup["site"]:<20} {backup["product"]:<10} {created} {size:>8} MB '
+                      f'{"deleted " if backup["deleted"] else ""}{location}')
+            logging.info(f'{len(backups)} backups found in {elapsed * 1000:.1f} ms')
+        elif args.command == 'prune':
+            policy = {period: getattr(args, period) for period in PERIODS if getattr(args, period)}
+            if not policy:
+                parser.error('Give at least one of ' + ', '.join(f'--{period}' for period in PERIODS))
+            pruned = prune(catalog, policy, args.site, args.product, args.dry_run)
+            for backup in pruned:
+                print(('Would delete ' if args.dry_run else 'Deleted ') + backup['file_name'])
+        else:
+            added, gone = sync(catalog, args.bucket, args.prefix)
+            logging.info(f'{added} backups added to the catalog, {gone} marked as deleted')
+    except Exception:
+        logging.error(f'{args.command} failed')
+        logging.error(traceback.format_exc())
+        sys.exit(1)
+    finally:
+        catalog.close()
+
+
+if __name__ == '__main__':
+    main()
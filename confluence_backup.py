@@ -16,11 +16,14 @@
 #                           Separated common parts between jira and confluence backups
 #                           Cleaned-up code
 
-import time
 import re
 import logging
+import export_state
+import metrics
 import traceback
 import operations
+import polling
+import progress_models
 
 # Atlassian imposes a restriction on the initiation of a backup process whereas
 # a new process can be initiated after 24 hours
@@ -30,7 +33,8 @@ FILE_LAST_BACKUP_URL = 'last_backup_file_url_confluence.txt'
 PROGRAM_NAME = 'confluence'
 
 
-def conf_backup(account, attachments, session):
+def conf_backup(account, attachments, session, url_file=FILE_LAST_BACKUP_URL, poller=None, run_metrics=None,
+                state=None, base_url=None):
     logging.info('Starting a new Confluence backup job.')
 
     # Set json data to determine if backup to include attachments.
@@ -39,94 +43,108 @@ def conf_backup(account, attachments, session):
         json = b'{"cbAttachments": "true", "exportToCloud": "true"}'
 
     # Create the full base url for the Confluence instance using the account name.
-    url = 'https://' + account + '.atlassian.net/wiki'
+    url = (base_url or 'https://' + account + '.atlassian.net/wiki').rstrip('/')
 
     error = 'error'
-    # Start backup
-    try:
-        backup_start = session.post(url + '/rest/obm/1.0/runbackup', data=json)
-        # Catch error response from backup start and exit if error found.
-        backup_response = int(re.search('(?<=<Response \[)(.*?)(?=\])', str(backup_start)).group(1))
+    run_metrics = run_metrics or metrics.RunMetrics(account, PROGRAM_NAME)
+    # Continue with the export of a run that stopped while it was waiting for it. Confluence has one export at a
+    # time and reports the progress of the running one
+    resume = state is not None and state.resumable()
+    if resume:
+        logging.info('Resuming the progress checks of the export triggered at '
+                     f'{export_state.format_time(state.data["triggered_at"])}')
+    elif state is not None and state.next_trigger_at() is not None:
+        logging.info(f'No new export can be started before {export_state.format_time(state.next_trigger_at())}')
+        return state.pending_file_url()
 
-        if backup_response == 200 and error.casefold() not in backup_start.text:
-            logging.info('Authentication is successful. Backup is starting...')
-        else:
-            logging.error('Backup could not start. Response code: ' + str(backup_response))
+    # Start backup
+    if not resume:
+        try:
+            with run_metrics.phase('trigger'):
+                backup_start = session.post(url + '/rest/obm/1.0/runbackup', data=json)
+            # Catch error response from backup start and exit if error found.
+            backup_response = int(re.search('(?<=<Response \[)(.*?)(?=\])', str(backup_start)).group(1))
+
+            if backup_response == 200 and error.casefold() not in backup_start.text:
+                logging.info('Authentication is successful. Backup is starting...')
+                if state is not None:
+                    state.triggered()
+            else:
+                logging.error('Backup could not start. Response code: ' + str(backup_response))
+                logging.error('Response from server: ' + backup_start.text)
+
+                # If we hit the backup init restriction, server returns 406
+                if backup_response == 406:
+                    if state is not None:
+                        state.refused()
+                    file_url = operations.get_backup_file_url(url_file)
+                    # Can return None here if file does not exist
+                    return file_url
+        except AttributeError:
+            logging.error('Backup could not start (AttributeError)')
             logging.error('Response from server: ' + backup_start.text)
-
-            # If we hit the backup init restriction, server returns 406
-            if backup_response == 406:
-                file_url = operations.get_backup_file_url(FILE_LAST_BACKUP_URL)
-                # Can return None here if file does not exist
-                return file_url
-    except AttributeError:
-        logging.error('Backup could not start (AttributeError)')
-        logging.error('Response from server: ' + backup_start.text)
-        exit(1)
-    except Exception:
-        logging.error('Backup could not start')
-        logging.error(traceback.format_exc())
-        exit(1)
-
-    progress_req = session.get(url + '/rest/obm/1.0/getprogress')
-
-    # Check for filename match in response
-    file_name = str(re.search('(?<=fileName\":\")(.*?)(?=\")', progress_req.text))
-
-    # If no file name match in JSON response keep outputting progress every 10 seconds
-    while file_name == 'None':
-        progress_req = session.get(url + '/rest/obm/1.0/getprogress')
-        # Regex to extract elements of JSON progress response.
-        file_name = str(re.search('(?<=fileName\":\")(.*?)(?=\")', progress_req.text))
-        estimated_percentage = str(re.search('(?<=Estimated progress: )(.*?)(?=\")', progress_req.text))
-
-        # While there is an estimated percentage this will be output.
-        if estimated_percentage != 'None':
-            # Regex for current status.
-            current_status = str(
-                re.search('(?<=currentStatus\":\")(.*?)(?=\")', progress_req.text).group(1))
-            # Regex for percentage progress value
-            estimated_percentage_value = str(
-                re.search('(?<=Estimated progress: )(.*?)(?=\")', progress_req.text).group(1))
-            logging.info('Action: ' + current_status + ' / Overall progress: ' + estimated_percentage_value)
-            time.sleep(10)
-        # Once no estimated percentage in response the alternative progress is output.
-        elif estimated_percentage == 'None':
-            # Regex for current status.
-            current_status = str(
-                re.search('(?<=currentStatus\":\")(.*?)(?=\")', progress_req.text).group(1))
-            # Regex for alternative percentage value.
-            alt_percentage_value = str(
-                re.search('(?<=alternativePercentage\":\")(.*?)(?=\")', progress_req.text).group(1))
-            logging.info('Action: ' + current_status + ' / Overall progress: ' + alt_percentage_value)
-            time.sleep(10)
-        # Catch any instance of the of word 'error' in the response and exit script.
-        elif error.casefold() in progress_req.text:
-            logging.error('Error encountered in response')
-            logging.error('Response from server: ' + progress_req.text)
+            exit(1)
+        except Exception:
+            logging.error('Backup could not start')
+            logging.error(traceback.format_exc())
             exit(1)
 
-    # Get filename from progress JSON
-    file_name = str(re.search('(?<=fileName\":\")(.*?)(?=\")', progress_req.text))
+    poller = poller or polling.Poller()
+    with run_metrics.phase('export_wait'):
+        progress_req = session.get(url + '/rest/obm/1.0/getprogress')
+        # Decode each progress response once and take the values from it
+        progress = progress_models.ConfluenceProgress.parse(progress_req.text)
+
+        # If there is no file name in the response keep outputting progress, the check interval follows the
+        # estimated remaining time of the export
+        while not progress.is_finished:
+            operations.wait_for_next_poll(poller, progress_req)
+            progress_req = session.get(url + '/rest/obm/1.0/getprogress')
+
+            # Rate limited, try again when the server allows it
+            if polling.retry_after(progress_req) is not None:
+                logging.info(f'Progress check is throttled by the server (status {progress_req.status_code})')
+                continue
+
+            progress = progress_models.ConfluenceProgress.parse(progress_req.text)
+
+            # The estimated percentage is shown while there is one, the alternative percentage afterwards
+            if progress.percentage_text is not None:
+                logging.info(f'Action: {progress.current_status} / Overall progress: {progress.percentage_text}')
+                poller.observe(progress.percentage)
+            # Catch any instance of the of word 'error' in the response and exit script.
+            elif progress.has_error:
+                logging.error('Error encountered in response')
+                logging.error('Response from server: ' + progress_req.text)
+                if state is not None:
+                    state.failed(progress.current_status)
+                exit(1)
+            else:
+                poller.observe(None)
+    run_metrics.count('polls', poller.polls)
 
     # Check filename is not None
-    if file_name != 'None':
+    if progress.file_name:
         logging.info('Backup process is complete')
-        file_name = str(re.search('(?<=fileName\":\")(.*?)(?=\")', progress_req.text).group(1))
-        file_url = url + '/download/' + file_name
+        file_url = url + '/download/' + progress.file_name
+        if state is not None:
+            state.exported(file_url)
 
-        operations.save_backup_file_url(FILE_LAST_BACKUP_URL, file_url)
+        operations.save_backup_file_url(url_file, file_url)
 
         logging.info('Backup file can also be downloaded from ' + file_url)
 
         return file_url
     else:
         logging.error('Error in backup file name. File name is not set.')
+        if state is not None:
+            state.failed('File name is not set')
         exit(1)
 
 
 def main():
-    site, user_name, api_token, attachments, folder, download_only, s3_bucket = operations.parse_arguments(PROGRAM_NAME)
+    site, user_name, api_token, attachments, folder, download_only, s3_bucket, options = \
+        operations.parse_arguments(PROGRAM_NAME)
 
     logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s',
                         level=logging.INFO,
@@ -137,23 +155,47 @@ def main():
                         ])
 
     # Get a session
-    session = operations.get_session(user_name, api_token)
-
-    if download_only:
-        logging.info('Download only option is used')
-        file_url = operations.get_backup_file_url(FILE_LAST_BACKUP_URL)
-    else:
-        file_url = conf_backup(site, attachments, session)
-
-    successful = False
-    if file_url is not None:
-        logging.info('Backup complete, downloading file to ' + folder)
-        successful = operations.download_backup_and_upload_to_s3(file_url, folder, session, PROGRAM_NAME, s3_bucket)
+    # Leave room for the progress checks next to the parallel downloads
+    session = operations.get_session(user_name, api_token, options['workers'] + 2)
+    run_metrics = metrics.RunMetrics(site, PROGRAM_NAME)
+    options['metrics'] = run_metrics
+
+    # Runs for the same site wait for the export together, so only one of them may work on it
+    state = export_state.ExportState.load(export_state.state_file(site, PROGRAM_NAME))
+    if not state.acquire():
+        logging.info(f'Another backup of {site} is running, see {state.path}')
+        return
+    options['export_state'] = state
+
+    # The export functions call exit() on errors, the site is released for the next run in any case
+    try:
+        if download_only:
+            logging.info('Download only option is used')
+            file_url = operations.get_backup_file_url(FILE_LAST_BACKUP_URL)
+        else:
+            file_url = conf_backup(site, attachments, session,
+                                   poller=polling.Poller(max_wait=options['max_wait'] * 3600), run_metrics=run_metrics,
+                                   state=state, base_url=options['base_url'])
+
+        successful = False
+        if file_url is not None:
+            logging.info('Backup complete, downloading file to ' + folder)
+            successful = operations.download_backup_and_upload_to_s3(file_url, folder, session, PROGRAM_NAME, s3_bucket,
+                                                                       options)
+        elif state.status == export_state.DOWNLOADED:
+            logging.info('The backup file of the last export is already downloaded')
+            successful = True
+    finally:
+        state.release()
+
+    session.transport_stats.log()
+    operations.report_run(run_metrics, session, successful, options['metrics_dir'])
 
     if successful:
         logging.info('Backup job is finished successfully')
     else:
         logging.info('Backup job finished with errors. See the logs.')
+        exit(1)
 
 
 if __name__ == '__main__':
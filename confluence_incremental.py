@@ -0,0 +1,224 @@
+import argparse
+import logging
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+import dedup_store
+import incremental
+import metrics
+import operations
+
+# Incremental Confluence backup through the content REST API. It is not limited to one run per day like the
+# site export, and it only transfers the pages, blog posts and attachments that changed since the last run.
+#
+# Every run lists the spaces and the versions of their content, which is cheap, and compares them with the
+# local index. New and changed items are fetched in parallel into a content-addressed chunk store; items
+# that are gone are dropped from the index. Each run also saves the complete index of that moment as a
+# manifest of the store, so the state of every run can be rebuilt later.
+
+PROGRAM_NAME = 'confluence_incremental'
+CONTENT_TYPES = ['page', 'blogpost']
+CONTENT_EXPAND = 'body.storage,version,space,ancestors'
+
+
+def index_file(folder, site):
+    return os.path.join(folder, f'confluence_index_{site}.json')
+
+
+class ConfluenceIncremental(object):
+
+    def __init__(self, base_url, session, store, index, workers=incremental.DEFAULT_WORKERS,
+                 parallel_pages=incremental.DEFAULT_PARALLEL_PAGES, run_metrics=None):
+        """
+        :param base_url: Confluence base URL, e.g. https://<account>.atlassian.net/wiki
+        :param session: Authenticated session, see operations.get_session
+        :param store: dedup_store chunk store for the content
+        :param index: incremental.Index of the previous runs
+        :param workers: Number of items fetched in parallel
+        :param parallel_pages: Number of listing pages fetched in parallel
+        """
+        self._url = base_url.rstrip('/')
+        self._session = session
+        self._store = store
+        self._index = index
+        self._workers = workers
+        self._parallel_pages = parallel_pages
+        self._metrics = run_metrics or metrics.RunMetrics(None, PROGRAM_NAME)
+        self.totals = incremental.Totals()
+        self.failed = 0
+
+    def _list(self, executor, path, params):
+        return incremental.paginate(self._session, executor, self._url + path, params,
+                                    parallel=self._parallel_pages)
+
+    def list_spaces(self, executor, keys=None):
+        spaces = self._list(executor, '/rest/api/space', {})
+        if keys:
+            spaces = [space for space in spaces if space['key'] in keys]
+        return spaces
+
+    def list_space(self, executor, space_key):
+        """Return the versions of the content and the attachments of a space, without their bodies"""
+        content = []
+        for content_type in CONTENT_TYPES:
+            content += self._list(executor, '/rest/api/content',
+                                  {'spaceKey': space_key, 'type': content_type, 'status': 'current',
+                                   'expand': 'version'})
+        # Adding an attachment does not create a new page version, so attachments are listed on their own
+        # The search pages with a cursor and does not reliably honour the offset
+        attachments = incremental.paginate_links(self._session, self._url, '/rest/api/content/search',
+                                                 {'cql': f'type=attachment and space="{space_key}"',
+                                                  'expand': 'version,container'})
+        return content, attachments
+
+    def fetch_content(self, space_key, item):
+        document = incremental.get_json(self._session, f'{self._url}/rest/api/content/{item["id"]}',
+                                        {'expand': CONTENT_EXPAND})
+        keys, stats = incremental.store_document(self._store, document)
+        self.totals.add(stats)
+        self._index.set('content', item['id'], {
+            'space': space_key,
+            'type': item['type'],
+            'title': item['title'],
+            'version': item['version']['number'],
+            'chunks': keys,
+        })
+
+    def fetch_attachment(self, space_key, item):
+        version = item['version']['number']
+        keys, stats = incremental.store_download(self._session, self._url + item['_links']['download'],
+                                                 self._store)
+        self.totals.add(stats)
+        self._index.set('attachments', item['id'], {
+            'space': space_key,
+            'container': item.get('container', {}).get('id'),
+            'title': item['title'],
+            'version': version,
+            'media_type': item.get('extensions', {}).get('mediaType'),
+            'size': stats.total_bytes,
+            'chunks': keys,
+        })
+
+    def _changed(self, section, items):
+        known = self._index.entries(section)
+        return [item for item in items
+                if known.get(item['id'], {}).get('version') != item['version']['number']]
+
+    def _drop_missing(self, section, space_key, items):
+        present = {item['id'] for item in items}
+        missing = [key for key, entry in self._index.entries(section).items()
+                   if entry['space'] == space_key and key not in present]
+        self._index.remove(section, missing)
+        return len(missing)
+
+    def run(self, space_keys=None):
+        """Bring the store up to date and return True if every changed item could be fetched"""
+        with ThreadPoolExecutor(max_workers=self._parallel_pages) as pages, \
+                ThreadPoolExecutor(max_workers=self._workers) as fetches:
+            with self._metrics.phase('list'):
+                spaces = self.list_spaces(pages, space_keys)
+            futures = []
+            for space in spaces:
+                with self._metrics.phase('list'):
+                    content, attachments = self.list_space(pages, space['key'])
+                self._index.set('spaces', space['key'], {'name': space['name']})
+
+                changed_content = self._changed('content', content)
+                changed_attachments = self._changed('attachments', attachments)
+                removed = (self._drop_missing('content', space['key'], content) +
+                           self._drop_missing('attachments', space['key'], attachments))
+                logging.info(f'Space {space["key"]}: {len(changed_content)} of {len(content)} pages and '
+                             f'{len(changed_attachments)} of {len(attachments)} attachments changed, '
+                             f'{removed} removed')
+                self._metrics.count('unchanged_items', len(content) + len(attachments) -
+                                    len(changed_content) - len(changed_attachments))
+                self._metrics.count('removed_items', removed)
+
+                futures += [(item, fetches.submit(self.fetch_content, space['key'], item))
+                            for item in changed_content]
+                futures += [(item, fetches.submit(self.fetch_attachment, space['key'], item))
+                            for item in changed_attachments]
+
+            with self._metrics.phase('fetch'):
+                for item, future in futures:
+                    try:
+                        future.result()
+                    except Exception:
+                        # The index keeps the old version, so the item is fetched again in the next run
+                        logging.error(f'Cannot fetch {item["type"]} {item["id"]} ({item["title"]})')
+                        logging.error(traceback.format_exc())
+                        self.failed += 1
+
+        self._metrics.count('changed_items', self.totals.items)
+        self._metrics.count('failed_items', self.failed)
+        self._metrics.count('download_bytes', self.totals.total_bytes)
+        self._metrics.count('stored_bytes', self.totals.stored_bytes)
+        return self.failed == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(PROGRAM_NAME)
+    parser.add_argument('-s', '--site', help='Site name <account>.atlassian.net', required=True)
+    parser.add_argument('-u', '--user', help='An Atlassian account email address with admin rights',
+                        required=True)
+    parser.add_argument('-t', '--token', help='API token of the Atlassian account', required=True)
+    parser.add_argument('-f', '--folder', help='Folder of the local index, and of the store if --store is omitted',
+                        required=True)
+    parser.add_argument('--store', help='Chunk store for the content. Either a local directory or '
+                                        's3://bucket/prefix. Defaults to a store directory in the folder')
+    parser.add_argument('--spaces', help='Comma separated keys of the spaces to back up, all spaces if omitted')
+    parser.add_argument('-w', '--workers', help='Number of pages and attachments fetched in parallel',
+                        type=int, default=incremental.DEFAULT_WORKERS)
+    parser.add_argument('--parallel-pages', help='Number of listing pages fetched in parallel',
+                        type=int, default=incremental.DEFAULT_PARALLEL_PAGES)
+    parser.add_argument('--base-url', help='Confluence URL to use instead of https://<site>.atlassian.net/wiki, '
+                                           'e.g. a local stand-in server')
+    parser.add_argument('--record', help='Save all responses to this file, to replay them with local_server.py')
+    parser.add_argument('--metrics-dir', help='Folder to save a JSON report and a Prometheus textfile of the run to')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s',
+                        level=logging.INFO,
+                        encoding='utf-8',
+                        handlers=[
+                            logging.FileHandler(PROGRAM_NAME + '.log'),
+                            logging.StreamHandler()
+                        ])
+
+    os.makedirs(args.folder, exist_ok=True)
+    session = operations.get_session(args.user, args.token, args.workers + args.parallel_pages)
+    recording = incremental.record_responses(session) if args.record else None
+    store = dedup_store.open_store(args.store or os.path.join(args.folder, 'store'))
+    index = incremental.Index.load(index_file(args.folder, args.site))
+    run_metrics = metrics.RunMetrics(args.site, PROGRAM_NAME)
+
+    backup = ConfluenceIncremental(args.base_url or f'https://{args.site}.atlassian.net/wiki', session, store,
+                                   index, args.workers, args.parallel_pages, run_metrics)
+    successful = False
+    try:
+        successful = backup.run(args.spaces.split(',') if args.spaces else None)
+    except Exception:
+        logging.error('Incremental backup failed')
+        logging.error(traceback.format_exc())
+    else:
+        index.save()
+        name = f'confluence-{args.site}-{time.strftime("%Y%m%d_%H%M%S")}'
+        store.put_manifest(name, index.data)
+        logging.info(f'{backup.totals.items} changed items fetched, {backup.totals.stored_bytes // 1000} KB of '
+                     f'{backup.totals.total_bytes // 1000} KB stored as new chunks. Snapshot saved as {name}')
+
+    if recording is not None:
+        incremental.save_recording(recording, args.record)
+    session.transport_stats.log()
+    operations.report_run(run_metrics, session, successful, args.metrics_dir)
+
+    if successful:
+        logging.info('Backup job is finished successfully')
+    else:
+        logging.info('Backup job finished with errors. See the logs.')
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,424 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import struct
+import sys
+import threading
+import zipfile
+import zlib
+
+# Deduplicated storage for backup archives.
+#
+# An export zip is split into regions: zip headers, member data and the central directory. Text members
+# (e.g. entities.xml) whose deflate stream can be reproduced with zlib are stored decompressed and cut with
+# content-defined chunking, so an edit in the middle of the file only changes the chunks around it. All
+# other regions are cut into fixed-size chunks, which is enough for attachments that do not change between
+# exports. Chunks are stored by their SHA-256, and a manifest per backup lists the chunks needed to rebuild
+# a byte-identical zip. Rebuilding the text members needs a zlib that compresses like the one that stored
+# them, so the manifest records the zlib version and the CRC-32 of every such member, see repack.py.
+
+MIN_CHUNK_SIZE = 64 * 1024
+AVG_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+FIXED_CHUNK_SIZE = 1024 * 1024
+READ_SIZE = 1024 * 1024
+
+# Only members which compress at least this well are treated as text
+TEXT_COMPRESSION_RATIO = 2
+TEXT_MIN_SIZE = 1024 * 1024
+# Java's ZipOutputStream uses zlib with the default compression level
+DEFLATE_LEVEL = 6
+
+# Cut points are only considered at the end of a line, or of a tag in XML without line breaks. The text members
+# are XML, so these come every few dozen bytes, and the regular expression finds them in C instead of hashing
+# every byte in Python
+_ANCHORS = [re.compile(b'\n'), re.compile(b'>')]
+# Bytes before an anchor whose CRC-32 decides whether to cut there
+WINDOW = 48
+# FastCDC style normalization: cut less likely before the average size and more likely after it. An anchor
+# following a gap of n bytes is a cut point with the probability n / 2^20 before and n / 2^16 after it, so
+# the chunk sizes do not depend on how dense the anchors are
+_SHIFT_SMALL = 32 - 20
+_SHIFT_LARGE = 32 - 16
+
+
+class RecompressMismatch(Exception):
+    pass
+
+
+def find_cut(data, min_size=MIN_CHUNK_SIZE, avg_size=AVG_CHUNK_SIZE, max_size=MAX_CHUNK_SIZE):
+    """Return the length of the first content-defined chunk of data"""
+    size = len(data)
+    if size <= min_size:
+        return size
+    end = min(size, max_size)
+    normal = min(avg_size, end)
+    crc32 = zlib.crc32
+    for anchor in _ANCHORS:
+        previous = min_size
+        for match in anchor.finditer(data, min_size, end):
+            i = match.end()
+            gap = i - previous
+            previous = i
+            shift = _SHIFT_SMALL if i < normal else _SHIFT_LARGE
+            if crc32(data[i - WINDOW:i]) < gap << shift:
+                return i
+        if previous > min_size:
+            return end
+    return end
+
+
+def cdc_chunks(blocks):
+    """Cut an iterable of byte blocks into content-defined chunks"""
+    buffer = bytearray()
+    for block in blocks:
+        buffer += block
+        while len(buffer) >= MAX_CHUNK_SIZE:
+            cut = find_cut(buffer)
+            yield bytes(buffer[:cut])
+            del buffer[:cut]
+    while buffer:
+        cut = find_cut(buffer)
+        yield bytes(buffer[:cut])
+        del buffer[:cut]
+
+
+def fixed_chunks(f, length):
+    while length > 0:
+        chunk = f.read(min(FIXED_CHUNK_SIZE, length))
+        if not chunk:
+            raise IOError('Unexpected end of file')
+        length -= len(chunk)
+        yield chunk
+
+
+def inflate_verified(f, length, level, digest=None):
+    """Yield the decompressed content of a raw deflate stream, checking on the fly that compressing it
+    again with zlib at the given level gives back exactly the same bytes
+
+    :param digest: Optional object whose update method receives the deflate data as it is read
+    """
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    original = bytearray()
+    recompressed = bytearray()
+
+    def compare():
+        matched = min(len(original), len(recompressed))
+        if original[:matched] != recompressed[:matched]:
+            raise RecompressMismatch()
+        del original[:matched]
+        del recompressed[:matched]
+
+    while length > 0:
+        block = f.read(min(READ_SIZE, length))
+        if not block:
+            raise IOError('Unexpected end of file')
+        length -= len(block)
+        if digest is not None:
+            digest.update(block)
+        original += block
+        plain = decompressor.decompress(block)
+        recompressed += compressor.compress(plain)
+        compare()
+        yield plain
+
+    recompressed += compressor.flush()
+    compare()
+    if original or recompressed or not decompressor.eof:
+        raise RecompressMismatch()
+
+
+def zip_regions(path):
+    """Split a zip file into (kind, offset, length, info) regions in file order
+
+    kind is 'raw' for headers and the central directory, 'member' for the data of a zip member.
+    """
+    with zipfile.ZipFile(path) as zf:
+        members = sorted(zf.infolist(), key=lambda i: i.header_offset)
+
+    regions = []
+    cursor = 0
+    with open(path, 'rb') as f:
+        for info in members:
+            f.seek(info.header_offset)
+            header = f.read(30)
+            name_length, extra_length = struct.unpack('<HH', header[26:30])
+            data_start = info.header_offset + 30 + name_length + extra_length
+            regions.append(('raw', cursor, data_start - cursor, None))
+            regions.append(('member', data_start, info.compress_size, info))
+            cursor = data_start + info.compress_size
+    regions.append(('raw', cursor, os.path.getsize(path) - cursor, None))
+    return [region for region in regions if region[2] > 0]
+
+
+class LocalChunkStore(object):
+
+    def __init__(self, root):
+        self._root = root
+        os.makedirs(os.path.join(root, 'chunks'), exist_ok=True)
+        os.makedirs(os.path.join(root, 'manifests'), exist_ok=True)
+
+    def _chunk_path(self, key):
+        return os.path.join(self._root, 'chunks', key[:2], key)
+
+    def has(self, key):
+        return os.path.isfile(self._chunk_path(key))
+
+    def put(self, key, data):
+        path = self._chunk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Parallel writers may store the same chunk, each needs its own temporary file
+        temp_path = f'{path}.{os.getpid()}-{threading.get_ident()}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    def get(self, key):
+        with open(self._chunk_path(key), 'rb') as f:
+            return f.read()
+
+    def put_manifest(self, name, manifest):
+        # A manifest is only there once it is complete, so it never refers to a chunk that was not stored
+        path = os.path.join(self._root, 'manifests', name + '.json')
+        temp_path = f'{path}.{os.getpid()}-{threading.get_ident()}.tmp'
+        with open(temp_path, 'w', encoding='UTF-8') as f:
+            json.dump(manifest, f)
+        os.replace(temp_path, path)
+
+    def get_manifest(self, name):
+        with open(os.path.join(self._root, 'manifests', name + '.json'), 'r', encoding='UTF-8') as f:
+            return json.load(f)
+
+    def list_manifests(self):
+        return sorted(n[:-len('.json')] for n in os.listdir(os.path.join(self._root, 'manifests'))
+                      if n.endswith('.json'))
+
+
+class S3ChunkStore(object):
+
+    def __init__(self, bucket, prefix):
+        import s3_operations
+        self._client = s3_operations.get_client()
+        self._bucket = bucket
+        self._prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        # List the existing chunks once instead of asking S3 about every chunk
+        self._known = set()
+        paginator = self._client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=self._prefix + 'chunks/'):
+            for obj in page.get('Contents', []):
+                self._known.add(obj['Key'].rsplit('/', 1)[-1])
+
+    def _chunk_key(self, key):
+        return f'{self._prefix}chunks/{key[:2]}/{key}'
+
+    def has(self, key):
+        return key in self._known
+
+    def put(self, key, data):
+        self._client.put_object(Bucket=self._bucket, Key=self._chunk_key(key), Body=data)
+        self._known.add(key)
+
+    def get(self, key):
+        return self._client.get_object(Bucket=self._bucket, Key=self._chunk_key(key))['Body'].read()
+
+    def put_manifest(self, name, manifest):
+        self._client.put_object(Bucket=self._bucket, Key=f'{self._prefix}manifests/{name}.json',
+                                Body=json.dumps(manifest).encode('UTF-8'))
+
+    def get_manifest(self, name):
+        body = self._client.get_object(Bucket=self._bucket, Key=f'{self._prefix}manifests/{name}.json')['Body']
+        return json.loads(body.read())
+
+    def list_manifests(self):
+        names = []
+        paginator = self._client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self._bucket, Prefix=self._prefix + 'manifests/'):
+            for obj in page.get('Contents', []):
+                names.append(obj['Key'].rsplit('/', 1)[-1][:-len('.json')])
+        return sorted(names)
+
+
+def open_store(location):
+    """Open a chunk store from a local directory or an s3://bucket/prefix location"""
+    if location.startswith('s3://'):
+        bucket, _, prefix = location[len('s3://'):].partition('/')
+        return S3ChunkStore(bucket, prefix)
+    return LocalChunkStore(location)
+
+
+class Ingest(object):
+
+    def __init__(self, store):
+        self._store = store
+        self.total_bytes = 0
+        self.stored_bytes = 0
+        self.chunks = 0
+        self.new_chunks = 0
+
+    def add(self, chunks, compress):
+        """Store chunks that are not in the store yet and return their keys"""
+        keys = []
+        for chunk in chunks:
+            key = hashlib.sha256(chunk).hexdigest()
+            self.total_bytes += len(chunk)
+            self.chunks += 1
+            if not self._store.has(key):
+                # First byte tells whether the chunk body is zlib compressed
+                data = b'Z' + zlib.compress(chunk, 1) if compress else b'R' + chunk
+                self._store.put(key, data)
+                self.stored_bytes += len(data)
+                self.new_chunks += 1
+            keys.append(key)
+        return keys
+
+
+class _FileDigest(object):
+    """SHA-256 of the whole file and CRC-32 of the current segment, fed with the bytes of the file in order"""
+
+    def __init__(self):
+        self.sha256 = hashlib.sha256()
+        self.crc32 = 0
+
+    def update(self, data):
+        self.sha256.update(data)
+        self.crc32 = zlib.crc32(data, self.crc32)
+
+    def copy(self):
+        digest = _FileDigest()
+        digest.sha256 = self.sha256.copy()
+        digest.crc32 = self.crc32
+        return digest
+
+
+def _hashed(blocks, digest):
+    for block in blocks:
+        digest.update(block)
+        yield block
+
+
+def ingest(path, store, name=None):
+    """Add a backup zip to the store and write its manifest
+
+    :param path: Full path of the backup zip
+    :param store: LocalChunkStore or S3ChunkStore
+    :param name: Manifest name, the file name of path if omitted
+    :return: Ingest object with the chunk and byte counts of this run, once the manifest is written
+    """
+    name = name or os.path.basename(path)
+    stats = Ingest(store)
+    segments = []
+    # The regions cover the whole file in order, so the file is hashed while it is chunked
+    digest = _FileDigest()
+    try:
+        with open(path, 'rb') as f:
+            for kind, offset, length, info in zip_regions(path):
+                f.seek(offset)
+                is_text = (kind == 'member' and info.compress_type == zipfile.ZIP_DEFLATED
+                           and info.file_size >= TEXT_MIN_SIZE
+                           and info.file_size >= TEXT_COMPRESSION_RATIO * info.compress_size)
+                if is_text:
+                    before = digest.copy()
+                    digest.crc32 = 0
+                    try:
+                        keys = stats.add(cdc_chunks(inflate_verified(f, length, DEFLATE_LEVEL, digest)),
+                                         compress=True)
+                        segments.append({'type': 'deflate', 'level': DEFLATE_LEVEL, 'crc32': digest.crc32,
+                                         'chunks': keys})
+                        continue
+                    except RecompressMismatch:
+                        logging.info(f'{info.filename} cannot be recompressed identically, storing it as is')
+                        f.seek(offset)
+                        digest = before
+                keys = stats.add(_hashed(fixed_chunks(f, length), digest), compress=False)
+                segments.append({'type': 'raw', 'chunks': keys})
+
+        # The manifest is written last, the backup is only in the store once it is there. The deflate segments
+        # are only rebuilt identically by a zlib that compresses like this one
+        store.put_manifest(name, {'name': name, 'size': os.path.getsize(path), 'sha256': digest.sha256.hexdigest(),
+                                  'zlib_version': zlib.ZLIB_RUNTIME_VERSION, 'segments': segments})
+    except Exception:
+        if stats.new_chunks:
+            # Chunks are content-addressed, so the next ingest of the file finds them instead of storing them again
+            logging.warning(f'Ingest of {name} failed, {stats.new_chunks} chunks of '
+                            f'{stats.stored_bytes // 1000000} MB are stored without a manifest that refers to them')
+        raise
+    return stats
+
+
+def read_chunk(store, key):
+    data = store.get(key)
+    return zlib.decompress(data[1:]) if data[:1] == b'Z' else data[1:]
+
+
+def restore(store, name, target):
+    """Rebuild the backup zip of manifest name into target and check its SHA-256
+
+    :return: True if the restored file is identical to the ingested one, False otherwise
+    """
+    manifest = store.get_manifest(name)
+    packed_with = manifest.get('zlib_version', 'unknown')
+    if packed_with != zlib.ZLIB_RUNTIME_VERSION:
+        logging.warning(f'{name} was stored with zlib {packed_with}, this is zlib {zlib.ZLIB_RUNTIME_VERSION}. '
+                        'The restored zip may differ from the original')
+    digest = _FileDigest()
+    with open(target, 'wb') as f:
+        def write(data):
+            f.write(data)
+            digest.update(data)
+
+        for number, segment in enumerate(manifest['segments']):
+            if segment['type'] == 'deflate':
+                digest.crc32 = 0
+                compressor = zlib.compressobj(segment['level'], zlib.DEFLATED, -zlib.MAX_WBITS)
+                for key in segment['chunks']:
+                    write(compressor.compress(read_chunk(store, key)))
+                write(compressor.flush())
+                # Manifests written before the CRC-32 was recorded are only checked by the SHA-256 at the end
+                if segment.get('crc32', digest.crc32) != digest.crc32:
+                    logging.error(f'Segment {number + 1} of {name} does not come out as the original deflate data '
+                                  f'with zlib {zlib.ZLIB_RUNTIME_VERSION}. Restore it with zlib {packed_with}')
+                    return False
+            else:
+                for key in segment['chunks']:
+                    write(read_chunk(store, key))
+
+    if digest.sha256.hexdigest() != manifest['sha256']:
+        logging.error(f'Restored file {target} does not match the original backup')
+        return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser('dedup_store')
+    parser.add_argument('store', help='Local directory or s3://bucket/prefix of the chunk store')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    ingest_parser = subparsers.add_parser('ingest', help='Add a backup zip to the store')
+    ingest_parser.add_argument('file')
+    restore_parser = subparsers.add_parser('restore', help='Rebuild a backup zip from the store')
+    restore_parser.add_argument('name', help='Name of the backup, see the list command')
+    restore_parser.add_argument('target', help='Full path of the restored file')
+    subparsers.add_parser('list', help='List the backups in the store')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s', level=logging.INFO)
+    store = open_store(args.store)
+
+    if args.command == 'ingest':
+        stats = ingest(args.file, store)
+        logging.info(f'{stats.new_chunks} of {stats.chunks} chunks are new, '
+                     f'{stats.stored_bytes // 1000000} MB stored')
+    elif args.command == 'restore':
+        if not restore(store, args.name, args.target):
+            sys.exit(1)
+        logging.info(args.name + ' is restored to ' + args.target)
+    else:
+        for name in store.list_manifests():
+            print(name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import glob
+import json
+import logging
+import os
+import threading
+
+# A journal is a small JSON file next to a partially downloaded backup file. It records the source URL,
+# the validators of the remote file and the byte ranges that are already on disk, so an interrupted
+# download can continue where it stopped.
+
+JOURNAL_SUFFIX = '.journal'
+
+
+class Journal(object):
+
+    def __init__(self, path, url, total_size, validators, segment_size, completed=None):
+        self.path = path
+        self.url = url
+        self.total_size = total_size
+        self.validators = validators
+        self.segment_size = segment_size
+        self.completed = set(tuple(r) for r in completed or [])
+        self._lock = threading.Lock()
+
+    @property
+    def file_path(self):
+        return self.path[:-len(JOURNAL_SUFFIX)]
+
+    @property
+    def completed_bytes(self):
+        return sum(end - start + 1 for start, end in self.completed)
+
+    @classmethod
+    def for_file(cls, file_path, url, total_size, validators, segment_size):
+        return cls(file_path + JOURNAL_SUFFIX, url, total_size, validators, segment_size)
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path, 'r', encoding='UTF-8') as jf:
+                data = json.load(jf)
+            return cls(path, data['url'], data['total_size'], data['validators'], data['segment_size'],
+                       data['completed'])
+        except (IOError, ValueError, KeyError):
+            logging.error(f'Cannot read the download journal {path}')
+            return None
+
+    def matches(self, url, total_size, validators):
+        """Check that the remote file is still the one this journal was written for
+
+        A changed ETag or Last-Modified means the bytes on disk belong to another file and must not be
+        mixed with new ones.
+        """
+        if self.url != url or self.total_size != total_size:
+            return False
+        for key, value in self.validators.items():
+            if value is not None and validators.get(key) != value:
+                return False
+        return True
+
+    def mark_done(self, start, end):
+        with self._lock:
+            self.completed.add((start, end))
+            self.save()
+
+    def save(self):
+        data = {
+            'url': self.url,
+            'total_size': self.total_size,
+            'validators': self.validators,
+            'segment_size': self.segment_size,
+            'completed': sorted(self.completed),
+        }
+        # Write to a temporary file first so a crash never leaves a half-written journal
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='UTF-8') as jf:
+            json.dump(data, jf)
+            jf.flush()
+            os.fsync(jf.fileno())
+        os.replace(temp_path, self.path)
+
+    def remove(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+def find(folder, url):
+    """Find the journal of an unfinished download of url in folder
+
+    :param folder: Download directory
+    :param url: URL of the backup file
+    :return: Journal whose partial file still exists, None if there is none
+    """
+    for path in sorted(glob.glob(os.path.join(glob.escape(folder), '*' + JOURNAL_SUFFIX))):
+        journal = Journal.load(path)
+        if journal is not None and journal.url == url and os.path.isfile(journal.file_path):
+            return journal
+    return None
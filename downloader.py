@@ -0,0 +1,300 @@
+import logging
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib3.exceptions import ProtocolError
+import download_journal
+import transport
+
+DEFAULT_WORKERS = 4
+DEFAULT_SEGMENT_SIZE_MB = 64
+DEFAULT_SEGMENT_SIZE = DEFAULT_SEGMENT_SIZE_MB * 1024 * 1024
+DEFAULT_BUFFER_SIZE_MB = 4
+DEFAULT_BUFFER_SIZE = DEFAULT_BUFFER_SIZE_MB * 1024 * 1024
+# How often the progress bar is redrawn
+PROGRESS_INTERVAL = 0.5
+
+# Only needed on platforms without os.pwrite, where seek and write must not interleave
+_seek_lock = threading.Lock()
+
+
+def probe(session, url):
+    """Find out the size of the remote file and whether the server accepts byte-range requests
+
+    A single-byte ranged GET is used instead of HEAD because the Atlassian download endpoints redirect
+    to a storage URL which does not always answer HEAD requests.
+
+    :param session: The current https session
+    :param url: URL of the file to download
+    :return: Tuple of (total size in bytes or None, True if ranges are supported, dict of ETag and Last-Modified)
+    """
+    with session.get(url, headers={'Range': 'bytes=0-0'}, stream=True) as response:
+        response.raise_for_status()
+        validators = {'etag': response.headers.get('etag'), 'last_modified': response.headers.get('last-modified')}
+
+        # Content-Range looks like "bytes 0-0/123456"
+        content_range = response.headers.get('content-range', '')
+        if response.status_code == 206 and '/' in content_range:
+            total = content_range.rsplit('/', 1)[-1]
+            if total.isdigit():
+                return int(total), True, validators
+
+        total = response.headers.get('content-length')
+        return (int(total) if total is not None else None), False, validators
+
+
+def if_range_value(validators):
+    # Weak ETags cannot be used in If-Range, Last-Modified is the next best option
+    etag = validators.get('etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return validators.get('last_modified')
+
+
+def split_segments(total_size, segment_size):
+    """Split a file of total_size bytes into inclusive (start, end) byte ranges"""
+    return [(start, min(start + segment_size, total_size) - 1) for start in range(0, total_size, segment_size)]
+
+
+def read_into(response, buffer_size):
+    """Yield the body of a streamed response as memoryviews of one reused buffer
+
+    The data is read with readinto, so no new bytes object is created per chunk. A yielded view is only
+    valid until the next one is requested; callers that keep data must copy it.
+    """
+    if response.headers.get('content-encoding', 'identity') != 'identity':
+        # The raw stream would still be compressed, let requests decode it
+        yield from response.iter_content(buffer_size)
+        return
+
+    buffer = memoryview(bytearray(buffer_size))
+    while True:
+        size = response.raw.readinto(buffer)
+        if not size:
+            return
+        yield buffer[:size]
+
+
+def preallocate(full_path, total_size, reserve=False):
+    """Create full_path with total_size bytes. With reserve, the disk blocks are allocated right away where
+    posix_fallocate is available, so a full disk fails the download at the start instead of in the middle"""
+    with open(full_path, 'wb') as f:
+        if reserve and hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(f.fileno(), 0, total_size)
+        else:
+            f.truncate(total_size)
+
+
+def drop_cache(fd, start, length):
+    # Tell the kernel that the written range will not be read again, so a large download does not push
+    # everything else out of the page cache. The data must be on disk already
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, start, length, os.POSIX_FADV_DONTNEED)
+
+
+def write_at(fd, data, offset):
+    # Positional write so that the workers never share a file position
+    if hasattr(os, 'pwrite'):
+        while data:
+            written = os.pwrite(fd, data, offset)
+            data = data[written:]
+            offset += written
+    else:
+        with _seek_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            os.write(fd, data)
+
+
+class Progress(object):
+    """Count downloaded bytes and redraw the progress bar from a background thread
+
+    Counting is all the download loop does, so the terminal output does not slow down the transfer.
+    """
+
+    def __init__(self, total_size, done=0):
+        self._total_size = total_size
+        self._done = done
+        self._last_percent = -1
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __call__(self, bytes_amount):
+        with self._lock:
+            self._done += bytes_amount
+
+    def __enter__(self):
+        if self._total_size:
+            self._thread = threading.Thread(target=self._report, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._draw()
+
+    def _report(self):
+        while not self._stopped.wait(PROGRESS_INTERVAL):
+            self._draw()
+
+    def _draw(self):
+        if not self._total_size:
+            return
+        percent = min(int(100 * self._done / self._total_size), 100)
+        if percent != self._last_percent:
+            self._last_percent = percent
+            # Print the download percentage
+            sys.stdout.write("\r[%s%s] %s percent" % ('=' * percent, ' ' * (100 - percent), str(percent)))
+            sys.stdout.flush()
+
+    @property
+    def done(self):
+        return self._done
+
+
+def download_segment(session, url, fd, start, end, progress, journal, limiter=None, hasher=None,
+                     buffer_size=DEFAULT_BUFFER_SIZE, no_cache=False):
+    """Download the inclusive byte range start-end of url, write it to the same offset of fd and record it
+    in the journal
+
+    If the connection breaks off, the rest of the range is requested again with the retries and the backoff of
+    the session, so every byte reaches the hasher once.
+    """
+    if_range = if_range_value(journal.validators)
+    retry = transport.body_retry(session, url)
+    offset = start
+    while offset <= end:
+        headers = {'Range': f'bytes={offset}-{end}'}
+        if if_range:
+            # The server answers with the whole file instead of 206 if the file has changed meanwhile
+            headers['If-Range'] = if_range
+        error = None
+        with session.get(url, headers=headers, stream=True) as response:
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise IOError(f'Server did not return bytes {offset}-{end}, the file may have changed on the server')
+
+            try:
+                for chunk in read_into(response, buffer_size):
+                    write_at(fd, chunk, offset)
+                    if hasher is not None:
+                        hasher.update(offset, chunk)
+                    offset += len(chunk)
+                    progress(len(chunk))
+                    if limiter is not None:
+                        limiter(len(chunk))
+            except transport.STREAM_ERRORS as e:
+                error = e
+
+        if offset <= end:
+            error = error or ProtocolError(f'Connection closed after {offset - start} bytes of segment {start}-{end}')
+            retry = transport.retry_body(retry, 'GET', url, error)
+
+    if offset != end + 1:
+        raise IOError(f'Segment {start}-{end} is too long, received {offset - start} bytes')
+
+    # Make sure the bytes are on disk before the journal says so
+    os.fsync(fd)
+    journal.mark_done(start, end)
+    if no_cache:
+        drop_cache(fd, start, end - start + 1)
+
+
+def download_single_stream(session, url, full_path, total_size, limiter=None, hasher=None,
+                           buffer_size=DEFAULT_BUFFER_SIZE):
+    """Download the whole file over one connection. Used when the server does not support ranges"""
+    with session.get(url, stream=True) as response, Progress(total_size) as progress:
+        response.raise_for_status()
+        with open(full_path, 'wb') as f:
+            for chunk in read_into(response, buffer_size):
+                f.write(chunk)
+                if hasher is not None:
+                    hasher.update(progress.done, chunk)
+                progress(len(chunk))
+                if limiter is not None:
+                    limiter(len(chunk))
+
+    return progress.done
+
+
+def download(session, url, full_path, workers=DEFAULT_WORKERS, segment_size=DEFAULT_SEGMENT_SIZE, limiter=None,
+             hasher=None, buffer_size=DEFAULT_BUFFER_SIZE, reserve_space=False, no_cache=False):
+    """Download url to full_path using concurrent byte-range requests when the server supports them
+
+    Segmented downloads keep a journal next to full_path. If a journal for the same remote file already
+    exists, only the missing segments are downloaded. The journal is removed once the file is complete.
+
+    :param session: The current https session to be used to download the file
+    :param url: URL of the file to download
+    :param full_path: Full path of the destination file
+    :param workers: Number of segments downloaded at the same time
+    :param segment_size: Size of each byte-range segment in bytes
+    :param limiter: Optional callable taking a byte count that blocks to enforce a bandwidth limit
+    :param hasher: Optional integrity.OrderedHasher that receives every downloaded chunk with its offset
+    :param buffer_size: Size of the read buffer of each connection in bytes
+    :param reserve_space: Allocate the disk space of the whole file before downloading
+    :param no_cache: Drop the written data from the page cache after each segment
+    :return: Tuple of (total size reported by the server or None, number of bytes on disk)
+    """
+    total_size, accepts_ranges, validators = probe(session, url)
+    if total_size is not None:
+        logging.info(f'Total size of backup file is {total_size // 1000000} MB')
+    if hasher is not None:
+        hasher.set_total_size(total_size)
+
+    journal_path = full_path + download_journal.JOURNAL_SUFFIX
+    journal = download_journal.Journal.load(journal_path) if os.path.isfile(journal_path) else None
+    if journal is not None and not (accepts_ranges and journal.matches(url, total_size, validators)):
+        logging.warning('The backup file has changed on the server since the last attempt, starting over')
+        journal.remove()
+        journal = None
+
+    if not accepts_ranges or not total_size:
+        logging.info('Downloading over a single connection...')
+        return total_size, download_single_stream(session, url, full_path, total_size, limiter, hasher,
+                                                  buffer_size)
+
+    if journal is None:
+        journal = download_journal.Journal.for_file(full_path, url, total_size, validators, segment_size)
+        # Preallocate the file so every segment can be written to its final position
+        preallocate(full_path, total_size, reserve_space)
+        journal.save()
+    elif journal.completed:
+        logging.info(f'Resuming download, {journal.completed_bytes // 1000000} MB are already downloaded')
+        if hasher is not None:
+            # Only the ranges of the earlier attempt are read back from disk
+            for start, end in sorted(journal.completed):
+                hasher.add_existing(full_path, start, end)
+
+    if hasher is not None:
+        # Every chunk is written before it is hashed, so chunks far ahead of the hashed position can be read back
+        hasher.spill_to(full_path)
+
+    # Keep the segment boundaries of the journal so completed ranges line up
+    segments = [segment for segment in split_segments(total_size, journal.segment_size)
+                if segment not in journal.completed]
+    logging.info(f'Downloading {len(segments)} segments with {workers} workers...')
+
+    fd = os.open(full_path, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        with Progress(total_size, journal.completed_bytes) as progress, \
+                ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            futures = [executor.submit(download_segment, session, url, fd, start, end, progress, journal,
+                                       limiter, hasher, buffer_size, no_cache)
+                       for start, end in segments]
+            try:
+                for future in futures:
+                    # Re-raise the first error of any worker
+                    future.result()
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+    finally:
+        os.close(fd)
+
+    journal.remove()
+    return total_size, progress.done
@@ -0,0 +1,225 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+# The export state is a small JSON file per site and product. It records the last export that was triggered,
+# its task id, the URL and ETag of the backup file and whether that file was downloaded, so that:
+#
+# - a run does not trigger an export while Atlassian still refuses new ones, and knows when the next one can be
+#   triggered
+# - a backup file that was already downloaded is not downloaded again when the export cannot be triggered
+# - a run that crashed while waiting for the export continues checking its progress instead of starting over
+#
+# A run holds an OS lock on the state for as long as it works on the export, so two invocations for the same
+# site and product do not trigger or download the same export twice. The OS drops the lock when a run crashes.
+
+STATE_SUFFIX = '.state.json'
+LOCK_SUFFIX = '.lock'
+# Atlassian allows one export every 24 hours
+COOLDOWN = 24 * 60 * 60
+# Try again after this long when the server refused an export that the state did not expect to be refused,
+# e.g. because it was started in the web interface
+REFUSED_RETRY = 60 * 60
+# Progress checks of an export are resumed if it was triggered this recently
+RESUME_MAX_AGE = COOLDOWN
+
+TRIGGERED = 'triggered'
+# An export that another client triggered, which this run waits for. Its trigger time is unknown, so it does not
+# start a cooldown
+JOINED = 'joined'
+EXPORTED = 'exported'
+DOWNLOADED = 'downloaded'
+FAILED = 'failed'
+
+
+def state_file(site, product):
+    return f'{site}_{product}{STATE_SUFFIX}'
+
+
+def format_time(timestamp):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+
+
+class ExportState(object):
+
+    def __init__(self, path, data=None, clock=time.time):
+        self.path = path
+        self.data = data or {}
+        self._clock = clock
+        self._lock_file = None
+        # The scheduler updates the state of a job from its export and its download thread
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path, clock=time.time):
+        """Read the state at path, an empty state if it does not exist or cannot be read"""
+        if not os.path.isfile(path):
+            return cls(path, clock=clock)
+        try:
+            with open(path, 'r', encoding='UTF-8') as sf:
+                return cls(path, json.load(sf), clock)
+        except (IOError, ValueError):
+            logging.error(f'Cannot read the export state {path}, starting with an empty one')
+            return cls(path, clock=clock)
+
+    def acquire(self):
+        """Take the lock of the state without waiting
+
+        :return: True if the lock is taken, False if another run holds it
+        """
+        lock_file = open(self.path + LOCK_SUFFIX, 'a+b')
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            elif msvcrt is not None:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        # Another run may have changed the state before it released the lock
+        self.data = ExportState.load(self.path).data
+        return True
+
+    def release(self):
+        if self._lock_file is not None:
+            # Closing the file drops the lock
+            self._lock_file.close()
+            self._lock_file = None
+
+    def save(self):
+        # Write to a temporary file first so a crash never leaves a half-written state
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='UTF-8') as sf:
+            json.dump(self.data, sf, indent=2)
+            sf.flush()
+            os.fsync(sf.fileno())
+        os.replace(temp_path, self.path)
+
+    def update(self, **values):
+        with self._lock:
+            self.data.update(values)
+            self.data['updated_at'] = self._clock()
+            self.save()
+
+    @property
+    def status(self):
+        return self.data.get('status')
+
+    @property
+    def task_id(self):
+        return self.data.get('task_id')
+
+    @property
+    def file_url(self):
+        return self.data.get('file_url')
+
+    def next_trigger_at(self):
+        """Time at which the next export can be triggered, None if one can be triggered right away"""
+        times = []
+        if self.data.get('triggered_at') is not None:
+            times.append(self.data['triggered_at'] + COOLDOWN)
+        if self.data.get('refused_at') is not None:
+            times.append(self.data['refused_at'] + REFUSED_RETRY)
+        next_time = max(times, default=None)
+        return next_time if next_time is not None and next_time > self._clock() else None
+
+    def next_run_at(self):
+        """Time at which a run has something to do: now if there is an export to resume or a backup file to
+        download, otherwise when the next export can be triggered"""
+        if self.resumable() or self.pending_file_url():
+            return self._clock()
+        return self.next_trigger_at() or self._clock()
+
+    def resumable(self, max_age=RESUME_MAX_AGE):
+        """True if the last export was triggered or joined but not seen finishing, recently enough to still be
+        running"""
+        if self.status == JOINED:
+            return self._clock() - self.data.get('joined_at', 0) < max_age
+        return self.status == TRIGGERED and self._clock() - self.data.get('triggered_at', 0) < max_age
+
+    @property
+    def waiting(self):
+        """True while the run waits for an export it triggered or joined"""
+        return self.status in (TRIGGERED, JOINED)
+
+    def pending_file_url(self):
+        """URL of the backup file of the last export if it is not downloaded yet"""
+        return self.file_url if self.status == EXPORTED else None
+
+    def is_downloaded(self, file_url, validators=None):
+        """True if file_url was already downloaded. A changed ETag means it points to another file now
+
+        :param validators: ETag and Last-Modified of file_url as returned by downloader.probe, None if unknown
+        """
+        if self.status != DOWNLOADED or self.file_url != file_url:
+            return False
+        etag = (validators or {}).get('etag')
+        return etag is None or self.data.get('etag') is None or etag == self.data['etag']
+
+    def triggered(self, task_id=None):
+        self.update(status=TRIGGERED, triggered_at=self._clock(), task_id=task_id, file_url=None, etag=None,
+                    refused_at=None, error=None)
+
+    def joined(self):
+        """Record an export that was already running when this run tried to trigger one. triggered_at is kept,
+        so the cooldown still follows the last export this client triggered"""
+        self.update(status=JOINED, joined_at=self._clock(), task_id=None, file_url=None, etag=None, error=None)
+
+    def exported(self, file_url):
+        self.update(status=EXPORTED, exported_at=self._clock(), file_url=file_url)
+
+    def downloaded(self, file_url, validators=None):
+        self.update(status=DOWNLOADED, downloaded_at=self._clock(), file_url=file_url,
+                    etag=(validators or {}).get('etag'))
+
+    def failed(self, error):
+        self.update(status=FAILED, error=error)
+
+    def refused(self):
+        """Record that the server refused to start an export"""
+        if self.next_trigger_at() is None:
+            self.update(refused_at=self._clock())
+
+    def describe(self):
+        next_time = self.next_trigger_at()
+        parts = [self.status or 'no export yet']
+        for name in ['triggered_at', 'joined_at', 'exported_at', 'downloaded_at']:
+            if self.data.get(name) is not None:
+                parts.append(f'{name[:-3]} {format_time(self.data[name])}')
+        parts.append(f'next export {format_time(next_time)}' if next_time else 'next export now')
+        return ', '.join(parts)
+
+
+def main():
+    parser = argparse.ArgumentParser('export_state')
+    parser.add_argument('folder', help='Folder with the export state files', nargs='?', default='.')
+    parser.add_argument('--next', help='Only print the earliest time a run has something to do, as a Unix time',
+                        action='store_true')
+    args = parser.parse_args()
+
+    states = [ExportState.load(path) for path in sorted(glob.glob(os.path.join(args.folder, '*' + STATE_SUFFIX)))]
+    if args.next:
+        # For timers: when the next run of any site has something to do
+        print(int(min([state.next_run_at() for state in states], default=time.time())))
+        return
+    for state in states:
+        print(f'{os.path.basename(state.path)[:-len(STATE_SUFFIX)]}: {state.describe()}')
+
+
+if __name__ == '__main__':
+    main()
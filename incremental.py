@@ -0,0 +1,264 @@
+import base64
+import json
+import logging
+import os
+import threading
+import time
+from urllib.parse import urlparse
+import dedup_store
+import polling
+import transport
+
+# Building blocks of the incremental exports, which fetch only the content that changed since the last run
+# through the REST APIs instead of waiting for a full site export.
+#
+# Offset paged listings are fetched in parallel: after the first page has shown the page size the server
+# really uses, the following pages are requested in parallel windows until a short page marks the end. Listings
+# that page with a cursor or a token are followed one page after the other. A listing that keeps returning items
+# it returned before stops with an error instead of looping, so it is never taken as complete. Changed items are
+# written to a content-addressed chunk store (see dedup_store), and an index of the ids, versions and chunk
+# keys of everything stored is kept locally so the next run can tell what changed.
+
+PAGE_SIZE = 100
+# Pages of one listing at most, a million items with the default page size
+MAX_PAGES = 10000
+DEFAULT_PARALLEL_PAGES = 4
+DEFAULT_WORKERS = 8
+# 429 answers of the REST APIs are retried after the time the server asks for
+MAX_THROTTLED_RETRIES = 5
+
+
+class RestError(Exception):
+    pass
+
+
+def get_json(session, url, params=None):
+    """GET a JSON document, waiting out rate limits"""
+    for _ in range(MAX_THROTTLED_RETRIES + 1):
+        response = session.get(url, params=params)
+        delay = polling.retry_after(response)
+        if delay is None:
+            break
+        logging.info(f'Request is throttled by the server (status {response.status_code}), '
+                     f'retrying in {delay:.0f} seconds')
+        time.sleep(delay)
+    if response.status_code != 200:
+        raise RestError(f'GET {response.url} returned {response.status_code}: {response.text[:200]}')
+    return response.json()
+
+
+def paginate(session, executor, url, params, results_key='results', offset_param='start', limit_param='limit',
+             page_size=PAGE_SIZE, parallel=DEFAULT_PARALLEL_PAGES):
+    """Return the items of all pages of an offset paged listing
+
+    :param executor: Executor the pages after the first one are fetched with
+    :param params: Query parameters of the listing without the offset and limit
+    :param results_key: Key of the item list in a page
+    :param parallel: Number of pages requested at the same time
+    """
+    first = get_json(session, url, dict(params, **{offset_param: 0, limit_param: page_size}))
+    items = list(first[results_key])
+    seen = set()
+    _check_new(url, first[results_key], seen)
+    # Servers cap the page size, sometimes lower for expanded listings. Page with the size that came back
+    page_size = min(page_size, first.get(limit_param) or page_size)
+    if len(first[results_key]) < page_size:
+        return items
+
+    offset = page_size
+    while True:
+        futures = [executor.submit(get_json, session, url,
+                                   dict(params, **{offset_param: offset + i * page_size, limit_param: page_size}))
+                   for i in range(parallel)]
+        pages = [future.result() for future in futures]
+        for page in pages:
+            # A server that ignores the offset answers with the first page again and again
+            _check_new(url, page[results_key], seen)
+            items.extend(page[results_key])
+            if len(page[results_key]) < page_size:
+                return items
+        offset += parallel * page_size
+
+
+def paginate_links(session, base_url, path, params, results_key='results', limit_param='limit',
+                   page_size=PAGE_SIZE):
+    """Return the items of all pages of a Confluence listing that pages with the cursor in _links.next, such
+    as the CQL search. These pages can only be fetched one after the other
+
+    :param base_url: Confluence base URL the next links are relative to, e.g. https://<account>.atlassian.net/wiki
+    :param path: Path of the listing below base_url
+    :param params: Query parameters of the listing without the limit
+    """
+    # The first page is asked for with an offset like every other listing, the cursor only exists after it
+    page = get_json(session, base_url + path, dict(params, **{'start': 0, limit_param: page_size}))
+    items = []
+    seen = set()
+    for _ in range(MAX_PAGES):
+        _check_new(base_url + path, page[results_key], seen)
+        items.extend(page[results_key])
+        next_link = page.get('_links', {}).get('next')
+        if not next_link or not page[results_key]:
+            return items
+        # The link keeps the query of the listing, the base of the link may not be the one the requests go to
+        page = get_json(session, base_url + next_link)
+    raise RestError(f'{base_url + path} has more than {MAX_PAGES} pages')
+
+
+def _check_new(url, page_items, seen):
+    """Raise RestError if a page only has items an earlier page of the listing already returned"""
+    ids = {item['id'] for item in page_items if 'id' in item}
+    if ids and ids <= seen:
+        raise RestError(f'{url} returns the same items again, its paging is not followed')
+    seen.update(ids)
+
+
+def paginate_token(session, url, params, results_key, token_param='nextPageToken'):
+    """Yield the items of every page of a listing that pages with a token from the previous page, one list per
+    page, so each page can be processed before the next one is fetched. Such pages can only be fetched one
+    after the other; parallelize over several listings instead"""
+    params = dict(params)
+    seen = set()
+    while True:
+        page = get_json(session, url, params)
+        _check_new(url, page[results_key], seen)
+        yield page[results_key]
+        if page.get('isLast', True) or not page.get(token_param):
+            return
+        params[token_param] = page[token_param]
+
+
+def fixed_size(blocks, size=dedup_store.FIXED_CHUNK_SIZE):
+    """Cut an iterable of byte blocks into chunks of exactly size bytes, the last one may be shorter"""
+    buffer = bytearray()
+    for block in blocks:
+        buffer += block
+        while len(buffer) >= size:
+            yield bytes(buffer[:size])
+            del buffer[:size]
+    if buffer:
+        yield bytes(buffer)
+
+
+def store_document(store, document):
+    """Store a JSON document and return (chunk keys, Ingest)"""
+    stats = dedup_store.Ingest(store)
+    data = json.dumps(document, sort_keys=True, separators=(',', ':')).encode('UTF-8')
+    # Large pages are cut by content, so an edit only stores the chunks around it again
+    return stats.add(dedup_store.cdc_chunks([data]), compress=True), stats
+
+
+def store_download(session, url, store):
+    """Download url into the store and return (chunk keys, Ingest). A download that breaks off is started
+    again, with the retries of the session"""
+    retry = transport.body_retry(session, url)
+    while True:
+        stats = dedup_store.Ingest(store)
+        with session.get(url, stream=True) as response:
+            if response.status_code != 200:
+                raise RestError(f'GET {url} returned {response.status_code}')
+            try:
+                keys = stats.add(fixed_size(response.iter_content(dedup_store.READ_SIZE)), compress=False)
+                return keys, stats
+            except transport.STREAM_ERRORS as e:
+                error = e
+        retry = transport.retry_body(retry, 'GET', url, error)
+
+
+def read_item(store, keys):
+    """Return the bytes of an item stored with store_document or store_download"""
+    return b''.join(dedup_store.read_chunk(store, key) for key in keys)
+
+
+class Index(object):
+    """Ids, versions and chunk keys of the stored items of one site, saved as a JSON file"""
+
+    def __init__(self, path, data=None):
+        self.path = path
+        self.data = data or {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        if not os.path.isfile(path):
+            return cls(path)
+        with open(path, 'r', encoding='UTF-8') as f:
+            return cls(path, json.load(f))
+
+    def section(self, name):
+        return self.data.setdefault(name, {})
+
+    def set(self, section, key, value):
+        with self._lock:
+            self.section(section)[key] = value
+
+    def entries(self, section):
+        """Copy of a section that stays consistent while other threads update the index"""
+        with self._lock:
+            return dict(self.section(section))
+
+    def remove(self, section, keys):
+        with self._lock:
+            for key in keys:
+                self.section(section).pop(key, None)
+
+    def save(self):
+        # Write to a temporary file first so a crash never leaves a half-written index
+        temp_path = self.path + '.tmp'
+        with self._lock, open(temp_path, 'w', encoding='UTF-8') as f:
+            json.dump(self.data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+
+
+class Totals(object):
+    """Adds up the Ingest counts of the parallel fetches"""
+
+    def __init__(self):
+        self.items = 0
+        self.total_bytes = 0
+        self.stored_bytes = 0
+        self._lock = threading.Lock()
+
+    def add(self, stats):
+        with self._lock:
+            self.items += 1
+            self.total_bytes += stats.total_bytes
+            self.stored_bytes += stats.stored_bytes
+
+
+def record_responses(session):
+    """Record every response of session, for replaying them with local_server.serve_recorded
+
+    :return: The list the recorded responses are appended to
+    """
+    recording = []
+    lock = threading.Lock()
+
+    def hook(response, *args, **kwargs):
+        parsed = urlparse(response.url)
+        entry = {
+            'method': response.request.method,
+            'path': parsed.path + ('?' + parsed.query if parsed.query else ''),
+            'status': response.status_code,
+            'content_type': response.headers.get('Content-Type'),
+        }
+        # Reading the content here keeps it available to the caller, also for streamed responses. JSON is
+        # kept readable, so recordings can be edited by hand
+        try:
+            if 'json' not in (entry['content_type'] or ''):
+                raise ValueError()
+            entry['json'] = json.loads(response.content)
+        except ValueError:
+            entry['body_base64'] = base64.b64encode(response.content).decode('ascii')
+        with lock:
+            recording.append(entry)
+
+    session.hooks['response'].append(hook)
+    return recording
+
+
+def save_recording(recording, path):
+    with open(path, 'w', encoding='UTF-8') as f:
+        json.dump(recording, f, indent=1)
+    logging.info(f'{len(recording)} responses are recorded to {path}')
@@ -0,0 +1,281 @@
+import base64
+import hashlib
+import json
+import logging
+import struct
+import threading
+
+# Integrity checks computed while the backup file is downloaded, so the file is not read a second time.
+#
+# OrderedHasher accepts the downloaded chunks in any order, as they come from the parallel segment workers,
+# and hashes them in file order. Chunks that arrive ahead of the hashed position are kept in memory until
+# the gap before them is filled, up to MAX_PENDING bytes. A slow or retried segment can hold back the hashed
+# position for a long time, so further chunks are read back from the downloaded file when they are reached,
+# usually from the page cache. Besides the SHA-256 of the whole file it computes the SHA-256 of every S3 part,
+# which gives the composite checksum S3 reports for multipart uploads. The end of the file is kept to validate
+# the zip central directory.
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# Part size of S3 uploads, s3_operations.PART_SIZE. The hasher needs it for the composite checksum
+DEFAULT_PART_SIZE = 16 * 1024 * 1024
+# Bytes of out of order chunks kept in memory
+MAX_PENDING = 64 * 1024 * 1024
+TAIL_SIZE = 1024 * 1024
+READ_SIZE = 1024 * 1024
+MANIFEST_SUFFIX = '.manifest.json'
+
+
+def optional_hashers():
+    """Hashers of the optional algorithms that are installed"""
+    hashers = {}
+    if blake3 is not None:
+        hashers['blake3'] = blake3.blake3()
+    if xxhash is not None:
+        hashers['xxh3_128'] = xxhash.xxh3_128()
+    return hashers
+
+
+def composite_checksum(part_digests, multipart=None):
+    """S3 style checksum of a multipart upload: SHA-256 of the part digests, base64 encoded, with the part
+    count. An object uploaded in one request has the plain SHA-256 of the object
+
+    :param multipart: True if the object is uploaded as a multipart upload, which has the composite form even
+                      with a single part. If None, only an upload of more than one part is taken as multipart
+    """
+    if multipart is None:
+        multipart = len(part_digests) > 1
+    if not multipart:
+        return base64.b64encode(part_digests[0]).decode('ascii')
+    combined = hashlib.sha256(b''.join(part_digests)).digest()
+    return f'{base64.b64encode(combined).decode("ascii")}-{len(part_digests)}'
+
+
+def checksums_match(expected, reported):
+    """Compare our composite checksum with the one reported by S3. Some S3 compatible stores leave out the
+    part count suffix, so it is only compared when both have it"""
+    if expected is None or reported is None:
+        return False
+    if '-' in expected and '-' in reported:
+        return expected == reported
+    return expected.split('-', 1)[0] == reported.split('-', 1)[0]
+
+
+class OrderedHasher(object):
+
+    def __init__(self, part_size=DEFAULT_PART_SIZE, part_size_for_total=None, multipart_for_total=None,
+                 max_pending=MAX_PENDING):
+        """
+        :param part_size: Size of the S3 parts to compute the composite checksum for
+        :param part_size_for_total: Optional function that returns the part size for the total file size, in
+                                    case the uploader makes the parts larger for large files
+        :param multipart_for_total: Optional function that returns True if a file of the total size is uploaded
+                                    as a multipart upload. Without it only more than one part counts as multipart
+        :param max_pending: Bytes of out of order chunks kept in memory, see spill_to
+        """
+        self._part_size_for_total = part_size_for_total
+        self._multipart_for_total = multipart_for_total
+        self._lock = threading.Lock()
+        self._position = 0
+        self._pending = {}
+        self._pending_bytes = 0
+        self._max_pending = max_pending
+        # Ranges that are already on disk, from an earlier, interrupted download or spilled chunks
+        self._on_disk = {}
+        # Start of the spilled range that ends right before the key, to extend it with the next chunk
+        self._spilled_ends = {}
+        self._path = None
+        self._spill = False
+        self._sha256 = hashlib.sha256()
+        self._optional = optional_hashers()
+        self._part_size = part_size
+        self._part = hashlib.sha256()
+        self._part_fill = 0
+        self._part_digests = []
+        self._tail = bytearray()
+
+    def set_total_size(self, total_size):
+        """Called once the file size is known, before any data is added"""
+        if self._part_size_for_total is not None and total_size:
+            with self._lock:
+                if self._position:
+                    raise ValueError('The part size cannot change after hashing has started')
+                self._part_size = self._part_size_for_total(total_size)
+
+    def spill_to(self, path):
+        """Read chunks back from path instead of keeping them in memory once more than max_pending bytes are
+        waiting. The caller must write every chunk to path before it passes it to update. Without it all out of
+        order chunks are kept in memory"""
+        with self._lock:
+            self._path = path
+            self._spill = True
+
+    def add_existing(self, path, start, end):
+        """Hash the inclusive range start-end from path when it is reached instead of waiting for it"""
+        with self._lock:
+            self._path = path
+            self._on_disk[start] = end
+            self._drain()
+
+    def update(self, offset, data):
+        """Add data that belongs at offset of the file. Safe to call from several threads"""
+        with self._lock:
+            if offset != self._position and self._spill and self._pending_bytes + len(data) > self._max_pending:
+                # Extend the spilled range this chunk continues, so it is read back in one go
+                start = self._spilled_ends.pop(offset, offset)
+                self._on_disk[start] = offset + len(data) - 1
+                self._spilled_ends[offset + len(data)] = start
+                return
+            if offset != self._position:
+                self._pending[offset] = bytes(data)
+                self._pending_bytes += len(data)
+                return
+            self._consume(data)
+            self._drain()
+
+    def _drain(self):
+        while True:
+            if self._position in self._pending:
+                data = self._pending.pop(self._position)
+                self._pending_bytes -= len(data)
+                self._consume(data)
+            elif self._position in self._on_disk:
+                end = self._on_disk.pop(self._position)
+                self._spilled_ends.pop(end + 1, None)
+                with open(self._path, 'rb') as f:
+                    f.seek(self._position)
+                    remaining = end - self._position + 1
+                    while remaining > 0:
+                        block = f.read(min(READ_SIZE, remaining))
+                        if not block:
+                            raise IOError(f'{self._path} is shorter than expected')
+                        remaining -= len(block)
+                        self._consume(block)
+            else:
+                return
+
+    def _consume(self, data):
+        self._sha256.update(data)
+        for hasher in self._optional.values():
+            hasher.update(data)
+
+        view = memoryview(data)
+        while view:
+            take = min(self._part_size - self._part_fill, len(view))
+            self._part.update(view[:take])
+            self._part_fill += take
+            view = view[take:]
+            if self._part_fill == self._part_size:
+                self._part_digests.append(self._part.digest())
+                self._part = hashlib.sha256()
+                self._part_fill = 0
+
+        self._tail += data
+        if len(self._tail) > TAIL_SIZE:
+            del self._tail[:len(self._tail) - TAIL_SIZE]
+        self._position += len(data)
+
+    @property
+    def position(self):
+        """Number of bytes hashed so far"""
+        return self._position
+
+    def finish(self):
+        """Return the digests once every byte of the file has been hashed"""
+        with self._lock:
+            if self._pending or self._on_disk:
+                raise IOError(f'Gap in the hashed data at byte {self._position}')
+            part_digests = list(self._part_digests)
+            if self._part_fill or not part_digests:
+                part_digests.append(self._part.digest())
+            multipart = self._multipart_for_total(self._position) if self._multipart_for_total else None
+            digests = {'sha256': self._sha256.hexdigest()}
+            digests.update({name: hasher.hexdigest() for name, hasher in self._optional.items()})
+            return {
+                'size': self._position,
+                'digests': digests,
+                'part_size': self._part_size,
+                'part_sha256': [digest.hex() for digest in part_digests],
+                's3_checksum_sha256': composite_checksum(part_digests, multipart),
+            }
+
+    @property
+    def tail(self):
+        with self._lock:
+            return bytes(self._tail)
+
+
+def validate_zip(tail, size, path=None):
+    """Check the end of central directory record and the central directory of a zip file
+
+    :param tail: The last bytes of the file
+    :param size: Total size of the file
+    :param path: File to read the central directory from if it is larger than tail
+    :return: Dict with 'valid', 'entries' and 'error'
+    """
+    tail_start = size - len(tail)
+
+    def read(offset, length):
+        if offset >= tail_start:
+            return tail[offset - tail_start:offset - tail_start + length]
+        if path is None:
+            raise ValueError('Central directory is outside of the kept tail')
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    try:
+        eocd = tail.rfind(b'PK\x05\x06')
+        if eocd < 0 or len(tail) - eocd < 22:
+            raise ValueError('End of central directory record not found')
+        entries, cd_size, cd_offset = struct.unpack('<HII', tail[eocd + 10:eocd + 20])
+
+        if entries == 0xFFFF or cd_size == 0xFFFFFFFF or cd_offset == 0xFFFFFFFF:
+            # Zip64: the locator right before the record points to the zip64 end of central directory
+            locator = tail[eocd - 20:eocd]
+            if len(locator) != 20 or locator[:4] != b'PK\x06\x07':
+                raise ValueError('Zip64 end of central directory locator not found')
+            record_offset = struct.unpack('<Q', locator[8:16])[0]
+            record = read(record_offset, 56)
+            if record[:4] != b'PK\x06\x06':
+                raise ValueError('Zip64 end of central directory record not found')
+            entries, cd_size, cd_offset = struct.unpack('<QQQ', record[32:56])
+
+        if cd_offset + cd_size > size:
+            raise ValueError('Central directory points beyond the end of the file')
+
+        directory = read(cd_offset, cd_size)
+        position = 0
+        for _ in range(entries):
+            header = directory[position:position + 46]
+            if len(header) != 46 or header[:4] != b'PK\x01\x02':
+                raise ValueError(f'Broken central directory entry at byte {cd_offset + position}')
+            name_length, extra_length, comment_length = struct.unpack('<HHH', header[28:34])
+            local_offset = struct.unpack('<I', header[42:46])[0]
+            # 0xFFFFFFFF means the offset is in the zip64 extra field
+            if local_offset != 0xFFFFFFFF and local_offset >= cd_offset:
+                raise ValueError('Entry points beyond the start of the central directory')
+            position += 46 + name_length + extra_length + comment_length
+        if position != cd_size:
+            raise ValueError('Central directory size does not match its entries')
+    except (ValueError, struct.error) as e:
+        return {'valid': False, 'entries': None, 'error': str(e)}
+
+    return {'valid': True, 'entries': entries, 'error': None}
+
+
+def write_manifest(full_path, manifest):
+    """Save the manifest next to the backup file and return its path"""
+    manifest_path = full_path + MANIFEST_SUFFIX
+    with open(manifest_path, 'w', encoding='UTF-8') as mf:
+        json.dump(manifest, mf, indent=2)
+    logging.info(f'Integrity manifest is saved to {manifest_path}')
+    return manifest_path
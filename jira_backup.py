@@ -19,10 +19,12 @@
 #                           Cleaned-up code
 
 import traceback
-import time
-import re
 import logging
+import export_state
+import metrics
 import operations
+import polling
+import progress_models
 
 # Atlassian imposes a restriction on the initiation of a backup process whereas
 # a new process can be initiated after 24 hours
@@ -32,9 +34,10 @@ FILE_LAST_BACKUP_URL = 'last_backup_file_url_jira.txt'
 PROGRAM_NAME = 'jira'
 
 
-def jira_backup(account, attachments, session):
+def jira_backup(account, attachments, session, url_file=FILE_LAST_BACKUP_URL, poller=None, run_metrics=None,
+                state=None, base_url=None):
     # Create the full base url for the JIRA instance using the account name.
-    url = 'https://' + account + '.atlassian.net'
+    url = (base_url or 'https://' + account + '.atlassian.net').rstrip('/')
 
     # Set json data to determine if backup to include attachments.
     json = b'{"cbAttachments": "false", "exportToCloud": "true"}'
@@ -42,91 +45,125 @@ def jira_backup(account, attachments, session):
         json = b'{"cbAttachments": "true", "exportToCloud": "true"}'
 
     error = 'error'
-    # Start backup
-    try:
-        backup_response = session.post(url + '/rest/backup/1/export/runbackup', data=json)
+    run_metrics = run_metrics or metrics.RunMetrics(account, PROGRAM_NAME)
+    # Continue with the export of a run that stopped while it was waiting for it
+    resume = state is not None and state.resumable()
+    if resume:
+        started = state.data['joined_at' if state.status == export_state.JOINED else 'triggered_at']
+        logging.info(f'Resuming the progress checks of the export {state.status} at '
+                     f'{export_state.format_time(started)}')
+    elif state is not None and state.next_trigger_at() is not None:
+        logging.info(f'No new export can be started before {export_state.format_time(state.next_trigger_at())}')
+        return state.pending_file_url()
 
-        if backup_response.status_code == 200 and error.casefold() not in backup_response.text:
-            logging.info('Authentication is successful. Backup is starting...')
-        # If we hit the backup init restriction, server returns 406
-        elif backup_response.status_code == 406:
-            file_url = operations.get_backup_file_url(FILE_LAST_BACKUP_URL)
-            # Can return None here if file does not exist
-            return file_url
-        # If there is another backup process running, server returns 412
-        elif backup_response.status_code == 412:
-            logging.info('Another backup is in progress')
-        else:
-            logging.error('Backup could not start. Response code: ' + str(backup_response.status_code))
+    # Start backup
+    if not resume:
+        try:
+            with run_metrics.phase('trigger'):
+                backup_response = session.post(url + '/rest/backup/1/export/runbackup', data=json)
+
+            if backup_response.status_code == 200 and error.casefold() not in backup_response.text:
+                logging.info('Authentication is successful. Backup is starting...')
+                if state is not None:
+                    state.triggered()
+            # If we hit the backup init restriction, server returns 406
+            elif backup_response.status_code == 406:
+                if state is not None:
+                    state.refused()
+                file_url = operations.get_backup_file_url(url_file)
+                # Can return None here if file does not exist
+                return file_url
+            # If there is another backup process running, server returns 412
+            elif backup_response.status_code == 412:
+                logging.info('Another backup is in progress, waiting for it')
+                if state is not None:
+                    state.joined()
+            else:
+                logging.error('Backup could not start. Response code: ' + str(backup_response.status_code))
+                logging.error('Response from server: ' + backup_response.text)
+        except AttributeError:
+            logging.error('Backup could not start (AttributeError)')
             logging.error('Response from server: ' + backup_response.text)
-    except AttributeError:
-        logging.error('Backup could not start (AttributeError)')
-        logging.error('Response from server: ' + backup_response.text)
-        exit(1)
-    except Exception:
-        logging.error('Backup could not start')
-        logging.error(traceback.format_exc())
-        exit(1)
+            exit(1)
+        except Exception:
+            logging.error('Backup could not start')
+            logging.error(traceback.format_exc())
+            exit(1)
 
     # Get task ID of backup.
-    task_req = session.get(url + '/rest/backup/1/export/lastTaskId')
-    task_id = task_req.text
+    task_id = state.task_id if resume else None
+    if task_id is None:
+        with run_metrics.phase('trigger'):
+            task_req = session.get(url + '/rest/backup/1/export/lastTaskId')
+        task_id = task_req.text
+        if state is not None and state.waiting:
+            state.update(task_id=task_id)
 
     # set starting task progress values outside of while loop and if statements.
     task_progress = 0
     last_progress = -1
-    sleep_timer = 10
-    counter = 0
     progress_response = None
+    progress = None
+    poller = poller or polling.Poller()
 
     # Get progress and print update until complete
-    while task_progress < 100:
-        logging.debug('Monitoring the progress')
-        progress_response = session.get(url + '/rest/backup/1/export/getProgress?taskId=' + task_id)
-
-        # Chop just progress update from JSON response
-        try:
-            task_progress = int(re.search('(?<=progress":)(.*?)(?=,)', progress_response.text).group(1))
-            progress_message = re.search('(?<=message":)(.*?)(?=,)', progress_response.text).group(1)
-            logging.info('Progress message: ' + progress_message)
-        except AttributeError:
-            logging.error('Backup could not start (AttributeError)')
-            logging.error('Response from server: ' + progress_response.text)
-            exit(1)
-
-        if (last_progress != task_progress) and error.casefold() not in progress_response.text:
-            logging.info(f'Progress: {task_progress}%')
-            last_progress = task_progress
-            counter = 0
-            sleep_timer = 10
-        elif error.casefold() in progress_response.text:
-            logging.error('Error encountered in response')
-            logging.error('Response from server: ' + progress_response.text)
-            exit(1)
-
-        # Gradually increase the task progress check interval if the percentage does not change
-        counter += 1
-        if counter == 3:
-            sleep_timer = 20
-        elif counter == 4:
-            sleep_timer = 30
-        elif counter == 6:
-            sleep_timer = 60
-
-        if task_progress < 100:
-            time.sleep(sleep_timer)
-
-    file_name = re.search('(?<=result":")(.*?)(?=\",)', progress_response.text).group(1)
-    file_url = url + '/plugins/servlet/' + file_name
+    with run_metrics.phase('export_wait'):
+        while task_progress < 100:
+            logging.debug('Monitoring the progress')
+            progress_response = session.get(url + '/rest/backup/1/export/getProgress?taskId=' + task_id)
+
+            # Rate limited, try again when the server allows it
+            if polling.retry_after(progress_response) is not None:
+                logging.info(f'Progress check is throttled by the server (status {progress_response.status_code})')
+                operations.wait_for_next_poll(poller, progress_response)
+                continue
+
+            # Decode the progress response once and take the values from it
+            progress = progress_models.JiraProgress.parse(progress_response.text)
+            if not progress.is_valid:
+                logging.error('Progress is missing in the response')
+                logging.error('Response from server: ' + progress_response.text)
+                if state is not None:
+                    state.failed('Progress is missing in the response')
+                exit(1)
+            task_progress = progress.progress
+            logging.info(f'Progress message: {progress.message}')
+
+            if (last_progress != task_progress) and not progress.has_error:
+                logging.info(f'Progress: {task_progress}%')
+                last_progress = task_progress
+            elif progress.has_error:
+                logging.error('Error encountered in response')
+                logging.error('Response from server: ' + progress_response.text)
+                if state is not None:
+                    state.failed(progress.message)
+                exit(1)
+
+            # The check interval follows the estimated remaining time of the export
+            poller.observe(task_progress)
+            if task_progress < 100:
+                operations.wait_for_next_poll(poller, progress_response)
+    run_metrics.count('polls', poller.polls)
+
+    if not progress.result:
+        logging.error('Backup is finished but the response has no file name')
+        logging.error('Response from server: ' + progress_response.text)
+        if state is not None:
+            state.failed('The response has no file name')
+        exit(1)
+    file_url = url + '/plugins/servlet/' + progress.result
+    if state is not None:
+        state.exported(file_url)
 
-    operations.save_backup_file_url(FILE_LAST_BACKUP_URL, file_url)
+    operations.save_backup_file_url(url_file, file_url)
     logging.info('Backup file can also be downloaded from ' + file_url)
 
     return file_url
 
 
 def main():
-    site, user_name, api_token, attachments, folder, download_only, s3_bucket = operations.parse_arguments(PROGRAM_NAME)
+    site, user_name, api_token, attachments, folder, download_only, s3_bucket, options = \
+        operations.parse_arguments(PROGRAM_NAME)
 
     logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s',
                         level=logging.INFO,
@@ -137,23 +174,47 @@ def main():
                         ])
 
     # Get a session
-    session = operations.get_session(user_name, api_token)
-
-    if download_only:
-        logging.info('Download only option is used')
-        file_url = operations.get_backup_file_url(FILE_LAST_BACKUP_URL)
-    else:
-        file_url = jira_backup(site, folder, session)
-
-    successful = False
-    if file_url is not None:
-        logging.info('Backup complete, downloading file to ' + folder)
-        successful = operations.download_backup_and_upload_to_s3(file_url, folder, session, PROGRAM_NAME, s3_bucket)
+    # Leave room for the progress checks next to the parallel downloads
+    session = operations.get_session(user_name, api_token, options['workers'] + 2)
+    run_metrics = metrics.RunMetrics(site, PROGRAM_NAME)
+    options['metrics'] = run_metrics
+
+    # Runs for the same site wait for the export together, so only one of them may work on it
+    state = export_state.ExportState.load(export_state.state_file(site, PROGRAM_NAME))
+    if not state.acquire():
+        logging.info(f'Another backup of {site} is running, see {state.path}')
+        return
+    options['export_state'] = state
+
+    # The export functions call exit() on errors, the site is released for the next run in any case
+    try:
+        if download_only:
+            logging.info('Download only option is used')
+            file_url = operations.get_backup_file_url(FILE_LAST_BACKUP_URL)
+        else:
+            file_url = jira_backup(site, folder, session,
+                                   poller=polling.Poller(max_wait=options['max_wait'] * 3600), run_metrics=run_metrics,
+                                   state=state, base_url=options['base_url'])
+
+        successful = False
+        if file_url is not None:
+            logging.info('Backup complete, downloading file to ' + folder)
+            successful = operations.download_backup_and_upload_to_s3(file_url, folder, session, PROGRAM_NAME, s3_bucket,
+                                                                       options)
+        elif state.status == export_state.DOWNLOADED:
+            logging.info('The backup file of the last export is already downloaded')
+            successful = True
+    finally:
+        state.release()
+
+    session.transport_stats.log()
+    operations.report_run(run_metrics, session, successful, options['metrics_dir'])
 
     if successful:
         logging.info('Backup job is finished successfully')
     else:
         logging.info('Backup job finished with errors. See the logs.')
+        exit(1)
 
 
 if __name__ == '__main__':
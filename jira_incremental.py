@@ -0,0 +1,329 @@
+import argparse
+import json
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+import dedup_store
+import incremental
+import metrics
+import operations
+
+# Incremental Jira backup between the daily site exports. Every run asks the JQL search for the issues that
+# were updated since the previous run and stores the new versions of them, and their new attachments, in a
+# content-addressed chunk store.
+#
+# The search pages with a token, so the pages of one search are fetched one after the other; the projects
+# are searched in parallel instead. The time window is given relative to now (updated >= -Nm), which avoids
+# converting timestamps to the time zone of the user that JQL dates are read in. The window overlaps the
+# previous run by a few minutes, issues that come back unchanged are recognized by their updated timestamp.
+# Deleted issues are not noticed, the daily site export keeps covering them.
+#
+# The index is an SQLite database with one row per issue and per attachment, which stays small and quick
+# to update for sites with hundreds of thousands of issues. Each run saves the issues and attachments it
+# stored as a manifest of the store.
+
+PROGRAM_NAME = 'jira_incremental'
+SEARCH_PAGE_SIZE = 100
+# Fields stored for every issue. The attachment, project and updated fields are needed by the backup itself
+DEFAULT_FIELDS = '*all'
+REQUIRED_FIELDS = ['attachment', 'project', 'updated']
+OVERLAP_MINUTES = 5
+
+
+def index_file(folder, site):
+    return os.path.join(folder, f'jira_index_{site}.sqlite')
+
+
+class JiraIndex(object):
+    """Issue and attachment versions and chunk keys of one site in an SQLite database"""
+
+    def __init__(self, path):
+        self.path = path
+        # The connection is shared by the worker threads, the lock serializes its use
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.executescript('''
+                CREATE TABLE IF NOT EXISTS issues (
+                    id TEXT PRIMARY KEY, key TEXT NOT NULL, project TEXT NOT NULL, updated TEXT NOT NULL,
+                    chunks TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS attachments (
+                    id TEXT PRIMARY KEY, issue_id TEXT NOT NULL, filename TEXT NOT NULL, size INTEGER,
+                    chunks TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT);
+            ''')
+
+    def updated(self, issue_ids):
+        """Return a dict of issue id to the updated timestamp stored for it"""
+        with self._lock:
+            found = {}
+            ids = list(issue_ids)
+            # Stay below the SQLite limit of query parameters
+            for start in range(0, len(ids), 500):
+                batch = ids[start:start + 500]
+                rows = self._connection.execute(
+                    f'SELECT id, updated FROM issues WHERE id IN ({",".join("?" * len(batch))})', batch)
+                found.update(rows)
+            return found
+
+    def known_attachments(self, attachment_ids):
+        with self._lock:
+            ids = list(attachment_ids)
+            found = set()
+            for start in range(0, len(ids), 500):
+                batch = ids[start:start + 500]
+                rows = self._connection.execute(
+                    f'SELECT id FROM attachments WHERE id IN ({",".join("?" * len(batch))})', batch)
+                found.update(row[0] for row in rows)
+            return found
+
+    def put_issues(self, rows):
+        """Insert or replace (id, key, project, updated, chunk keys) rows"""
+        with self._lock, self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO issues VALUES (?, ?, ?, ?, ?)',
+                                         [(i, k, p, u, json.dumps(c)) for i, k, p, u, c in rows])
+
+    def put_attachment(self, attachment_id, issue_id, filename, size, chunks):
+        with self._lock, self._connection:
+            self._connection.execute('INSERT OR REPLACE INTO attachments VALUES (?, ?, ?, ?, ?)',
+                                     (attachment_id, issue_id, filename, size, json.dumps(chunks)))
+
+    def get_meta(self, name):
+        with self._lock:
+            row = self._connection.execute('SELECT value FROM meta WHERE name = ?', (name,)).fetchone()
+            return row[0] if row else None
+
+    def set_meta(self, name, value):
+        with self._lock, self._connection:
+            self._connection.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (name, value))
+
+    def counts(self):
+        with self._lock:
+            return (self._connection.execute('SELECT COUNT(*) FROM issues').fetchone()[0],
+                    self._connection.execute('SELECT COUNT(*) FROM attachments').fetchone()[0])
+
+    def items(self):
+        """Yield (kind, id, chunk keys) of everything in the index"""
+        with self._lock:
+            rows = self._connection.execute("SELECT 'issue', id, chunks FROM issues UNION ALL "
+                                            "SELECT 'attachment', id, chunks FROM attachments").fetchall()
+        for kind, item_id, chunks in rows:
+            yield kind, item_id, json.loads(chunks)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class JiraIncremental(object):
+
+    def __init__(self, base_url, session, store, index, workers=incremental.DEFAULT_WORKERS,
+                 fields=DEFAULT_FIELDS, run_metrics=None, clock=time.time):
+        """
+        :param base_url: Jira base URL, e.g. https://<account>.atlassian.net
+        :param session: Authenticated session, see operations.get_session
+        :param store: dedup_store chunk store for the issues and attachments
+        :param index: JiraIndex of the previous runs
+        :param workers: Number of projects searched and attachments fetched in parallel
+        :param fields: Comma separated issue fields to store, *all for all of them
+        :param clock: Function returning the current time in seconds, replaceable for replayed runs
+        """
+        self._url = base_url.rstrip('/')
+        self._session = session
+        self._store = store
+        self._index = index
+        self._workers = workers
+        requested = fields.split(',')
+        self._fields = ','.join(requested + [f for f in REQUIRED_FIELDS if f not in requested and
+                                             '*all' not in requested])
+        self._metrics = run_metrics or metrics.RunMetrics(None, PROGRAM_NAME)
+        self._clock = clock
+        self.totals = incremental.Totals()
+        self.failed = 0
+        # Issues and attachments stored in this run, saved as the manifest of the run
+        self.stored = {'issues': {}, 'attachments': {}}
+        self._stored_lock = threading.Lock()
+
+    def list_projects(self, executor):
+        return incremental.paginate(self._session, executor, self._url + '/rest/api/3/project/search', {},
+                                    results_key='values', offset_param='startAt', limit_param='maxResults')
+
+    def since_minutes(self):
+        """Length of the search window in minutes, None on the first run"""
+        last_run = self._index.get_meta('last_run_started')
+        if last_run is None:
+            return None
+        return math.ceil((self._clock() - float(last_run)) / 60) + OVERLAP_MINUTES
+
+    def search(self, project_key, since_minutes):
+        """Yield the issues of a project updated in the window, one list per search page"""
+        jql = f'project = "{project_key}"'
+        if since_minutes is not None:
+            jql += f' AND updated >= -{since_minutes}m'
+        return incremental.paginate_token(self._session, self._url + '/rest/api/3/search/jql',
+                                          {'jql': jql + ' ORDER BY key ASC', 'fields': self._fields,
+                                           'maxResults': SEARCH_PAGE_SIZE}, 'issues')
+
+    def sync_project(self, project_key, since_minutes, attachment_pool):
+        """Store the changed issues of a project and queue their new attachments, one search page at a time
+
+        :return: List of (attachment, future) of the queued attachment downloads
+        """
+        downloads = []
+        total = 0
+        changed_count = 0
+        for issues in self.search(project_key, since_minutes):
+            total += len(issues)
+            known = self._index.updated(issue['id'] for issue in issues)
+            changed = [issue for issue in issues if known.get(issue['id']) != issue['fields']['updated']]
+            changed_count += len(changed)
+
+            rows = []
+            for issue in changed:
+                keys, stats = incremental.store_document(self._store, issue)
+                self.totals.add(stats)
+                rows.append((issue['id'], issue['key'], project_key, issue['fields']['updated'], keys))
+                with self._stored_lock:
+                    self.stored['issues'][issue['id']] = {'key': issue['key'],
+                                                          'updated': issue['fields']['updated'], 'chunks': keys}
+            self._index.put_issues(rows)
+
+            # Attachments never change, a new upload gets a new id. The attachments of unchanged issues are
+            # checked too, in case one of them could not be fetched in the previous run
+            attachments = [(issue['id'], attachment) for issue in issues
+                           for attachment in issue['fields'].get('attachment') or []]
+            stored_attachments = self._index.known_attachments(attachment['id'] for _, attachment in attachments)
+            downloads += [(attachment, attachment_pool.submit(self.fetch_attachment, issue_id, attachment))
+                          for issue_id, attachment in attachments if attachment['id'] not in stored_attachments]
+
+        logging.info(f'Project {project_key}: {changed_count} of {total} issues changed, '
+                     f'{len(downloads)} new attachments')
+        self._metrics.count('unchanged_items', total - changed_count)
+        return downloads
+
+    def fetch_attachment(self, issue_id, attachment):
+        # Build the URL from the base URL, the content link of the response names the production host
+        keys, stats = incremental.store_download(
+            self._session, f'{self._url}/rest/api/3/attachment/content/{attachment["id"]}', self._store)
+        self.totals.add(stats)
+        self._index.put_attachment(attachment['id'], issue_id, attachment['filename'], stats.total_bytes, keys)
+        with self._stored_lock:
+            self.stored['attachments'][attachment['id']] = {'issue_id': issue_id,
+                                                            'filename': attachment['filename'], 'chunks': keys}
+
+    def run(self, project_keys=None):
+        """Store the issues updated since the last run and return True if all of them could be stored"""
+        started = self._clock()
+        since_minutes = self.since_minutes()
+        logging.info('First run, storing all issues' if since_minutes is None else
+                     f'Storing the issues updated in the last {since_minutes} minutes')
+
+        with ThreadPoolExecutor(max_workers=self._workers) as projects_pool, \
+                ThreadPoolExecutor(max_workers=self._workers) as attachment_pool:
+            with self._metrics.phase('list'):
+                projects = [project['key'] for project in self.list_projects(projects_pool)
+                            if not project_keys or project['key'] in project_keys]
+
+            with self._metrics.phase('fetch'):
+                searches = [(key, projects_pool.submit(self.sync_project, key, since_minutes, attachment_pool))
+                            for key in projects]
+                downloads = []
+                for key, future in searches:
+                    try:
+                        downloads += future.result()
+                    except Exception:
+                        logging.error(f'Cannot back up the issues of project {key}')
+                        logging.error(traceback.format_exc())
+                        self.failed += 1
+                for attachment, future in downloads:
+                    try:
+                        future.result()
+                    except Exception:
+                        # The attachment is not in the index, so the issue is fetched again in the next run
+                        logging.error(f'Cannot fetch attachment {attachment["id"]} ({attachment["filename"]})')
+                        logging.error(traceback.format_exc())
+                        self.failed += 1
+
+        if self.failed == 0:
+            # Only move the window forward when nothing is missing, otherwise the next run repeats this one
+            self._index.set_meta('last_run_started', repr(started))
+
+        self._metrics.count('changed_items', self.totals.items)
+        self._metrics.count('failed_items', self.failed)
+        self._metrics.count('download_bytes', self.totals.total_bytes)
+        self._metrics.count('stored_bytes', self.totals.stored_bytes)
+        return self.failed == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(PROGRAM_NAME)
+    parser.add_argument('-s', '--site', help='Site name <account>.atlassian.net', required=True)
+    parser.add_argument('-u', '--user', help='An Atlassian account email address with admin rights',
+                        required=True)
+    parser.add_argument('-t', '--token', help='API token of the Atlassian account', required=True)
+    parser.add_argument('-f', '--folder', help='Folder of the local index, and of the store if --store is omitted',
+                        required=True)
+    parser.add_argument('--store', help='Chunk store for the issues. Either a local directory or '
+                                        's3://bucket/prefix. Defaults to a store directory in the folder')
+    parser.add_argument('--projects', help='Comma separated keys of the projects to back up, all if omitted')
+    parser.add_argument('--fields', help='Comma separated issue fields to store', default=DEFAULT_FIELDS)
+    parser.add_argument('-w', '--workers', help='Number of projects searched and attachments fetched in parallel',
+                        type=int, default=incremental.DEFAULT_WORKERS)
+    parser.add_argument('--base-url', help='Jira URL to use instead of https://<site>.atlassian.net, e.g. a local '
+                                           'stand-in server')
+    parser.add_argument('--record', help='Save all responses to this file, to replay them with local_server.py')
+    parser.add_argument('--metrics-dir', help='Folder to save a JSON report and a Prometheus textfile of the run to')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s',
+                        level=logging.INFO,
+                        encoding='utf-8',
+                        handlers=[
+                            logging.FileHandler(PROGRAM_NAME + '.log'),
+                            logging.StreamHandler()
+                        ])
+
+    os.makedirs(args.folder, exist_ok=True)
+    # Every worker may hold a search and an attachment connection at the same time
+    session = operations.get_session(args.user, args.token, 2 * args.workers)
+    recording = incremental.record_responses(session) if args.record else None
+    store = dedup_store.open_store(args.store or os.path.join(args.folder, 'store'))
+    index = JiraIndex(index_file(args.folder, args.site))
+    run_metrics = metrics.RunMetrics(args.site, PROGRAM_NAME)
+
+    backup = JiraIncremental(args.base_url or f'https://{args.site}.atlassian.net', session, store, index,
+                             args.workers, args.fields, run_metrics)
+    successful = False
+    try:
+        successful = backup.run(args.projects.split(',') if args.projects else None)
+        name = f'jira-{args.site}-{time.strftime("%Y%m%d_%H%M%S")}'
+        store.put_manifest(name, backup.stored)
+        issues, attachments = index.counts()
+        logging.info(f'{backup.totals.items} changed items fetched, {backup.totals.stored_bytes // 1000} KB of '
+                     f'{backup.totals.total_bytes // 1000} KB stored as new chunks. Changes saved as {name}, the '
+                     f'index has {issues} issues and {attachments} attachments')
+    except Exception:
+        logging.error('Incremental backup failed')
+        logging.error(traceback.format_exc())
+    finally:
+        index.close()
+
+    if recording is not None:
+        incremental.save_recording(recording, args.record)
+    session.transport_stats.log()
+    operations.report_run(run_metrics, session, successful, args.metrics_dir)
+
+    if successful:
+        logging.info('Backup job is finished successfully')
+    else:
+        logging.info('Backup job finished with errors. See the logs.')
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
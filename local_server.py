@@ -0,0 +1,383 @@
+import argparse
+import base64
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit, urlencode
+
+# Stand-in for the Atlassian download endpoints so that downloads can be benchmarked and checked locally.
+# It can also replay REST responses recorded with incremental.record_responses, or simulate the whole backup
+# API of many sites, from the trigger to the download, with injected errors and throttling.
+
+CHUNK_SIZE = 256 * 1024
+
+
+class BackupFileHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+    def do_GET(self):
+        send_file(self, self.server.file_path, self.server.accept_ranges, self.server.stream_rate)
+
+
+def send_file(handler, path, accept_ranges, stream_rate=None, drop_at=None):
+    """Answer the GET request of handler with the file at path, or the byte range it asks for
+
+    :param drop_at: Close the connection after sending this share of the response, to simulate a dropped
+                    transfer
+    """
+    stat = os.stat(path)
+    total_size = stat.st_size
+    etag = f'"{stat.st_mtime_ns:x}-{total_size:x}"'
+    last_modified = formatdate(stat.st_mtime, usegmt=True)
+    start, end = 0, total_size - 1
+
+    range_header = handler.headers.get('Range')
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', range_header or '')
+    # A Range request with a stale If-Range validator gets the whole file
+    if_range = handler.headers.get('If-Range')
+    if if_range is not None and if_range not in (etag, last_modified):
+        match = None
+
+    if accept_ranges and match:
+        if match.group(1):
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(int(match.group(2)), total_size - 1)
+        elif match.group(2):
+            # Suffix range: the last N bytes
+            start = max(total_size - int(match.group(2)), 0)
+
+        if start >= total_size or start > end:
+            handler.send_response(416)
+            handler.send_header('Content-Range', f'bytes */{total_size}')
+            handler.send_header('Content-Length', '0')
+            handler.end_headers()
+            return
+
+        handler.send_response(206)
+        handler.send_header('Content-Range', f'bytes {start}-{end}/{total_size}')
+    else:
+        handler.send_response(200)
+
+    length = end - start + 1
+    handler.send_header('Content-Type', 'application/zip')
+    handler.send_header('Content-Length', str(length))
+    handler.send_header('ETag', etag)
+    handler.send_header('Last-Modified', last_modified)
+    if accept_ranges:
+        handler.send_header('Accept-Ranges', 'bytes')
+    handler.end_headers()
+
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = length
+        if drop_at is not None:
+            remaining = int(length * drop_at)
+            handler.close_connection = True
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            try:
+                handler.wfile.write(chunk)
+            except (BrokenPipeError, ConnectionResetError):
+                return
+            remaining -= len(chunk)
+            # Simulate the per-connection speed limit of a remote server
+            if stream_rate:
+                time.sleep(len(chunk) / stream_rate)
+
+
+def request_key(method, path):
+    """Key of a recorded request. The query parameters are sorted, their order does not matter"""
+    parts = urlsplit(path)
+    return method, parts.path, urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+
+
+def load_recording(recording_path):
+    """Read a recording into a dict of request key to response. A request recorded twice answers with the
+    last response"""
+    with open(recording_path, 'r', encoding='UTF-8') as f:
+        return {request_key(entry['method'], entry['path']): entry for entry in json.load(f)}
+
+
+class RecordedResponseHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+    def do_GET(self):
+        entry = self.server.responses.get(request_key('GET', self.path))
+        if entry is None:
+            body = f'No recorded response for {self.path}'.encode('UTF-8')
+            self.send_response(404)
+            self.send_header('Content-Type', 'text/plain')
+        else:
+            body = json.dumps(entry['json']).encode('UTF-8') if 'json' in entry else \
+                base64.b64decode(entry['body_base64'])
+            self.send_response(entry['status'])
+            if entry.get('content_type'):
+                self.send_header('Content-Type', entry['content_type'])
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve_recorded(recording_path, port=0):
+    """Replay recorded responses over HTTP in a background thread
+
+    Set server.responses = load_recording(path) to switch to another recording, e.g. of a later run.
+
+    :return: Tuple of (server, base URL). Call server.shutdown() to stop it
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), RecordedResponseHandler)
+    server.daemon_threads = True
+    server.responses = load_recording(recording_path)
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def serve(file_path, port=0, accept_ranges=True, stream_rate=None):
+    """Serve file_path over HTTP in a background thread
+
+    :param file_path: File that is returned for every GET request
+    :param port: Port to listen on, 0 picks a free port
+    :param accept_ranges: Answer Range requests with 206 responses if True, ignore them otherwise
+    :param stream_rate: Maximum bytes per second of a single connection, unlimited if None
+    :return: Tuple of (server, URL of the file). Call server.shutdown() to stop it
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), BackupFileHandler)
+    server.daemon_threads = True
+    server.file_path = file_path
+    server.accept_ranges = accept_ranges
+    server.stream_rate = stream_rate
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/download/backup.zip'
+
+
+class SimulatedExport(object):
+    """The last export of one product of a simulated site"""
+
+    def __init__(self, task_id, started):
+        self.task_id = task_id
+        self.started = started
+        self.file_id = uuid.uuid4().hex
+
+
+class AtlassianHandler(BaseHTTPRequestHandler):
+    """Backup endpoints of simulated Jira and Confluence sites, with the site name as the first path segment:
+    http://127.0.0.1:<port>/<site> for Jira and http://127.0.0.1:<port>/<site>/wiki for Confluence"""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+    def _send(self, status, body=b'', content_type='application/json', headers=None):
+        if isinstance(body, str):
+            body = body.encode('UTF-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count(self.command, self._endpoint, status)
+
+    def _route(self):
+        parts = urlsplit(self.path)
+        site, _, path = parts.path.lstrip('/').partition('/')
+        self._endpoint = '/' + re.sub(r'/[0-9a-f]{32}$', '/{id}', path)
+        return site, '/' + path, dict(parse_qsl(parts.query))
+
+    def _injected_failure(self, throttle=True):
+        """Answer with an injected error or throttling response. Returns True if one was sent"""
+        server = self.server
+        if throttle and server.rng.random() < server.throttle_rate:
+            self._send(429, '{"message": "Rate limited"}', headers={'Retry-After': str(server.retry_after)})
+            return True
+        if server.rng.random() < server.error_rate:
+            self._send(503, '{"message": "Service unavailable"}')
+            return True
+        return False
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        site, path, _ = self._route()
+        if path == '/rest/backup/1/export/runbackup':
+            self._trigger(site, 'jira', 412)
+        elif path == '/wiki/rest/obm/1.0/runbackup':
+            self._trigger(site, 'confluence', 406)
+        else:
+            self._send(404, '{"message": "Not found"}')
+
+    def _trigger(self, site, product, busy_status):
+        server = self.server
+        with server.lock:
+            export = server.exports.get((site, product))
+            now = time.monotonic()
+            if export is not None and now - export.started < server.export_seconds:
+                self._send(busy_status, '{"message": "A backup is already in progress"}')
+                return
+            if export is not None and now - export.started < server.cooldown:
+                self._send(406, '{"message": "Backup frequency is limited. You can not make another backup '
+                                'right now."}')
+                return
+            server.task_ids += 1
+            server.exports[(site, product)] = SimulatedExport(server.task_ids, now)
+            task_id = server.task_ids
+        self._send(200, json.dumps({'taskId': task_id}))
+
+    def _progress(self, export):
+        elapsed = time.monotonic() - export.started
+        return min(100, int(elapsed * 100 / self.server.export_seconds)) if self.server.export_seconds else 100
+
+    def do_GET(self):
+        site, path, query = self._route()
+        server = self.server
+        jira = server.exports.get((site, 'jira'))
+        confluence = server.exports.get((site, 'confluence'))
+
+        if path == '/rest/backup/1/export/lastTaskId':
+            if not self._injected_failure(throttle=False):
+                self._send(200, str(jira.task_id) if jira else '', 'text/plain')
+        elif path == '/rest/backup/1/export/getProgress':
+            if self._injected_failure():
+                return
+            if jira is None or str(jira.task_id) != query.get('taskId'):
+                self._send(404, '{"message": "Unknown task"}')
+                return
+            progress = self._progress(jira)
+            body = {'status': 'Success' if progress == 100 else 'InProgress', 'progress': progress,
+                    'message': 'Completed export' if progress == 100 else 'Exporting issues'}
+            if progress == 100:
+                body['result'] = f'export/download/?fileId={jira.file_id}'
+            self._send(200, json.dumps(body))
+        elif path == '/wiki/rest/obm/1.0/getprogress':
+            if self._injected_failure():
+                return
+            progress = self._progress(confluence) if confluence else 0
+            body = {'currentStatus': f'Exporting content. Estimated progress: {progress}%',
+                    'alternativePercentage': f'{progress}%', 'concurrentBackupInProgress': False, 'size': 0,
+                    'fileName': f'temp/filestore/{confluence.file_id}' if progress == 100 else None}
+            self._send(200, json.dumps(body))
+        elif path == '/plugins/servlet/export/download/' or path.startswith('/wiki/download/temp/filestore/'):
+            if self._injected_failure(throttle=False):
+                return
+            drop_at = None
+            # The one byte probe of downloader.probe is never cut off
+            if self.headers.get('Range') != 'bytes=0-0' and server.rng.random() < server.drop_rate:
+                drop_at = server.rng.uniform(0.1, 0.9)
+            server.count('GET', self._endpoint, 'dropped' if drop_at is not None else 'sent')
+            send_file(self, server.file_path, server.accept_ranges, server.stream_rate, drop_at)
+        else:
+            self._send(404, '{"message": "Not found"}')
+
+
+def serve_atlassian(file_path, port=0, export_seconds=10, cooldown=0, accept_ranges=True, stream_rate=None,
+                    error_rate=0, throttle_rate=0, retry_after=1, drop_rate=0, seed=None):
+    """Simulate the backup endpoints of Jira and Confluence sites in a background thread
+
+    Every finished export is downloaded as file_path. Point the scripts to a site with --base-url
+    <URL>/<site> for Jira and <URL>/<site>/wiki for Confluence.
+
+    :param export_seconds: Time from the trigger of an export until its file is ready
+    :param cooldown: Seconds after a trigger during which a new export is refused with 406
+    :param accept_ranges: Answer Range requests of the downloads with 206 responses if True
+    :param stream_rate: Maximum bytes per second of a single download connection, unlimited if None
+    :param error_rate: Share of the GET requests answered with 503
+    :param throttle_rate: Share of the progress checks answered with 429 and a Retry-After of retry_after
+    :param drop_rate: Share of the downloads whose connection is closed part way
+    :param seed: Seed of the random injected failures
+    :return: Tuple of (server, base URL). server.counts holds the number of responses by endpoint and status.
+             Call server.shutdown() to stop it
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), AtlassianHandler)
+    server.daemon_threads = True
+    server.file_path = file_path
+    server.export_seconds = export_seconds
+    server.cooldown = cooldown
+    server.accept_ranges = accept_ranges
+    server.stream_rate = stream_rate
+    server.error_rate = error_rate
+    server.throttle_rate = throttle_rate
+    server.retry_after = retry_after
+    server.drop_rate = drop_rate
+    server.rng = random.Random(seed)
+    server.lock = threading.Lock()
+    server.exports = {}
+    server.task_ids = 10000
+    server.counts = {}
+
+    def count(method, endpoint, status):
+        with server.lock:
+            key = (f'{method} {endpoint}', status)
+            server.counts[key] = server.counts.get(key, 0) + 1
+
+    def handle_error(request, client_address):
+        # Clients close connections part way on purpose, e.g. after the one byte probe of a download
+        logging.debug(f'Connection of {client_address} failed')
+
+    server.count = count
+    server.handle_error = handle_error
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def main():
+    parser = argparse.ArgumentParser('local_server')
+    parser.add_argument('file', help='File to serve', nargs='?')
+    parser.add_argument('--recording', help='Replay the responses of this recording instead of serving a file')
+    parser.add_argument('-p', '--port', type=int, default=8000)
+    parser.add_argument('--no-ranges', help='Ignore Range requests', action='store_true')
+    parser.add_argument('--stream-rate', help='Per-connection limit in MB/s', type=float)
+    parser.add_argument('--atlassian', help='Simulate the backup API of Jira and Confluence sites that export the file',
+                        action='store_true')
+    parser.add_argument('--export-seconds', help='With --atlassian, duration of an export', type=float, default=10)
+    parser.add_argument('--cooldown', help='With --atlassian, seconds before a new export can be started', type=float,
+                        default=0)
+    parser.add_argument('--error-rate', help='With --atlassian, share of the GET requests answered with 503',
+                        type=float, default=0)
+    parser.add_argument('--throttle-rate', help='With --atlassian, share of the progress checks answered with 429',
+                        type=float, default=0)
+    parser.add_argument('--drop-rate', help='With --atlassian, share of the downloads cut off part way', type=float,
+                        default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s', level=logging.INFO)
+    if args.recording:
+        server, url = serve_recorded(args.recording, args.port)
+        logging.info('Replaying ' + args.recording + ' at ' + url)
+    elif args.file and args.atlassian:
+        stream_rate = args.stream_rate * 1000000 if args.stream_rate else None
+        server, url = serve_atlassian(args.file, args.port, args.export_seconds, args.cooldown, not args.no_ranges,
+                                      stream_rate, args.error_rate, args.throttle_rate, drop_rate=args.drop_rate)
+        logging.info(f'Simulating sites at {url}/<site> and {url}/<site>/wiki, exporting {args.file}')
+    elif args.file:
+        stream_rate = args.stream_rate * 1000000 if args.stream_rate else None
+        server, url = serve(args.file, args.port, not args.no_ranges, stream_rate)
+        logging.info('Serving ' + args.file + ' at ' + url)
+    else:
+        parser.error('Either a file or --recording is required')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
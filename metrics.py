@@ -0,0 +1,126 @@
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+# Measurements of one backup run: how long each phase took, how many bytes were moved and how often the
+# servers were asked. A run can be written as a JSON report and as a Prometheus textfile for the
+# node_exporter textfile collector.
+
+PROMETHEUS_PREFIX = 'atlassian_backup'
+# Phases whose throughput is reported, with the counter holding their byte count
+THROUGHPUT = {'download': 'download_bytes', 'upload': 'upload_bytes', 'stream_to_s3': 'download_bytes',
+              'repack': 'repack_bytes', 'index': 'indexed_bytes'}
+
+
+class RunMetrics(object):
+
+    def __init__(self, site, product):
+        self.site = site
+        self.product = product
+        self.started = time.time()
+        self.phases = {}
+        self.counters = {}
+        self.values = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Measure the duration of a phase. A phase that runs more than once adds up"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set(self, name, value):
+        with self._lock:
+            self.values[name] = value
+
+    def report(self):
+        with self._lock:
+            throughput = {phase: self.counters[counter] / self.phases[phase]
+                          for phase, counter in THROUGHPUT.items()
+                          if self.phases.get(phase) and self.counters.get(counter)}
+            return {
+                'site': self.site,
+                'product': self.product,
+                'started': self.started,
+                'finished': time.time(),
+                'phase_seconds': dict(self.phases),
+                'counters': dict(self.counters),
+                'values': dict(self.values),
+                'bytes_per_second': throughput,
+            }
+
+    def log(self):
+        report = self.report()
+        for name, seconds in report['phase_seconds'].items():
+            logging.info(f'Phase {name} took {seconds:.2f} seconds')
+        for name, rate in report['bytes_per_second'].items():
+            logging.info(f'Phase {name} ran at {rate / 1000000:.1f} MB/s')
+
+    def write_json(self, folder):
+        report = self.report()
+        stamp = time.strftime('%Y%m%d_%H%M%S', time.localtime(report['started']))
+        path = os.path.join(folder, f'{self.site}-{self.product}-{stamp}.json')
+        _write_atomic(path, json.dumps(report, indent=2))
+        return path
+
+    def write_prometheus(self, folder):
+        """Write the run as <site>-<product>.prom, replacing the file of the previous run"""
+        report = self.report()
+        labels = f'site="{_escape(self.site)}",product="{_escape(self.product)}"'
+        lines = []
+
+        def metric(name, help_text, samples):
+            lines.append(f'# HELP {PROMETHEUS_PREFIX}_{name} {help_text}')
+            lines.append(f'# TYPE {PROMETHEUS_PREFIX}_{name} gauge')
+            for extra_labels, value in samples:
+                lines.append(f'{PROMETHEUS_PREFIX}_{name}{{{labels}{extra_labels}}} {value}')
+
+        metric('phase_seconds', 'Duration of a phase of the last backup run',
+               [(f',phase="{_escape(name)}"', seconds) for name, seconds in sorted(report['phase_seconds'].items())])
+        metric('throughput_bytes_per_second', 'Average transfer rate of a phase of the last backup run',
+               [(f',phase="{_escape(name)}"', rate) for name, rate in sorted(report['bytes_per_second'].items())])
+        for name, value in sorted(report['counters'].items()):
+            metric(name, f'{name.replace("_", " ").capitalize()} of the last backup run', [('', value)])
+        for name, value in sorted(report['values'].items()):
+            if isinstance(value, bool):
+                value = int(value)
+            if isinstance(value, (int, float)):
+                metric(name, f'{name.replace("_", " ").capitalize()} of the last backup run', [('', value)])
+        metric('last_run_timestamp_seconds', 'Start time of the last backup run', [('', report['started'])])
+
+        path = os.path.join(folder, f'{self.site}-{self.product}.prom')
+        _write_atomic(path, '\n'.join(lines) + '\n')
+        return path
+
+    def export(self, folder):
+        """Write the JSON report and the Prometheus textfile to folder"""
+        try:
+            os.makedirs(folder, exist_ok=True)
+            logging.info(f'Run report is saved to {self.write_json(folder)}')
+            self.write_prometheus(folder)
+        except IOError:
+            logging.error(f'Could not save the run metrics to {folder}')
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _write_atomic(path, text):
+    # The textfile collector may read at any time, so never leave a half-written file behind
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='UTF-8') as f:
+        f.write(text)
+    os.replace(temp_path, path)
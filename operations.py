@@ -1,11 +1,21 @@
 import argparse
+import json
 import logging
 import os
-import sys
 import time
 import traceback
-import requests
+import archive_index
+import bandwidth
+import catalog
+import dedup_store
+import download_journal
+import downloader
+import integrity
+import metrics
+import polling
+import repack
 import s3_operations
+import transport
 
 
 def parse_arguments(program):
@@ -26,25 +36,127 @@ def parse_arguments(program):
                         action='store_true')
     parser.add_argument('-s3', '--s3-bucket', help='Name of the S3 bucket to upload the backup file. Note that in '
                                                    'to upload to S3, AWS CLI must be installed and configured')
+    parser.add_argument('-w', '--workers', help='Number of parallel connections used to download the backup file. '
+                                                'Use 1 to download over a single connection',
+                        type=int, default=downloader.DEFAULT_WORKERS)
+    parser.add_argument('--segment-size', help='Size of each downloaded byte-range segment in MB',
+                        type=int, default=downloader.DEFAULT_SEGMENT_SIZE_MB)
+    parser.add_argument('--buffer-size', help='Size of the read buffer of each download connection in MB',
+                        type=int, default=downloader.DEFAULT_BUFFER_SIZE_MB)
+    parser.add_argument('--reserve-space', help='Allocate the disk space for the whole backup file before '
+                                                'downloading, so a full disk is detected right away',
+                        action='store_true')
+    parser.add_argument('--no-cache', help='Drop downloaded data from the operating system page cache once it is '
+                                           'written, to keep large downloads from evicting other data',
+                        action='store_true')
+    parser.add_argument('--stream-to-s3', help='Upload the backup file to the S3 bucket while it is downloaded '
+                                               'instead of saving it to the folder first',
+                        action='store_true')
+    parser.add_argument('--keep-local', help='With --stream-to-s3, also save a copy of the backup file to the folder',
+                        action='store_true')
+    parser.add_argument('--part-size', help='Size of each S3 multipart upload part in MB',
+                        type=int, default=s3_operations.PART_SIZE // (1024 * 1024))
+    parser.add_argument('--part-concurrency', help='Number of S3 parts uploaded in parallel',
+                        type=int, default=s3_operations.DEFAULT_CONCURRENCY)
+    parser.add_argument('--multipart-threshold', help='Upload files of at least this many MB in parts. Defaults to '
+                                                      'the part size',
+                        type=int)
+    parser.add_argument('--s3-crt', help='Upload with the AWS Common Runtime transfer client, needs awscrt',
+                        action='store_true')
+    parser.add_argument('--storage-class', help='S3 storage class of the uploaded backup files',
+                        choices=s3_operations.STORAGE_CLASSES)
+    parser.add_argument('--sse', help='Server-side encryption of the uploaded backup files',
+                        choices=s3_operations.SSE_ALGORITHMS)
+    parser.add_argument('--sse-kms-key-id', help='KMS key to encrypt the backup files with when --sse is aws:kms')
+    parser.add_argument('--bandwidth-mb', help='Limit the download and the upload together to this many MB/s',
+                        type=float)
+    parser.add_argument('--bandwidth-schedule', help='Limits by time of day in MB/s, e.g. "mon-fri 08:00-18:00=50". '
+                                                     '--bandwidth-mb applies outside of these windows')
+    parser.add_argument('--adaptive-bandwidth', help='Slow down the transfer while the latency of the requests rises',
+                        action='store_true')
+    parser.add_argument('--low-priority', help='Download and upload with a low CPU and disk I/O priority',
+                        action='store_true')
+    parser.add_argument('--max-wait', help='Give up if the export is not finished after this many hours',
+                        type=float, default=polling.DEFAULT_MAX_WAIT / 3600)
+    parser.add_argument('--dedup-store', help='Also add the backup file to a deduplicated chunk store. Either a '
+                                              'local directory or s3://bucket/prefix')
+    parser.add_argument('--repack', help='Recompress the XML of the backup file with zstd and also upload the '
+                                         'smaller pack. Needs zstandard, restore with repack.py unpack',
+                        action='store_true')
+    parser.add_argument('--repack-level', help='zstd compression level of --repack',
+                        type=int, default=repack.DEFAULT_LEVEL)
+    parser.add_argument('--repack-threads', help='zstd worker threads of --repack, -1 for one per core',
+                        type=int, default=repack.DEFAULT_THREADS)
+    parser.add_argument('--index-archive', help='Index the backup file for restoring single issues, pages and '
+                                                'attachments with archive_index.py restore. The index is saved and '
+                                                f'uploaded next to the backup file as *{archive_index.INDEX_SUFFIX}',
+                        action='store_true')
+    parser.add_argument('--catalog', help='SQLite catalog to record the backup in, see catalog.py. Defaults to '
+                                          f'{catalog.CATALOG_FILE} in the folder')
+    parser.add_argument('--metrics-dir', help='Folder to save a JSON report and a Prometheus textfile of the run to, '
+                                              'e.g. the directory of the node_exporter textfile collector')
+    parser.add_argument('--base-url', help=f'Site URL to use instead of https://<site>.atlassian.net'
+                                           f'{"/wiki" if program == "confluence" else ""}, e.g. a local '
+                                           'stand-in server')
 
     args = parser.parse_args().__dict__
+    if args['bandwidth_schedule']:
+        try:
+            bandwidth.Schedule.parse(args['bandwidth_schedule'])
+        except ValueError as e:
+            parser.error(str(e))
+    if args['repack'] and not repack.available():
+        parser.error('--repack needs the zstandard package, pip install zstandard')
+    if args['repack'] and args['stream_to_s3']:
+        parser.error('--repack cannot be combined with --stream-to-s3')
+    if args['index_archive'] and args['stream_to_s3']:
+        # The index points into the zip, which is not saved with --stream-to-s3
+        parser.error('--index-archive cannot be combined with --stream-to-s3')
     return args["site"], \
            args["user"], \
            args["token"], \
            args["with_attachments"], \
            args["folder"], \
            args["download_only"], \
-           args["s3_bucket"]
+           args["s3_bucket"], \
+           args
 
 
-def get_session(username, token):
-    # Open new session for cookie persistence and auth.
-    session = requests.Session()
+def get_session(username, token, pool_size=transport.DEFAULT_POOL_SIZE):
+    # Open new session for cookie persistence and auth. The same session and its connections are used for
+    # the trigger, progress and download requests
+    session = transport.create_session(pool_size)
     session.auth = (username, token)
     session.headers.update({"Accept": "application/json", "Content-Type": "application/json"})
     return session
 
 
+def wait_for_next_poll(poller, response):
+    # Sleep until the next progress check and give up once the export takes longer than allowed
+    try:
+        poller.wait(response)
+    except polling.PollTimeout as e:
+        logging.error(str(e))
+        exit(1)
+
+
+def report_run(run_metrics, session, successful, metrics_dir=None, skipped=False):
+    """Add the transport counters and the outcome to the run metrics, log them and save them to metrics_dir
+
+    :param skipped: True if the run did nothing because another run works on the site, which is reported as
+                    skipped instead of a success or a failure
+    """
+    for name, value in session.transport_stats.totals().items():
+        run_metrics.count(f'http_{name}', value)
+    if skipped:
+        run_metrics.set('skipped', True)
+    else:
+        run_metrics.set('success', bool(successful))
+    run_metrics.log()
+    if metrics_dir:
+        run_metrics.export(metrics_dir)
+
+
 def save_backup_file_url(file_name, url):
     # Save the latest backup file url to a file
     try:
@@ -71,7 +183,191 @@ def get_backup_file_url(file_name):
         return file_url
 
 
-def download_backup_and_upload_to_s3(file_url, folder, session, program_name, s3_bucket):
+def backup_origin(options, program_name):
+    """Return (site, product, time) of a backup for the catalog"""
+    return options.get('site'), options.get('product') or program_name, time.time()
+
+
+def record_backup(options, origin, manifest, folder, s3_bucket=None, s3_key=None, local_files=None):
+    """Add a finished backup to the catalog. A failure is logged, it does not fail the backup"""
+    path = options.get('catalog') or catalog.default_path(folder)
+    site, product, created = origin
+    try:
+        backups = catalog.Catalog(path)
+        try:
+            backups.record(site, product, created, manifest['file'], manifest['size'], manifest['digests']['sha256'],
+                           manifest['s3_checksum_sha256'], s3_bucket, s3_key, local_files)
+        finally:
+            backups.close()
+    except Exception:
+        logging.error(f'Cannot record the backup in the catalog {path}')
+        logging.error(traceback.format_exc())
+
+
+def stream_backup_to_s3(file_url, full_path, session, s3_bucket, options, origin=None):
+    """Download the backup file and upload it to S3 in the same pass, without staging it on disk
+
+    :param file_url: URL of the file to download
+    :param full_path: Full path of the local copy, only written if the keep_local option is set
+    :param session: The current https session to be used to download the backup
+    :param s3_bucket: Name of the S3 bucket to upload the backup file
+    :param options: All command line arguments
+    :param origin: (site, product, time) of the backup, see backup_origin. If given, the backup is recorded in
+                   the catalog
+    :return: True if the whole file is uploaded and its checksum matches, False otherwise
+    """
+    object_name = os.path.basename(full_path)
+    local_copy = None
+    run_metrics = options.get('metrics') or metrics.RunMetrics(None, None)
+    try:
+        with session.get(file_url, stream=True) as response:
+            response.raise_for_status()
+            total_size = response.headers.get('content-length')
+            total_size = int(total_size) if total_size is not None else None
+            if total_size is not None:
+                logging.info(f'Total size of backup file is {total_size // 1000000} MB')
+
+            settings = s3_operations.TransferSettings.from_options(options)
+            hasher = integrity.OrderedHasher(s3_operations.effective_part_size(settings.part_size, total_size))
+
+            def chunks():
+                limiter = options.get('limiter')
+                buffer_size = options.get('buffer_size', downloader.DEFAULT_BUFFER_SIZE_MB) * 1024 * 1024
+                for chunk in downloader.read_into(response, buffer_size):
+                    if limiter is not None:
+                        limiter(len(chunk))
+                    if local_copy is not None:
+                        local_copy.write(chunk)
+                    hasher.update(hasher.position, chunk)
+                    run_metrics.count('download_bytes', len(chunk))
+                    yield chunk
+
+            if options.get('keep_local'):
+                local_copy = open(full_path, 'wb')
+
+            logging.info(f'Streaming {object_name} to {s3_bucket}')
+            with run_metrics.phase('stream_to_s3'):
+                uploaded = s3_operations.upload_stream(chunks(), s3_bucket, object_name, settings, total_size,
+                                                       catalog.object_metadata(*origin) if origin else None)
+            if not uploaded:
+                return False
+
+        if local_copy is not None:
+            local_copy.close()
+        with run_metrics.phase('hash'):
+            manifest = verify_download(file_url, full_path, hasher, full_path if local_copy is not None else None)
+        if local_copy is not None:
+            integrity.write_manifest(full_path, manifest)
+        if not (upload_manifest_and_compare(manifest, s3_bucket, object_name, settings) and manifest['zip']['valid']):
+            return False
+        if origin is not None:
+            record_backup(options, origin, manifest, os.path.dirname(full_path), s3_bucket, object_name,
+                          [full_path] if local_copy is not None else [])
+        return True
+    except Exception:
+        logging.error('Error while streaming backup file to S3')
+        logging.error(traceback.format_exc())
+        return False
+    finally:
+        if local_copy is not None:
+            local_copy.close()
+
+
+def verify_download(file_url, full_path, hasher, path=None):
+    """Build the integrity manifest from the hashes computed during the download and validate the zip
+
+    :param path: Local file to read the zip central directory from if it does not fit in the kept tail
+    """
+    manifest = hasher.finish()
+    manifest['file'] = os.path.basename(full_path)
+    manifest['url'] = file_url
+    manifest['zip'] = integrity.validate_zip(hasher.tail, manifest['size'], path)
+    logging.info(f'SHA-256 of {manifest["file"]}: {manifest["digests"]["sha256"]}')
+    if not manifest['zip']['valid']:
+        logging.error(f'Backup file is not a valid zip file: {manifest["zip"]["error"]}')
+    return manifest
+
+
+def upload_manifest_and_compare(manifest, s3_bucket, object_name, settings=None):
+    """Upload the integrity manifest next to the S3 object and compare our checksum with the one of S3"""
+    s3_operations.upload_bytes(json.dumps(manifest, indent=2).encode('UTF-8'), s3_bucket,
+                               object_name + integrity.MANIFEST_SUFFIX, settings)
+
+    checksum = s3_operations.get_checksum(s3_bucket, object_name)
+    if not integrity.checksums_match(manifest['s3_checksum_sha256'], checksum):
+        logging.error(f'S3 checksum {checksum} of {object_name} does not match the downloaded file '
+                      f'({manifest["s3_checksum_sha256"]})')
+        return False
+    logging.info('S3 checksum matches the downloaded file')
+    return True
+
+
+def add_to_dedup_store(full_path, location):
+    logging.info(f'Adding {full_path} to the deduplicated store {location}')
+    try:
+        stats = dedup_store.ingest(full_path, dedup_store.open_store(location))
+    except Exception:
+        logging.error('Error while adding the backup file to the deduplicated store')
+        logging.error(traceback.format_exc())
+        return False
+
+    logging.info(f'{stats.new_chunks} of {stats.chunks} chunks are new, '
+                 f'{stats.stored_bytes // 1000000} MB of {stats.total_bytes // 1000000} MB stored')
+    return True
+
+
+def index_backup(full_path):
+    """Index the backup file with archive_index.build
+
+    :return: Full path of the index, or None if indexing fails
+    """
+    logging.info(f'Indexing {full_path}')
+    try:
+        start = time.perf_counter()
+        stats = archive_index.build(full_path)
+    except Exception:
+        logging.error('Error while indexing the backup file')
+        logging.error(traceback.format_exc())
+        return None
+
+    logging.info(f'{stats.entities} entities and {stats.members} members indexed with {stats.checkpoints} '
+                 f'checkpoints in {time.perf_counter() - start:.2f} seconds')
+    return full_path + archive_index.INDEX_SUFFIX
+
+
+def repack_backup(full_path, manifest, options, settings):
+    """Pack the backup file with repack.pack and hash the pack for the upload
+
+    :param manifest: Integrity manifest of the backup file, kept in the manifest of the pack
+    :return: Full path and integrity manifest of the pack, or None if packing fails
+    """
+    pack_path = full_path + repack.PACK_SUFFIX
+    logging.info(f'Repacking {full_path} with zstd')
+    try:
+        start = time.perf_counter()
+        stats = repack.pack(full_path, pack_path, options.get('repack_level', repack.DEFAULT_LEVEL),
+                            options.get('repack_threads', repack.DEFAULT_THREADS))
+        hasher = integrity.OrderedHasher(part_size_for_total=settings.part_size_for,
+                                     multipart_for_total=settings.uses_multipart)
+        hasher.set_total_size(stats.packed_size)
+        with open(pack_path, 'rb') as f:
+            for block in iter(lambda: f.read(dedup_store.READ_SIZE), b''):
+                hasher.update(hasher.position, block)
+    except Exception:
+        logging.error('Error while repacking the backup file')
+        logging.error(traceback.format_exc())
+        return None
+
+    logging.info(f'{stats.recompressed_members} members recompressed in {time.perf_counter() - start:.2f} seconds, '
+                 f'the pack is {stats.packed_size // 1000000} MB, {stats.ratio:.2f} times smaller than the zip')
+    pack_manifest = hasher.finish()
+    pack_manifest['file'] = os.path.basename(pack_path)
+    pack_manifest['original'] = manifest
+    integrity.write_manifest(pack_path, pack_manifest)
+    return pack_path, pack_manifest
+
+
+def download_backup_and_upload_to_s3(file_url, folder, session, program_name, s3_bucket, options=None):
     """Download the backup file from Atlassian and upload it to S3
 
     :param file_url: URL of the file to download
@@ -79,8 +375,61 @@ def download_backup_and_upload_to_s3(file_url, folder, session, program_name, s3
     :param session: The current https session to be used to download the backup
     :param program_name: jira or confluence
     :param s3_bucket: Name of the S3 bucket to upload the backup file
+    :param options: All command line arguments, used for the download tuning options. A 'limiter' entry, if
+                    present, is called with every downloaded and uploaded byte count to enforce a bandwidth limit,
+                    otherwise one is created from the bandwidth options. A 'metrics' entry, if present, is a
+                    metrics.RunMetrics that records the phases of the transfer. An 'export_state' entry, if
+                    present, is the export_state.ExportState of the export; a file it already records as
+                    downloaded is skipped, and a successful transfer is recorded in it
     :return: True if download and upload succeeds, False if one of them fails
     """
+    options = options or {}
+    state = options.get('export_state')
+    validators = None
+    if state is not None:
+        validators = remote_validators(session, file_url)
+        if state.is_downloaded(file_url, validators):
+            logging.info(f'The backup file is already downloaded, see {state.path}')
+            return True
+
+    if options.get('low_priority'):
+        bandwidth.lower_priority()
+    limiter = bandwidth.from_options(options) if options.get('limiter') is None else None
+    if limiter is None:
+        result = transfer_backup(file_url, folder, session, program_name, s3_bucket, options)
+    else:
+        limiter.watch(session)
+        try:
+            result = transfer_backup(file_url, folder, session, program_name, s3_bucket,
+                                     dict(options, limiter=limiter))
+        finally:
+            report_bandwidth(limiter, options.get('metrics'))
+
+    if result and state is not None:
+        state.downloaded(file_url, validators)
+    return result
+
+
+def remote_validators(session, file_url):
+    """ETag and Last-Modified of the backup file, None if they cannot be read, e.g. because the link expired"""
+    try:
+        return downloader.probe(session, file_url)[2]
+    except Exception:
+        logging.debug(traceback.format_exc())
+        return None
+
+
+def report_bandwidth(limiter, run_metrics=None):
+    """Log the rate achieved under a bandwidth.TokenBucket and add it to the run metrics"""
+    limiter.log()
+    if run_metrics is not None:
+        report = limiter.report()
+        run_metrics.set('shaped_bytes_per_second', report['achieved_bytes_per_second'])
+        run_metrics.set('throttled_seconds', report['throttled_seconds'])
+
+
+def transfer_backup(file_url, folder, session, program_name, s3_bucket, options):
+    """Download the backup file and upload it, see download_backup_and_upload_to_s3"""
 
     # Example download URL for Confluence:
     # https://userhappiness.atlassian.net/wiki/download/temp/filestore/8dd92113-7734-4cef-aa1a-ee11537adf7a
@@ -89,54 +438,118 @@ def download_backup_and_upload_to_s3(file_url, folder, session, program_name, s3
 
     if not folder.endswith('/'):
         folder += '/'
+    run_metrics = options.get('metrics') or metrics.RunMetrics(None, program_name)
+    origin = backup_origin(options, program_name)
+
+    if s3_bucket is not None and options.get('stream_to_s3'):
+        backup_file = program_name + '-export-' + time.strftime('%Y%m%d_%H%M%S') + '.zip'
+        result = stream_backup_to_s3(file_url, folder + backup_file, session, s3_bucket, options, origin)
+        if result:
+            logging.info('Upload to S3 is finished')
+        else:
+            logging.error('Upload to S3 failed')
+        return result
 
-    backup_file = program_name + '-export-' + time.strftime('%Y%m%d_%H%M%S') + '.zip'
-    full_path = folder + backup_file
+    # Continue an interrupted download of the same file instead of starting from zero
+    journal = download_journal.find(folder, file_url)
+    if journal is not None:
+        full_path = journal.file_path
+        backup_file = os.path.basename(full_path)
+        logging.info(f'Found an unfinished download of this backup file: {full_path}')
+    else:
+        backup_file = program_name + '-export-' + time.strftime('%Y%m%d_%H%M%S') + '.zip'
+        full_path = folder + backup_file
     result = False
+    total_size = None
+    written = None
+    # S3 may use larger parts for very large files, the hasher follows it to compute the same checksum
+    settings = s3_operations.TransferSettings.from_options(options)
+    hasher = integrity.OrderedHasher(part_size_for_total=settings.part_size_for,
+                                     multipart_for_total=settings.uses_multipart)
     try:
-        file = session.get(file_url, stream=True)
-        file.raise_for_status()
-
-        total_size = file.headers.get('content-length')
-        total_size_mb = int(total_size) // 1000000
-        logging.info(f'Total size of backup file is {total_size_mb} MB')
-
-        with open(full_path, 'wb') as f:
-            # Call performance counter first time to measure the elapsed time at the end
-            time.perf_counter()
-            logging.info('Downloading...')
-            dl = 0
-            for chunk in file.iter_content(1024):
-                f.write(chunk)
-                if total_size is not None:
-                    dl += len(chunk)
-                    done = int(100 * dl / int(total_size))
-                    # Print the download percentage
-                    sys.stdout.write("\r[%s%s] %s percent" % ('=' * done, ' ' * (100 - done), str(done)))
-
-        logging.info(f"Download finished in {(time.perf_counter()):.2f} seconds")
+        start = time.perf_counter()
+        workers = options.get('workers', downloader.DEFAULT_WORKERS)
+        segment_size = options.get('segment_size', downloader.DEFAULT_SEGMENT_SIZE_MB) * 1024 * 1024
+        buffer_size = options.get('buffer_size', downloader.DEFAULT_BUFFER_SIZE_MB) * 1024 * 1024
+        with run_metrics.phase('download'):
+            total_size, written = downloader.download(session, file_url, full_path, workers, segment_size,
+                                                      options.get('limiter'), hasher, buffer_size,
+                                                      options.get('reserve_space', False),
+                                                      options.get('no_cache', False))
+        run_metrics.count('download_bytes', written)
+
+        logging.info(f"Download finished in {time.perf_counter() - start:.2f} seconds")
     except KeyboardInterrupt:
         logging.info('Download is interrupted by user')
     except Exception:
         logging.error('Error while downloading/saving backup file')
         logging.error(traceback.format_exc())
     finally:
-        if os.path.isfile(full_path) and os.stat(full_path).st_size == int(total_size):
+        # The file is preallocated for segmented downloads, so its size alone does not prove it is complete.
+        # If the server did not report a size, trust the number of bytes received.
+        completed = written is not None and (total_size is None or written == total_size)
+        if completed and os.path.isfile(full_path) and os.stat(full_path).st_size == written:
             logging.info(backup_file + ' is saved to ' + folder)
-            result = True
+            with run_metrics.phase('hash'):
+                manifest = verify_download(file_url, full_path, hasher, full_path)
+            integrity.write_manifest(full_path, manifest)
+            result = manifest['zip']['valid']
+
+            if result and options.get('dedup_store'):
+                with run_metrics.phase('dedup'):
+                    result = add_to_dedup_store(full_path, options['dedup_store'])
+
+            local_files = [full_path]
+            index_path = None
+            pack = None
+            if result and options.get('index_archive'):
+                with run_metrics.phase('index'):
+                    index_path = index_backup(full_path)
+                result = index_path is not None
+                if result:
+                    local_files.append(index_path)
+                    # Bytes of the zip read by the indexer, for the throughput, and the size of the index
+                    run_metrics.count('indexed_bytes', os.path.getsize(full_path))
+                    run_metrics.count('index_bytes', os.path.getsize(index_path))
 
-            if s3_bucket is not None:
+            if result and options.get('repack'):
+                with run_metrics.phase('repack'):
+                    pack = repack_backup(full_path, manifest, options, settings)
+                result = pack is not None
+                if result:
+                    local_files.append(pack[0])
+                    run_metrics.count('repack_bytes', manifest['size'])
+
+            if result and s3_bucket is not None:
                 logging.info(f'Uploading {full_path} to {s3_bucket}')
-                s3_upload_result = s3_operations.upload(full_path, s3_bucket, os.path.split(full_path)[-1])
+                s3_upload_result = s3_operations.upload(full_path, s3_bucket, backup_file, run_metrics, settings,
+                                                        catalog.object_metadata(*origin, manifest['digests']['sha256']))
                 if s3_upload_result:
                     logging.info('Upload to S3 is finished')
+                    result = upload_manifest_and_compare(manifest, s3_bucket, backup_file, settings)
+                    if result and index_path is not None:
+                        result = s3_operations.upload(index_path, s3_bucket, os.path.split(index_path)[-1],
+                                                      settings=settings)
+                    # The zip stays the copy to restore from: a pack can only be rebuilt into it with the same zlib
+                    if result and pack is not None:
+                        pack_path, pack_manifest = pack
+                        result = s3_operations.upload(pack_path, s3_bucket, os.path.split(pack_path)[-1],
+                                                      run_metrics, settings)
+                        result = result and upload_manifest_and_compare(pack_manifest, s3_bucket,
+                                                                        os.path.split(pack_path)[-1], settings)
                 else:
                     logging.error('Upload to S3 failed')
-        elif os.stat(full_path).st_size < int(total_size):
-            logging.error(traceback.format_exc())
+                    result = False
+
+            if result:
+                record_backup(options, origin, manifest, folder, s3_bucket,
+                              backup_file if s3_bucket is not None else None, local_files)
+        elif os.path.isfile(full_path + download_journal.JOURNAL_SUFFIX):
+            logging.error('Backup file is incomplete. Run again with --download-only to resume the download')
+        elif os.path.isfile(full_path):
+            logging.error('Backup file is incomplete, removing ' + full_path)
             os.remove(full_path)
         else:
             logging.error('Cannot download backup file')
-            logging.error(traceback.format_exc())
 
         return result
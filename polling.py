@@ -0,0 +1,103 @@
+import logging
+import random
+import time
+
+# Decides how long to wait between two progress checks of an export.
+#
+# The rate of progress is estimated from the progress values seen so far, and the next check is scheduled
+# for a fraction of the estimated remaining time. Long exports are therefore checked rarely while they are
+# far from done, and more often as they get close to 100%. Until the progress moves at all, the interval
+# grows exponentially. Rate limit answers (429/503 with Retry-After) are always honoured.
+
+DEFAULT_MIN_INTERVAL = 5
+DEFAULT_MAX_INTERVAL = 300
+DEFAULT_MAX_WAIT = 24 * 60 * 60
+# Check again after this share of the estimated remaining time
+REMAINING_FRACTION = 0.3
+JITTER = 0.1
+# Longest Retry-After that is honoured, longer ones are taken as a broken header
+MAX_RETRY_AFTER = 15 * 60
+
+
+class PollTimeout(Exception):
+    pass
+
+
+def retry_after(response):
+    """Seconds to wait from the Retry-After header of a 429 or 503 response, None for other responses"""
+    if response is None or response.status_code not in (429, 503):
+        return None
+    value = response.headers.get('Retry-After', '')
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        # HTTP dates are rare here, fall back to the regular backoff
+        return 0
+
+
+class Poller(object):
+
+    def __init__(self, min_interval=DEFAULT_MIN_INTERVAL, max_interval=DEFAULT_MAX_INTERVAL,
+                 max_wait=DEFAULT_MAX_WAIT, clock=time.monotonic, sleep=time.sleep):
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._max_wait = max_wait
+        self._clock = clock
+        self._sleep = sleep
+        self._started = clock()
+        self._first = None
+        self._last = None
+        self._backoff = min_interval
+        self.polls = 0
+
+    def observe(self, progress):
+        """Record a progress value between 0 and 100. None means the response had no usable progress"""
+        self.polls += 1
+        if progress is None:
+            return
+        now = self._clock()
+        if self._first is None:
+            self._first = (now, progress)
+        if self._last is None or progress != self._last[1]:
+            self._last = (now, progress)
+            self._backoff = self._min_interval
+
+    def rate(self):
+        """Estimated progress in percent per second, None until the progress has moved"""
+        if self._first is None or self._last is None or self._last[1] <= self._first[1]:
+            return None
+        return (self._last[1] - self._first[1]) / (self._last[0] - self._first[0])
+
+    def next_delay(self, response=None):
+        """Seconds to wait before the next check"""
+        server_delay = retry_after(response)
+        if server_delay:
+            # Never sleep past max_wait, wait raises PollTimeout at the next check instead
+            if self._max_wait is not None:
+                server_delay = min(server_delay, max(self._max_wait - (self._clock() - self._started), 0))
+            return min(server_delay, MAX_RETRY_AFTER)
+        if server_delay is not None:
+            # Back off further on every rate limit answer without a usable hint
+            delay = self._backoff
+            self._backoff = min(self._backoff * 2, self._max_interval)
+            return delay
+
+        rate = self.rate()
+        if rate:
+            remaining = (100 - self._last[1]) / rate - (self._clock() - self._last[0])
+            delay = max(remaining, 0) * REMAINING_FRACTION
+        else:
+            delay = self._backoff
+            self._backoff = min(self._backoff * 2, self._max_interval)
+
+        delay = min(max(delay, self._min_interval), self._max_interval)
+        return delay * random.uniform(1 - JITTER, 1 + JITTER)
+
+    def wait(self, response=None):
+        """Sleep until the next check, raise PollTimeout once the total wait exceeds max_wait"""
+        delay = self.next_delay(response)
+        elapsed = self._clock() - self._started
+        if self._max_wait is not None and (elapsed >= self._max_wait or elapsed + delay > self._max_wait):
+            raise PollTimeout(f'Export did not finish within {int(self._max_wait // 60)} minutes')
+        logging.debug(f'Next progress check in {delay:.1f} seconds')
+        self._sleep(delay)
@@ -0,0 +1,100 @@
+import json
+import re
+
+# Models of the export progress responses. Each response body is decoded once; if it is not the expected
+# JSON object, the values are scraped from the raw text the same way the scripts used to do it.
+
+
+def _decode(text):
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def _search(pattern, text):
+    match = re.search(pattern, text)
+    return match.group(1) if match else None
+
+
+def _percentage(value):
+    # Percentages come as 45, "45" or "45%"
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return int(value)
+    match = re.search(r'\d+', value) if isinstance(value, str) else None
+    return int(match.group(0)) if match else None
+
+
+class JiraProgress(object):
+    """Response of /rest/backup/1/export/getProgress"""
+
+    def __init__(self, text, progress=None, message=None, result=None, status=None):
+        self.text = text
+        self.progress = progress
+        self.message = message
+        self.result = result
+        self.status = status
+        self.has_error = 'error' in text or status == 'Failed'
+
+    @property
+    def is_valid(self):
+        return self.progress is not None
+
+    @classmethod
+    def parse(cls, text):
+        data = _decode(text)
+        if data is not None:
+            return cls(text, _percentage(data.get('progress')), data.get('message'), data.get('result'),
+                       data.get('status'))
+
+        # Not JSON, scrape what we can
+        progress = _search('(?<=progress":)(.*?)(?=,)', text)
+        return cls(text, _percentage(progress), _search('(?<=message":)(.*?)(?=,)', text),
+                   _search('(?<=result":")(.*?)(?=",)', text))
+
+
+class ConfluenceProgress(object):
+    """Response of /rest/obm/1.0/getprogress"""
+
+    def __init__(self, text, file_name=None, current_status=None, estimated_percentage=None,
+                 alternative_percentage=None):
+        self.text = text
+        self.file_name = file_name
+        self.current_status = current_status
+        self.estimated_percentage = estimated_percentage
+        self.alternative_percentage = alternative_percentage
+        self.has_error = 'error' in text
+
+    @property
+    def is_finished(self):
+        return bool(self.file_name)
+
+    @property
+    def percentage_text(self):
+        """Progress as shown by Confluence, the estimated one if available"""
+        return self.estimated_percentage if self.estimated_percentage is not None else self.alternative_percentage
+
+    @property
+    def percentage(self):
+        return _percentage(self.percentage_text)
+
+    @classmethod
+    def parse(cls, text):
+        data = _decode(text)
+        if data is not None:
+            # The estimate is embedded in a status text like "... Estimated progress: 45%"
+            estimated = None
+            for value in data.values():
+                if isinstance(value, str) and 'Estimated progress: ' in value:
+                    estimated = value.split('Estimated progress: ', 1)[1]
+                    break
+            alternative = data.get('alternativePercentage')
+            return cls(text, data.get('fileName') or None, data.get('currentStatus'), estimated,
+                       str(alternative) if alternative not in (None, '') else None)
+
+        # Not JSON, scrape what we can
+        return cls(text, _search('(?<=fileName":")(.*?)(?=")', text),
+                   _search('(?<=currentStatus":")(.*?)(?=")', text),
+                   _search('(?<=Estimated progress: )(.*?)(?=")', text),
+                   _search('(?<=alternativePercentage":")(.*?)(?=")', text))
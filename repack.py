@@ -0,0 +1,251 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import struct
+import sys
+import zipfile
+import zlib
+import dedup_store
+
+# Recompresses backup zips with zstd, reversibly.
+#
+# Atlassian exports are deflate zips whose largest member is usually entities.xml, which zstd compresses far
+# better than deflate. A pack keeps every region of the zip (see dedup_store.zip_regions) in file order:
+# the deflate data of large text members is stored decompressed and zstd compressed, after checking on the
+# fly that zlib compresses it back to the identical bytes. Everything else, including the attachments that
+# are compressed already, is copied as it is. Unpacking therefore gives back the original zip byte for byte,
+# which the SHA-256 in the pack confirms.
+#
+# The rebuilt deflate data is only identical if the zlib that unpacks produces the same output as the one that
+# packed. Other builds, such as zlib-ng or a newer zlib, may not. The pack records the zlib version and the
+# CRC-32 of every recompressed member, so unpacking stops at the first member that comes out different and
+# names the zlib version needed. The backup scripts upload the original zip next to the pack for this reason.
+#
+# Layout: MAGIC, then per region a header (type, deflate level, payload length) and the payload, then a JSON
+# footer with the original size and SHA-256, the zlib version and the CRC-32 of the deflate data of every
+# recompressed member, its length and END_MAGIC.
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b'ATLZPK01'
+END_MAGIC = b'ATLZPKND'
+PACK_SUFFIX = '.zpk'
+DEFAULT_LEVEL = 12
+# zstd worker threads, -1 uses one per core
+DEFAULT_THREADS = -1
+RAW = b'R'
+DEFLATE = b'D'
+_SEGMENT = struct.Struct('<ccQ')
+_FOOTER = struct.Struct('<Q8s')
+
+
+class PackError(Exception):
+    pass
+
+
+def available():
+    return zstandard is not None
+
+
+class _Digest(object):
+    """SHA-256 of the whole zip and CRC-32 of the current member, fed with the bytes of the zip in order"""
+
+    def __init__(self):
+        self.sha256 = hashlib.sha256()
+        self.crc32 = 0
+
+    def update(self, data):
+        self.sha256.update(data)
+        self.crc32 = zlib.crc32(data, self.crc32)
+
+    def copy(self):
+        digest = _Digest()
+        digest.sha256 = self.sha256.copy()
+        digest.crc32 = self.crc32
+        return digest
+
+
+class Pack(object):
+    """Sizes of a packed file"""
+
+    def __init__(self):
+        self.original_size = 0
+        self.packed_size = 0
+        self.recompressed_members = 0
+
+    @property
+    def ratio(self):
+        return self.original_size / self.packed_size if self.packed_size else 0
+
+
+def _copy(source, target, length, digest=None):
+    while length > 0:
+        block = source.read(min(dedup_store.READ_SIZE, length))
+        if not block:
+            raise IOError('Unexpected end of file')
+        length -= len(block)
+        if digest is not None:
+            digest.update(block)
+        target.write(block)
+
+
+def pack(path, target, level=DEFAULT_LEVEL, threads=DEFAULT_THREADS):
+    """Write the pack of the zip path to target
+
+    :param level: zstd compression level
+    :param threads: zstd worker threads, -1 for one per core
+    :return: Pack with the sizes
+    """
+    if zstandard is None:
+        raise PackError('Packing needs the zstandard package, pip install zstandard')
+    compressor = zstandard.ZstdCompressor(level=level, threads=threads)
+    stats = Pack()
+    stats.original_size = os.path.getsize(path)
+    deflate_crc32 = []
+    # The zip is read once, its SHA-256 is computed while it is packed
+    digest = _Digest()
+
+    with open(path, 'rb') as f, open(target, 'wb') as out:
+        out.write(MAGIC)
+        for kind, offset, length, info in dedup_store.zip_regions(path):
+            is_text = (kind == 'member' and info.compress_type == zipfile.ZIP_DEFLATED
+                       and info.file_size >= dedup_store.TEXT_MIN_SIZE
+                       and info.file_size >= dedup_store.TEXT_COMPRESSION_RATIO * info.compress_size)
+            if is_text:
+                header_at = out.tell()
+                out.write(_SEGMENT.pack(DEFLATE, bytes([dedup_store.DEFLATE_LEVEL]), 0))
+                f.seek(offset)
+                before = digest.copy()
+                digest.crc32 = 0
+                try:
+                    with compressor.stream_writer(out, closefd=False) as writer:
+                        for block in dedup_store.inflate_verified(f, length, dedup_store.DEFLATE_LEVEL, digest):
+                            writer.write(block)
+                    end = out.tell()
+                    out.seek(header_at)
+                    out.write(_SEGMENT.pack(DEFLATE, bytes([dedup_store.DEFLATE_LEVEL]),
+                                            end - header_at - _SEGMENT.size))
+                    out.seek(end)
+                    deflate_crc32.append(digest.crc32)
+                    stats.recompressed_members += 1
+                    continue
+                except dedup_store.RecompressMismatch:
+                    logging.info(f'{info.filename} cannot be recompressed identically, keeping it as is')
+                    out.seek(header_at)
+                    out.truncate()
+                    # The member is copied as it is, from the start
+                    digest = before
+
+            f.seek(offset)
+            out.write(_SEGMENT.pack(RAW, b'\0', length))
+            _copy(f, out, length, digest)
+
+        footer = json.dumps({'name': os.path.basename(path), 'size': stats.original_size,
+                             'sha256': digest.sha256.hexdigest(), 'zstd_level': level,
+                             'zlib_version': zlib.ZLIB_RUNTIME_VERSION,
+                             'deflate_crc32': deflate_crc32}).encode('UTF-8')
+        out.write(footer)
+        out.write(_FOOTER.pack(len(footer), END_MAGIC))
+        stats.packed_size = out.tell()
+    return stats
+
+
+def read_footer(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise PackError(f'{path} is not a pack')
+        f.seek(-_FOOTER.size, os.SEEK_END)
+        footer_length, end_magic = _FOOTER.unpack(f.read(_FOOTER.size))
+        if end_magic != END_MAGIC:
+            raise PackError(f'{path} is incomplete')
+        f.seek(-_FOOTER.size - footer_length, os.SEEK_END)
+        return json.loads(f.read(footer_length)), f.tell() - footer_length
+
+
+def unpack(path, target):
+    """Rebuild the original zip of the pack path into target
+
+    :return: True if the rebuilt file has the SHA-256 of the original, False otherwise
+    """
+    if zstandard is None:
+        raise PackError('Unpacking needs the zstandard package, pip install zstandard')
+    footer, footer_at = read_footer(path)
+    decompressor = zstandard.ZstdDecompressor()
+    digest = hashlib.sha256()
+    # Packs written before the CRC-32 was recorded are only checked by the SHA-256 at the end
+    deflate_crc32 = footer.get('deflate_crc32')
+    packed_with = footer.get('zlib_version', 'unknown')
+    if packed_with != zlib.ZLIB_RUNTIME_VERSION:
+        logging.warning(f'{path} was packed with zlib {packed_with}, this is zlib {zlib.ZLIB_RUNTIME_VERSION}. '
+                        'The rebuilt zip may differ from the original')
+    members = 0
+
+    with open(path, 'rb') as f, open(target, 'wb') as out:
+        f.seek(len(MAGIC))
+        while f.tell() < footer_at:
+            kind, level, length = _SEGMENT.unpack(f.read(_SEGMENT.size))
+            if kind == RAW:
+                _copy(f, out, length, digest)
+                continue
+            if kind != DEFLATE:
+                raise PackError(f'Unknown segment type {kind!r} at byte {f.tell() - _SEGMENT.size}')
+            compressor = zlib.compressobj(level[0], zlib.DEFLATED, -zlib.MAX_WBITS)
+            frame = decompressor.decompressobj()
+            crc = 0
+            while length > 0:
+                block = f.read(min(dedup_store.READ_SIZE, length))
+                if not block:
+                    raise IOError('Unexpected end of file')
+                length -= len(block)
+                data = compressor.compress(frame.decompress(block))
+                crc = zlib.crc32(data, crc)
+                digest.update(data)
+                out.write(data)
+            data = compressor.flush()
+            crc = zlib.crc32(data, crc)
+            digest.update(data)
+            out.write(data)
+            if deflate_crc32 is not None and (members >= len(deflate_crc32) or crc != deflate_crc32[members]):
+                logging.error(f'Recompressed member {members + 1} of {path} does not come out as the original '
+                              f'deflate data with zlib {zlib.ZLIB_RUNTIME_VERSION}. Unpack it with zlib '
+                              f'{packed_with}, or restore the original zip uploaded next to the pack')
+                return False
+            members += 1
+
+    if digest.hexdigest() != footer['sha256']:
+        logging.error(f'Unpacked file {target} does not match the original backup')
+        return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser('repack')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    pack_parser = subparsers.add_parser('pack', help='Recompress a backup zip into a pack')
+    pack_parser.add_argument('file')
+    pack_parser.add_argument('--level', help='zstd compression level', type=int, default=DEFAULT_LEVEL)
+    pack_parser.add_argument('--threads', help='zstd worker threads, -1 for one per core', type=int,
+                             default=DEFAULT_THREADS)
+    unpack_parser = subparsers.add_parser('unpack', help='Rebuild the original backup zip from a pack')
+    unpack_parser.add_argument('file')
+    unpack_parser.add_argument('target', help='Full path of the rebuilt zip')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s', level=logging.INFO)
+    if args.command == 'pack':
+        stats = pack(args.file, args.file + PACK_SUFFIX, args.level, args.threads)
+        logging.info(f'{args.file}{PACK_SUFFIX} is {stats.packed_size // 1000000} MB, '
+                     f'{stats.ratio:.2f} times smaller than the zip')
+    elif not unpack(args.file, args.target):
+        sys.exit(1)
+    else:
+        logging.info(args.file + ' is unpacked to ' + args.target)
+
+
+if __name__ == '__main__':
+    main()
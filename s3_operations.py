@@ -1,17 +1,148 @@
 import os
 import sys
 import threading
+import time
 import boto3
 import logging
 import traceback
+import integrity
+import metrics
+from concurrent.futures import ThreadPoolExecutor
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 
+try:
+    import awscrt
+except ImportError:
+    awscrt = None
 
-def upload(file_path, bucket, object_name=None):
+# S3 limits for multipart uploads
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+# Part size of uploads. It has to be known to compare the multipart checksum of S3 with our own
+PART_SIZE = integrity.DEFAULT_PART_SIZE
+DEFAULT_CONCURRENCY = 8
+# Connections of the shared client, raised if more parts are uploaded in parallel
+DEFAULT_POOL_CONNECTIONS = 10
+PROGRESS_INTERVAL = 0.5
+STORAGE_CLASSES = ['STANDARD', 'STANDARD_IA', 'ONEZONE_IA', 'INTELLIGENT_TIERING', 'GLACIER_IR', 'GLACIER',
+                   'DEEP_ARCHIVE']
+SSE_ALGORITHMS = ['AES256', 'aws:kms']
+# Keys per DeleteObjects request
+MAX_DELETE_KEYS = 1000
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def effective_part_size(part_size, total_size=None):
+    """Part size actually used for an upload of total_size bytes, within the S3 limits"""
+    if total_size:
+        part_size = max(part_size, -(-total_size // MAX_PARTS))
+    return max(part_size, MIN_PART_SIZE)
+
+
+def get_client(max_pool_connections=DEFAULT_POOL_CONNECTIONS):
+    """Return the S3 client shared by all uploads of the process
+
+    Clients are thread-safe, but creating one is slow and every client opens its own connections, so one is
+    kept per connection pool size.
+    """
+    max_pool_connections = max(max_pool_connections, DEFAULT_POOL_CONNECTIONS)
+    with _clients_lock:
+        if max_pool_connections not in _clients:
+            # The default boto3 session is not thread-safe, create the client from a session of its own
+            _clients[max_pool_connections] = boto3.session.Session().client(
+                's3', config=Config(max_pool_connections=max_pool_connections, retries={'mode': 'standard'}))
+        return _clients[max_pool_connections]
+
+
+class TransferSettings(object):
+
+    def __init__(self, part_size=PART_SIZE, multipart_threshold=None, max_concurrency=DEFAULT_CONCURRENCY,
+                 use_crt=False, storage_class=None, sse=None, sse_kms_key_id=None, limiter=None):
+        """
+        :param part_size: Size of each multipart upload part in bytes. Raised for very large files to stay
+                          within the 10000 part limit
+        :param multipart_threshold: Files of at least this size are uploaded in parts, smaller ones in one
+                                    request. Defaults to the part size
+        :param max_concurrency: Number of parts uploaded in parallel
+        :param use_crt: Use the AWS Common Runtime transfer client if awscrt is installed
+        :param storage_class: S3 storage class of the uploaded objects, e.g. STANDARD_IA
+        :param sse: Server-side encryption, AES256 or aws:kms
+        :param sse_kms_key_id: KMS key for aws:kms encryption, the default key of the account if not set
+        :param limiter: Optional callable taking a byte count that blocks to enforce a bandwidth limit on file
+                        uploads, e.g. a bandwidth.TokenBucket shared with the download
+        """
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.multipart_threshold = multipart_threshold or self.part_size
+        self.max_concurrency = max_concurrency
+        self.use_crt = use_crt
+        self.storage_class = storage_class
+        self.sse = sse
+        self.sse_kms_key_id = sse_kms_key_id
+        self.limiter = limiter
+        if use_crt and awscrt is None:
+            logging.warning('awscrt is not installed, S3 uploads use the default transfer client')
+            self.use_crt = False
+
+    @classmethod
+    def from_options(cls, options):
+        """Create the settings from the command line arguments"""
+        threshold = options.get('multipart_threshold')
+        return cls(part_size=options.get('part_size', PART_SIZE // (1024 * 1024)) * 1024 * 1024,
+                   multipart_threshold=threshold * 1024 * 1024 if threshold else None,
+                   max_concurrency=options.get('part_concurrency', DEFAULT_CONCURRENCY),
+                   use_crt=options.get('s3_crt', False),
+                   storage_class=options.get('storage_class'),
+                   sse=options.get('sse'),
+                   sse_kms_key_id=options.get('sse_kms_key_id'),
+                   limiter=options.get('limiter'))
+
+    def part_size_for(self, total_size):
+        """Size of the parts S3 gets for a file upload of total_size bytes. A file below the multipart threshold
+        is one part"""
+        if total_size is not None and total_size < self.multipart_threshold:
+            return max(total_size, 1)
+        return effective_part_size(self.part_size, total_size)
+
+    def uses_multipart(self, total_size):
+        """True if a file upload of total_size bytes is a multipart upload. S3 gives these a composite checksum
+        even if they have only one part"""
+        return total_size >= self.multipart_threshold
+
+    def transfer_config(self, total_size):
+        part_size = effective_part_size(self.part_size, total_size)
+        return TransferConfig(multipart_threshold=self.multipart_threshold, multipart_chunksize=part_size,
+                              max_concurrency=self.max_concurrency,
+                              preferred_transfer_client='crt' if self.use_crt else 'classic')
+
+    def object_args(self):
+        """Storage class and encryption arguments of put_object, create_multipart_upload and upload_file"""
+        args = {}
+        if self.storage_class:
+            args['StorageClass'] = self.storage_class
+        if self.sse:
+            args['ServerSideEncryption'] = self.sse
+        if self.sse == 'aws:kms' and self.sse_kms_key_id:
+            args['SSEKMSKeyId'] = self.sse_kms_key_id
+        return args
+
+    def client(self):
+        return get_client(self.max_concurrency)
+
+
+def upload(file_path, bucket, object_name=None, run_metrics=None, settings=None, metadata=None):
     """Upload a file to an S3 bucket
 
+    S3 is asked to store a SHA-256 checksum for every part, see get_checksum.
+
     :param file_path: File to upload
     :param bucket: Bucket to upload to
     :param object_name: S3 object name. If not specified then file_name is used
+    :param run_metrics: Optional metrics.RunMetrics that records the upload time and size
+    :param settings: TransferSettings of the upload, the defaults if not specified
+    :param metadata: Optional dict of user metadata of the object
     :returns True if operation succeeds, False otherwise
     """
 
@@ -19,11 +150,24 @@ def upload(file_path, bucket, object_name=None):
     if object_name is None:
         object_name = file_path
 
-    # Upload the file
-    s3_client = boto3.client('s3')
-
+    settings = settings or TransferSettings()
+    run_metrics = run_metrics or metrics.RunMetrics(None, None)
     try:
-        s3_client.upload_file(file_path, bucket, object_name, Callback=ProgressPercentage(file_path))
+        file_size = os.path.getsize(file_path)
+        extra_args = settings.object_args()
+        extra_args['ChecksumAlgorithm'] = 'SHA256'
+        if metadata:
+            extra_args['Metadata'] = metadata
+        with run_metrics.phase('upload'), ProgressPercentage(file_path) as progress:
+            def callback(bytes_amount):
+                progress(bytes_amount)
+                # The transfer threads call back while they read the file, so waiting here slows them down
+                if settings.limiter is not None:
+                    settings.limiter(bytes_amount)
+
+            settings.client().upload_file(file_path, bucket, object_name, Callback=callback,
+                                          Config=settings.transfer_config(file_size), ExtraArgs=extra_args)
+        run_metrics.count('upload_bytes', file_size)
         return True
     except:
         logging.error('Error in uploading to S3')
@@ -31,18 +175,178 @@ def upload(file_path, bucket, object_name=None):
         return False
 
 
-class ProgressPercentage(object):
+def upload_bytes(data, bucket, object_name, settings=None):
+    """Upload a small object, e.g. a manifest, and return True if it succeeds"""
+    settings = settings or TransferSettings()
+    try:
+        settings.client().put_object(Bucket=bucket, Key=object_name, Body=data, **settings.object_args())
+        return True
+    except Exception:
+        logging.error(f'Error in uploading {object_name} to S3')
+        logging.error(traceback.format_exc())
+        return False
+
+
+def get_checksum(bucket, object_name):
+    """Return the SHA-256 checksum S3 stored for an object, None if there is none"""
+    try:
+        response = get_client().head_object(Bucket=bucket, Key=object_name, ChecksumMode='ENABLED')
+    except Exception:
+        logging.error(f'Cannot read the checksum of {object_name}')
+        logging.error(traceback.format_exc())
+        return None
+    return response.get('ChecksumSHA256')
+
 
-    def __init__(self, filename):
-        self._filename = filename
-        self._size = float(os.path.getsize(filename))
+def delete_objects(bucket, keys):
+    """Delete objects with one request per MAX_DELETE_KEYS keys
+
+    :return: Set of the keys that could not be deleted
+    """
+    client = get_client()
+    failed = set()
+    keys = list(keys)
+    for start in range(0, len(keys), MAX_DELETE_KEYS):
+        batch = keys[start:start + MAX_DELETE_KEYS]
+        try:
+            response = client.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': key} for key in batch],
+                                                                    'Quiet': True})
+        except Exception:
+            logging.error(f'Cannot delete {len(batch)} objects from {bucket}')
+            logging.error(traceback.format_exc())
+            failed.update(batch)
+            continue
+        for error in response.get('Errors', []):
+            logging.error(f'Cannot delete {error["Key"]} from {bucket}: {error.get("Message")}')
+            failed.add(error['Key'])
+    return failed
+
+
+def upload_stream(chunks, bucket, object_name, settings, total_size=None, metadata=None):
+    """Upload an iterable of byte chunks to S3 as a multipart upload without staging it on disk
+
+    Chunks are collected into parts of part_size bytes. At most concurrency parts are uploaded at the same
+    time; reading from chunks blocks while all of them are busy, so memory use stays around
+    (concurrency + 1) * part_size. A stream that fits in one part is uploaded with a single put_object.
+
+    :param chunks: Iterable of bytes, e.g. the iter_content() of a download response
+    :param bucket: Bucket to upload to
+    :param object_name: S3 object name
+    :param settings: TransferSettings with the part size, the number of parts uploaded in parallel and the
+                     storage class and encryption of the object
+    :param total_size: Expected size in bytes if known, used to stay within the 10000 part limit
+    :param metadata: Optional dict of user metadata of the object
+    :returns True if operation succeeds, False otherwise
+    """
+    part_size = effective_part_size(settings.part_size, total_size)
+    concurrency = settings.max_concurrency
+
+    s3_client = settings.client()
+    extra_args = settings.object_args()
+    if metadata:
+        extra_args['Metadata'] = metadata
+    upload_id = None
+    slots = threading.BoundedSemaphore(concurrency)
+    progress = StreamProgress(object_name, total_size)
+
+    def upload_part(part_number, body):
+        try:
+            response = s3_client.upload_part(Bucket=bucket, Key=object_name, UploadId=upload_id,
+                                             PartNumber=part_number, Body=body, ChecksumAlgorithm='SHA256')
+            progress(len(body))
+            return {'PartNumber': part_number, 'ETag': response['ETag'],
+                    'ChecksumSHA256': response['ChecksumSHA256']}
+        finally:
+            slots.release()
+
+    futures = []
+    try:
+        with progress, ThreadPoolExecutor(max_workers=concurrency) as executor:
+            buffer = bytearray()
+            for chunk in chunks:
+                buffer += chunk
+                # Keep the last part back until the stream ends, a stream of one part is sent with put_object
+                while len(buffer) > part_size:
+                    if upload_id is None:
+                        upload_id = s3_client.create_multipart_upload(Bucket=bucket, Key=object_name,
+                                                                      ChecksumAlgorithm='SHA256',
+                                                                      **extra_args)['UploadId']
+                    slots.acquire()
+                    futures.append(executor.submit(upload_part, len(futures) + 1, bytes(buffer[:part_size])))
+                    del buffer[:part_size]
+                    # Stop reading early if a part has already failed
+                    for future in futures:
+                        if future.done() and future.exception() is not None:
+                            raise future.exception()
+
+            if upload_id is None:
+                # A multipart upload of one part would get a checksum of the part checksum instead of the
+                # checksum of the object
+                s3_client.put_object(Bucket=bucket, Key=object_name, Body=bytes(buffer),
+                                     ChecksumAlgorithm='SHA256', **extra_args)
+                progress(len(buffer))
+                return True
+
+            # The last part may be smaller than the minimum part size
+            slots.acquire()
+            futures.append(executor.submit(upload_part, len(futures) + 1, bytes(buffer)))
+            parts = [future.result() for future in futures]
+
+        s3_client.complete_multipart_upload(Bucket=bucket, Key=object_name, UploadId=upload_id,
+                                            MultipartUpload={'Parts': parts})
+        return True
+    except Exception:
+        logging.error('Error in streaming to S3')
+        logging.error(traceback.format_exc())
+        if upload_id is not None:
+            s3_client.abort_multipart_upload(Bucket=bucket, Key=object_name, UploadId=upload_id)
+        return False
+    except KeyboardInterrupt:
+        # Do not leave the uploaded parts behind, S3 keeps charging for them
+        if upload_id is not None:
+            s3_client.abort_multipart_upload(Bucket=bucket, Key=object_name, UploadId=upload_id)
+        raise
+
+
+class StreamProgress(object):
+    """Count uploaded bytes and print the progress at most every PROGRESS_INTERVAL seconds
+
+    The transfer threads call it for every chunk they send, so it only draws when it is time to.
+    """
+
+    def __init__(self, object_name, total_size):
+        self._object_name = object_name
+        self._total_size = total_size
         self._seen_so_far = 0
+        self._next_draw = 0
         self._lock = threading.Lock()
 
     def __call__(self, bytes_amount):
-        # To simplify, assume this is hooked up to a single filename
         with self._lock:
             self._seen_so_far += bytes_amount
-            percentage = (self._seen_so_far / self._size) * 100
-            sys.stdout.write("\r%s  (%.2f%%)" % (self._filename, percentage))
-            sys.stdout.flush()
+            now = time.monotonic()
+            if now < self._next_draw:
+                return
+            self._next_draw = now + PROGRESS_INTERVAL
+            self._draw()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        with self._lock:
+            self._draw()
+
+    def _draw(self):
+        if self._total_size:
+            percentage = (self._seen_so_far / self._total_size) * 100
+            sys.stdout.write("\r%s  (%.2f%%)" % (self._object_name, percentage))
+        else:
+            sys.stdout.write("\r%s  (%d MB)" % (self._object_name, self._seen_so_far // 1000000))
+        sys.stdout.flush()
+
+
+class ProgressPercentage(StreamProgress):
+
+    def __init__(self, filename):
+        super().__init__(filename, os.path.getsize(filename))
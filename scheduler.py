@@ -0,0 +1,232 @@
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+import bandwidth
+import catalog
+import confluence_backup
+import downloader
+import export_state
+import jira_backup
+import metrics
+import operations
+
+# Runs the backups of many sites and products from one process. Exports are triggered and polled in
+# parallel, and finished exports are handed to a bounded pool of download/upload workers.
+#
+# Example configuration:
+# {
+#     "folder": "/backups",
+#     "s3_bucket": "my-backup-bucket",
+#     "max_downloads": 4,
+#     "bandwidth_mb": 200,
+#     "bandwidth_schedule": "mon-fri 08:00-18:00=50",
+#     "adaptive_bandwidth": true,
+#     "metrics_dir": "/var/lib/node_exporter/textfile",
+#     "catalog": "/backups/backup_catalog.sqlite",
+#     "retention": {"daily": 7, "weekly": 4, "monthly": 12},
+#     "wait_for_cooldown_minutes": 30,
+#     "sites": [
+#         {"site": "acme", "user": "admin@acme.com", "token_env": "ACME_TOKEN",
+#          "products": ["jira", "confluence"], "with_attachments": true, "bandwidth_mb": 50}
+#     ]
+# }
+
+PRODUCTS = {
+    'jira': (jira_backup.jira_backup, jira_backup.FILE_LAST_BACKUP_URL),
+    'confluence': (confluence_backup.conf_backup, confluence_backup.FILE_LAST_BACKUP_URL),
+}
+DEFAULT_MAX_DOWNLOADS = 2
+# Result of a job that did not run because another backup of the site was running
+SKIPPED = 'skipped'
+
+
+def load_config(file_name):
+    with open(file_name, 'r', encoding='UTF-8') as cf:
+        config = json.load(cf)
+
+    for site in config['sites']:
+        # Keep tokens out of the configuration file if possible
+        if 'token_env' in site:
+            site['token'] = os.environ[site['token_env']]
+        for product in site['products']:
+            if product not in PRODUCTS:
+                raise ValueError(f'Unknown product {product} for site {site["site"]}')
+    for period in config.get('retention', {}):
+        if period not in catalog.PERIODS:
+            raise ValueError(f'Unknown retention period {period}, use one of {", ".join(catalog.PERIODS)}')
+    return config
+
+
+def limiter_of(config):
+    """Bandwidth limiter of the global or site configuration, None if it has no bandwidth settings"""
+    return bandwidth.from_mb(config.get('bandwidth_mb'), config.get('bandwidth_schedule'),
+                             config.get('adaptive_bandwidth', False))
+
+
+class Scheduler(object):
+
+    def __init__(self, config):
+        self._config = config
+        self._global_limiter = limiter_of(config)
+        self._downloads = ThreadPoolExecutor(max_workers=config.get('max_downloads', DEFAULT_MAX_DOWNLOADS))
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def catalog_path(self):
+        # One catalog for all sites
+        return self._config.get('catalog') or catalog.default_path(self._config['folder'])
+
+    def apply_retention(self):
+        """Prune the backups of all sites with the retention policy of the configuration, if there is one"""
+        policy = self._config.get('retention')
+        if not policy:
+            return True
+        backups = catalog.Catalog(self.catalog_path())
+        try:
+            pruned = catalog.prune(backups, policy)
+            logging.info(f'{len(pruned)} old backups deleted')
+            return True
+        except Exception:
+            logging.error('Cannot apply the retention policy')
+            logging.error(traceback.format_exc())
+            return False
+        finally:
+            backups.close()
+
+    def _finish(self, job, session, run_metrics, successful, state=None):
+        """:param successful: True, False or SKIPPED"""
+        if state is not None:
+            state.release()
+        session.transport_stats.log()
+        operations.report_run(run_metrics, session, successful is True, self._config.get('metrics_dir'),
+                              skipped=successful == SKIPPED)
+        with self._lock:
+            self._results[job] = successful
+
+    def run_export(self, site, product, limiter):
+        """Trigger the export of one product of a site, wait for it and queue its download"""
+        job = f'{site["site"]}-{product}'
+        backup, url_file = PRODUCTS[product]
+        # Every site needs its own last backup URL file
+        url_file = f'{site["site"]}_{url_file}'
+        workers = self._config.get('download_options', {}).get('workers', downloader.DEFAULT_WORKERS)
+        session = operations.get_session(site['user'], site['token'], workers + 2)
+        limiter.watch(session)
+        run_metrics = metrics.RunMetrics(site['site'], product)
+
+        state = export_state.ExportState.load(export_state.state_file(site['site'], product))
+        if not state.acquire():
+            logging.info(f'{job}: another backup of the site is running, see {state.path}')
+            self._finish(job, session, run_metrics, SKIPPED)
+            return None
+        # Exports that can be triggered soon are waited for, so that the run does not miss them by minutes
+        next_trigger = state.next_trigger_at()
+        if (next_trigger is not None and not state.resumable() and not site.get('download_only')
+                and next_trigger - time.time() <= self._config.get('wait_for_cooldown_minutes', 0) * 60):
+            logging.info(f'{job}: waiting until {export_state.format_time(next_trigger)} to start the export')
+            time.sleep(max(next_trigger - time.time(), 0))
+
+        try:
+            if site.get('download_only'):
+                file_url = operations.get_backup_file_url(url_file)
+            else:
+                logging.info(f'{job}: starting the export')
+                file_url = backup(site['site'], site.get('with_attachments', False), session, url_file,
+                                  run_metrics=run_metrics, state=state)
+        except BaseException:
+            # The product scripts call exit() on errors, which must only end this job
+            logging.error(f'{job}: export failed')
+            logging.error(traceback.format_exc())
+            self._finish(job, session, run_metrics, False, state)
+            return None
+
+        if file_url is None:
+            if state.status == export_state.DOWNLOADED:
+                logging.info(f'{job}: the backup file of the last export is already downloaded')
+                self._finish(job, session, run_metrics, True, state)
+            else:
+                logging.error(f'{job}: no backup file to download')
+                self._finish(job, session, run_metrics, False, state)
+            return None
+
+        logging.info(f'{job}: export is ready, queueing the download')
+        return self._downloads.submit(self.run_download, job, site, file_url, session, limiter, run_metrics, state)
+
+    def run_download(self, job, site, file_url, session, limiter, run_metrics, state=None):
+        folder = os.path.join(self._config['folder'], site['site'])
+        os.makedirs(folder, exist_ok=True)
+        options = dict(self._config.get('download_options', {}))
+        options['limiter'] = limiter
+        options['metrics'] = run_metrics
+        options['site'] = site['site']
+        options['product'] = run_metrics.product
+        options['catalog'] = self.catalog_path()
+        options['export_state'] = state
+
+        try:
+            # Prefix the file with the site name so backups of different sites do not overwrite each other in S3
+            successful = operations.download_backup_and_upload_to_s3(file_url, folder, session, job,
+                                                                       self._config.get('s3_bucket'), options)
+        except BaseException:
+            logging.error(f'{job}: download failed')
+            logging.error(traceback.format_exc())
+            successful = False
+        self._finish(job, session, run_metrics, successful, state)
+
+    def run(self):
+        """Run all exports and downloads and return a dict of job name to True, False or SKIPPED"""
+        jobs = [(site, product) for site in self._config['sites'] for product in site['products']]
+        # Waiting for an export is mostly sleeping, so every export gets its own thread
+        with ThreadPoolExecutor(max_workers=max(len(jobs), 1)) as exports:
+            site_limiters = {site['site']: limiter_of(site) for site in self._config['sites']}
+            futures = [exports.submit(self.run_export, site, product,
+                                      bandwidth.CombinedLimiter(site_limiters[site['site']], self._global_limiter))
+                       for site, product in jobs]
+            downloads = [future.result() for future in futures]
+
+        for download in downloads:
+            if download is not None:
+                download.result()
+        self._downloads.shutdown()
+
+        for site, limiter in sorted(site_limiters.items()):
+            if limiter is not None:
+                limiter.log(f'Transfers of {site}')
+        if self._global_limiter is not None:
+            self._global_limiter.log('All transfers')
+        return dict(self._results)
+
+
+def main():
+    parser = argparse.ArgumentParser('scheduler')
+    parser.add_argument('-c', '--config', help='JSON file with the sites and products to back up', required=True)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s %(asctime)s %(threadName)s %(message)s',
+                        level=logging.INFO,
+                        encoding='utf-8',
+                        handlers=[
+                            logging.FileHandler('scheduler.log'),
+                            logging.StreamHandler()
+                        ])
+
+    scheduler = Scheduler(load_config(args.config))
+    results = scheduler.run()
+    for job, successful in sorted(results.items()):
+        if successful == SKIPPED:
+            logging.info(f'{job}: skipped, another backup of the site is running')
+        else:
+            logging.info(f'{job}: {"finished successfully" if successful else "finished with errors"}')
+    retained = scheduler.apply_retention()
+
+    if any(successful is False for successful in results.values()) or not retained:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+import logging
+import re
+import threading
+import time
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError, ProtocolError, ReadTimeoutError
+from urllib3.util.retry import Retry
+
+# HTTP transport shared by the trigger, progress and download calls of a backup run. One session keeps its
+# connections alive between the phases, retries transient failures of idempotent requests and counts the
+# latency and retries of every endpoint.
+#
+# urllib3 only retries until the response headers have arrived. A streamed body that breaks off later is retried
+# by the caller with retry_body, which takes the attempts and the backoff from the same policy and counts them
+# with the other retries.
+
+DEFAULT_POOL_SIZE = 10
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 120
+MAX_RETRIES = 5
+BACKOFF_FACTOR = 1
+RETRY_STATUSES = (500, 502, 503, 504)
+# POST is left out: a repeated runbackup could start a second export
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'])
+# Errors while reading a streamed body, the requests ones come from iter_content
+STREAM_ERRORS = (ProtocolError, ReadTimeoutError, requests.exceptions.ChunkedEncodingError,
+                 requests.exceptions.ConnectionError)
+
+_ID_SEGMENT = re.compile(r'^[0-9a-fA-F-]{8,}$|^\d{3,}$')
+
+
+def endpoint(method, url):
+    """Group requests by method and path, with ids replaced so they add up per endpoint"""
+    path = urlparse(url).path
+    path = '/'.join('{id}' if _ID_SEGMENT.match(segment) else segment for segment in path.split('/'))
+    return f'{method} {path}'
+
+
+class TransportStats(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        self._listeners = []
+
+    def add_listener(self, listener):
+        """Call listener(method, url, seconds, failed) after every request, e.g. to follow the latency"""
+        self._listeners.append(listener)
+
+    def _entry(self, key):
+        return self._endpoints.setdefault(key, {'requests': 0, 'errors': 0, 'retries': 0,
+                                                'total_seconds': 0.0, 'max_seconds': 0.0})
+
+    def request(self, method, url, seconds, failed):
+        with self._lock:
+            entry = self._entry(endpoint(method, url))
+            entry['requests'] += 1
+            entry['errors'] += int(failed)
+            entry['total_seconds'] += seconds
+            entry['max_seconds'] = max(entry['max_seconds'], seconds)
+        for listener in self._listeners:
+            listener(method, url, seconds, failed)
+
+    def retry(self, method, url):
+        with self._lock:
+            self._entry(endpoint(method, url or ''))['retries'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {key: dict(value) for key, value in self._endpoints.items()}
+
+    def totals(self):
+        """Requests, retries and errors summed over all endpoints"""
+        totals = {'requests': 0, 'retries': 0, 'errors': 0}
+        for entry in self.snapshot().values():
+            for key in totals:
+                totals[key] += entry[key]
+        return totals
+
+    def log(self):
+        for key, entry in sorted(self.snapshot().items()):
+            average = entry['total_seconds'] / entry['requests'] if entry['requests'] else 0
+            logging.info(f'{key}: {entry["requests"]} requests, {entry["retries"]} retries, '
+                         f'{entry["errors"]} errors, {average:.3f}s average, {entry["max_seconds"]:.3f}s max '
+                         f'time to response headers including retries')
+
+
+class CountingRetry(Retry):
+    """urllib3 retry policy that reports every retry to a TransportStats"""
+
+    def __init__(self, *args, stats=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = stats
+
+    def new(self, **kwargs):
+        retry = super().new(**kwargs)
+        retry.stats = self.stats
+        return retry
+
+    def increment(self, method=None, url=None, *args, **kwargs):
+        # Raises MaxRetryError once the retries are used up, that last attempt is not retried
+        retry = super().increment(method, url, *args, **kwargs)
+        if self.stats is not None:
+            self.stats.retry(method, url)
+        return retry
+
+
+def body_retry(session, url):
+    """Retry state for the streamed body of a request to url, before its first retry, see retry_body"""
+    return session.get_adapter(url).max_retries
+
+
+def retry_body(retry, method, url, error):
+    """Count a streamed body that failed with error as a retry and wait the backoff of the retry policy
+
+    :param retry: Retry state of the earlier attempts, body_retry for the first one
+    :return: Retry state for the next attempt. Raises error once the retries are used up
+    """
+    try:
+        retry = retry.increment(method, url, error=error)
+    except MaxRetryError:
+        raise error
+    logging.warning(f'{method} {url} broke off, retrying: {error}')
+    retry.sleep()
+    return retry
+
+
+class InstrumentedAdapter(HTTPAdapter):
+
+    def __init__(self, stats, timeout, **kwargs):
+        self._stats = stats
+        self._timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        start = time.perf_counter()
+        failed = True
+        try:
+            response = super().send(request, timeout=timeout or self._timeout, **kwargs)
+            failed = response.status_code >= 400
+            return response
+        finally:
+            self._stats.request(request.method, request.url, time.perf_counter() - start, failed)
+
+
+def create_session(pool_size=DEFAULT_POOL_SIZE, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                   max_retries=MAX_RETRIES):
+    """Create a requests session with sized connection pools, timeouts, retries and statistics
+
+    The statistics are available as session.transport_stats.
+
+    :param pool_size: Connections kept per host, should be at least the number of parallel downloads
+    :param connect_timeout: Seconds to wait for a connection
+    :param read_timeout: Seconds to wait for data from the server
+    :param max_retries: Retries of a failed idempotent request, with exponential backoff
+    """
+    stats = TransportStats()
+    retry = CountingRetry(total=max_retries, connect=max_retries, read=max_retries, status=max_retries,
+                          backoff_factor=BACKOFF_FACTOR, status_forcelist=RETRY_STATUSES,
+                          allowed_methods=IDEMPOTENT_METHODS, respect_retry_after_header=True,
+                          raise_on_status=False, stats=stats)
+    adapter = InstrumentedAdapter(stats, (connect_timeout, read_timeout), pool_connections=pool_size,
+                                  pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.transport_stats = stats
+    return session